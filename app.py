@@ -1,21 +1,135 @@
 import os
 import logging
-import concurrent.futures
-import io
-from flask import Flask, render_template, request, flash, redirect, url_for, make_response
-from soap_client import ConsultaExpedientes
+import json
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from flask import Flask, render_template, request, flash, redirect, url_for, jsonify, send_file, Response, stream_with_context, g
+from flask import before_render_template, template_rendered
+from werkzeug.utils import secure_filename
+import metricas
+from soap_client import obtener_cliente, IUE_PATTERN, ConsultaExpedientes, etag_resultado, expediente_encontrado
+from motor_lote import obtener_motor, BATCH_MAX_SIZE
+from seguimiento import Seguimiento
+from escaneo_rangos import ErrorEscaneo, EscanerRangos
+from trabajos_pdf import ColaTrabajosPDF
+from resultados_guardados import ResultadosGuardados
+from indice_busqueda import IndiceBusqueda, SEARCH_MAX_RESULTS
+from historial_expedientes import HistorialExpedientes, HISTORY_DB
+from renderizadores import obtener_renderizador, RENDERIZADORES
+from importacion_iues import ImportadorIUEs, leer_archivo, csv_en_partes, escribir_xlsx
 import re
-from xhtml2pdf import pisa
 
-# Configuración de logging
-logging.basicConfig(level=logging.DEBUG)
+# Configuración de logging (LOG_LEVEL=DEBUG para ver el detalle de las consultas)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "default-secret-key")
 
-# Patrón para validar IUE
-IUE_PATTERN = r'^\d{1,3}\s*-\s*\d+\s*/\s*\d{4}$'
+# Inicio de los renders en curso por hilo (las plantillas pueden anidarse)
+_renders = threading.local()
+
+@before_render_template.connect_via(app)
+def _inicio_render(sender, template, context, **extra):
+    if not hasattr(_renders, 'inicios'):
+        _renders.inicios = []
+    _renders.inicios.append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _fin_render(sender, template, context, **extra):
+    inicios = getattr(_renders, 'inicios', None)
+    if inicios:
+        metricas.observar('render', time.perf_counter() - inicios.pop())
+
+@app.before_request
+def _iniciar_medicion():
+    g.inicio_request = time.perf_counter()
+    # Perfil por request opcional: con X-Perfil: 1 se devuelve el detalle en Server-Timing
+    if request.headers.get('X-Perfil', '').lower() in ('1', 'true', 'si'):
+        g.perfil, g.perfil_token = metricas.activar_perfil()
+
+@app.after_request
+def _registrar_medicion(response):
+    inicio = g.get('inicio_request')
+    if inicio is not None:
+        duracion = time.perf_counter() - inicio
+        metricas.REQUESTS.observar(request.endpoint or 'desconocido', duracion)
+        perfil = g.get('perfil')
+        if perfil is not None:
+            # En respuestas en streaming sólo se incluye lo medido hasta empezar a enviarlas
+            resumen = metricas.server_timing(perfil)
+            response.headers['Server-Timing'] = f'total;dur={duracion * 1000:.1f}' + (f', {resumen}' if resumen else '')
+    return response
+
+@app.teardown_request
+def _terminar_medicion(error=None):
+    token = g.pop('perfil_token', None)
+    if token is not None:
+        metricas.desactivar_perfil(token)
+    # Un render que lanzó una excepción no llega a _fin_render: su inicio no debe
+    # quedar en la pila del hilo para el próximo request
+    _renders.inicios = []
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Métricas del proceso en formato de texto de Prometheus
+    """
+    return Response(metricas.exportar(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    El proceso está vivo y atiende pedidos (no verifica dependencias)
+    """
+    return jsonify({'estado': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    El proceso puede atender consultas: el cliente SOAP está cargado. El estado del
+    circuito se informa pero no cuenta: si el servicio del Poder Judicial está caído
+    todos los workers lo están, y sacarlos de servicio no ayuda.
+    """
+    try:
+        cliente = obtener_cliente()
+    except ConnectionError as e:
+        return jsonify({'listo': False, 'error': str(e)}), 503
+    return jsonify({'listo': True, 'circuito': cliente.circuito.estado, 'wsdl_vencido': cliente.wsdl_vencido()})
+
+def calentar():
+    """
+    Prepara el proceso antes de atender pedidos: carga el cliente SOAP (el WSDL) y
+    compila las plantillas. Con gunicorn se llama en el proceso maestro antes del
+    fork (ver gunicorn.conf.py), así los workers arrancan con todo cargado.
+    Returns:
+        bool: True si el cliente SOAP quedó listo
+    """
+    global _plantilla_pdf
+    with metricas.medir('calentamiento'):
+        for nombre in app.jinja_env.list_templates(extensions=['html']):
+            app.jinja_env.get_template(nombre)
+        if 'pdf_template.html' in app.jinja_env.list_templates():
+            _plantilla_pdf = app.jinja_env.get_template('pdf_template.html')
+        # xhtml2pdf tarda en importarse; importado antes del fork lo comparten los workers
+        import xhtml2pdf.pisa
+        try:
+            obtener_cliente()
+        except ConnectionError as e:
+            logger.warning(f"No se pudo cargar el cliente SOAP al arrancar: {str(e)}")
+            return False
+    return True
+
+def _usar_cache():
+    """
+    La caché de resultados se puede saltear con ?sin_cache=1 (o el campo de formulario)
+    o enviando el encabezado Cache-Control: no-cache
+    """
+    if request.values.get('sin_cache', '').lower() in ('1', 'true', 'si'):
+        return False
+    return 'no-cache' not in request.headers.get('Cache-Control', '')
 
 @app.route('/', methods=['GET'])
 def index():
@@ -34,9 +148,11 @@ def consultar():
         return redirect(url_for('index'))
 
     try:
-        cliente = ConsultaExpedientes()
-        resultado = cliente.consultar_expediente(iue)
-        return render_template('results.html', resultado=resultado, iue=iue)
+        cliente = obtener_cliente()
+        resultado = cliente.consultar_expediente(iue, usar_cache=_usar_cache())
+        # El PDF se genera luego a partir de estos mismos resultados (?token=...)
+        token = _obtener_guardados().guardar({'tipo': 'individual', 'iue': iue, 'resultado': resultado})
+        return render_template('results.html', resultado=resultado, iue=iue, token=token)
 
     except ConnectionError as e:
         logger.error(f"Error de conexión: {str(e)}")
@@ -57,122 +173,578 @@ def consultar():
 def consulta_lote():
     return render_template('batch_search.html')
 
-@app.route('/consultar-lote', methods=['POST'])
-def consultar_lote():
-    sede = request.form.get('sede', '').strip()
-    desde = int(request.form.get('desde', 1))
-    hasta = int(request.form.get('hasta', 30))
-    anio = request.form.get('anio', '2024').strip()
+def _leer_rango_lote(valores):
+    """
+    Lee y valida sede, desde, hasta y año de un formulario de consulta en lote
+    (o de un objeto JSON, donde los valores pueden venir como números)
+    Raises:
+        ValueError: Si el rango no es válido (el mensaje es apto para mostrar al usuario)
+    """
+    sede, anio = valores.get('sede', ''), valores.get('anio', '2024')
+    if any(isinstance(valor, bool) or not isinstance(valor, (str, int)) for valor in (sede, anio)):
+        raise ValueError('La sede y el año deben ser texto o números')
+    sede, anio = str(sede).strip(), str(anio).strip()
+    try:
+        desde = int(valores.get('desde', 1))
+        hasta = int(valores.get('hasta', 30))
+    except (TypeError, ValueError):
+        raise ValueError('Los números de expediente deben ser enteros')
 
     if hasta < desde:
-        flash('El número final debe ser mayor o igual al inicial', 'error')
-        return redirect(url_for('consulta_lote'))
+        raise ValueError('El número final debe ser mayor o igual al inicial')
 
-    if hasta - desde > 50:
-        flash('Por favor, consulte máximo 50 expedientes a la vez', 'error')
-        return redirect(url_for('consulta_lote'))
+    if hasta - desde + 1 > BATCH_MAX_SIZE:
+        raise ValueError(f'Por favor, consulte máximo {BATCH_MAX_SIZE} expedientes a la vez')
 
-    resultados = []
-    cliente = ConsultaExpedientes()
+    return sede, desde, hasta, anio
 
-    # Procesar las consultas en paralelo para mejorar rendimiento
-    def consultar_iue(nro):
-        iue = f"{sede}-{nro}/{anio}"
-        try:
-            return cliente.consultar_expediente(iue)
-        except Exception as e:
-            logger.error(f"Error consultando {iue}: {str(e)}")
-            return {
-                'expediente': iue,
-                'origen': 'Error en la consulta',
-                'caratula': str(e)
-            }
-
-    # Usar ThreadPoolExecutor para paralelizar las consultas
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        # Crear un futures para cada número en el rango
-        futures = {executor.submit(consultar_iue, nro): nro for nro in range(desde, hasta + 1)}
-        
-        # Procesar los resultados a medida que se completan
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                resultado = future.result()
-                if resultado:
-                    resultados.append(resultado)
-            except Exception as e:
-                nro = futures[future]
-                iue = f"{sede}-{nro}/{anio}"
-                logger.error(f"Excepción en consulta de {iue}: {str(e)}")
-                resultados.append({
-                    'expediente': iue,
-                    'origen': 'Error',
-                    'caratula': f"Error: {str(e)}"
-                })
-
-    # Ordenar resultados por número de expediente
-    resultados.sort(key=lambda x: int(re.search(r'-\s*(\d+)\s*/', x['expediente']).group(1)))
+@app.route('/consultar-lote', methods=['POST'])
+def consultar_lote():
+    try:
+        sede, desde, hasta, anio = _leer_rango_lote(request.form)
+    except ValueError as ve:
+        flash(str(ve), 'error')
+        return redirect(url_for('consulta_lote'))
+
+    # El motor de lotes consulta en paralelo respetando el límite de tasa global
+    # y devuelve los resultados ordenados por número de expediente
+    iues = [f"{sede}-{nro}/{anio}" for nro in range(desde, hasta + 1)]
+    try:
+        resultados = obtener_motor().consultar(iues, usar_cache=_usar_cache())
+    except TimeoutError as e:
+        logger.error(str(e))
+        flash('La consulta en lote tardó demasiado. Por favor, intente con un rango menor o más tarde.', 'error')
+        return redirect(url_for('consulta_lote'))
     
+    token = _obtener_guardados().guardar({
+        'tipo': 'lote', 'sede': sede, 'desde': desde, 'hasta': hasta, 'anio': anio, 'resultados': resultados
+    })
+
     return render_template('batch_results.html', 
                           resultados=resultados, 
                           sede=sede, 
                           desde=desde, 
                           hasta=hasta, 
-                          anio=anio)
+                          anio=anio,
+                          token=token)
+
+@app.route('/consultar-lote/stream', methods=['GET', 'POST'])
+def consultar_lote_stream():
+    """
+    Igual que /consultar-lote pero envía cada expediente apenas se obtiene, como NDJSON
+    (por defecto) o Server-Sent Events (formato=sse o Accept: text/event-stream).
+    Los expedientes llegan en orden de finalización; cada evento incluye `indice`
+    (posición dentro del rango) para que el cliente los ubique en orden por número.
+    """
+    try:
+        sede, desde, hasta, anio = _leer_rango_lote(request.values)
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+
+    sse = request.values.get('formato') == 'sse' or request.accept_mimetypes.best == 'text/event-stream'
+    iues = [f"{sede}-{nro}/{anio}" for nro in range(desde, hasta + 1)]
+    total = len(iues)
+    usar_cache = _usar_cache()
+
+    def serializar(evento, datos):
+        texto = json.dumps(datos, ensure_ascii=False, default=str)
+        if sse:
+            return f"event: {evento}\ndata: {texto}\n\n"
+        return texto + "\n"
+
+    def generar():
+        resultados = [None] * total
+        for indice, resultado in obtener_motor().consultar_iter(iues, usar_cache=usar_cache):
+            resultados[indice] = resultado
+            yield serializar('expediente', {'indice': indice, 'total': total, 'resultado': resultado})
+        # El token permite exportar a PDF sin volver a consultar el rango
+        token = _obtener_guardados().guardar({
+            'tipo': 'lote', 'sede': sede, 'desde': desde, 'hasta': hasta, 'anio': anio, 'resultados': resultados
+        })
+        yield serializar('fin', {'fin': True, 'total': total, 'token': token})
+
+    response = Response(stream_with_context(generar()),
+                        mimetype='text/event-stream' if sse else 'application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Evita que un proxy (nginx) acumule la respuesta antes de enviarla
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+_escaner = None
+
+def _obtener_escaner():
+    global _escaner
+    if _escaner is None:
+        _escaner = EscanerRangos()
+    return _escaner
+
+def _validar_sede_anio(sede, anio):
+    if not re.match(r'^\d{1,3}$', sede) or not re.match(r'^\d{4}$', anio):
+        raise ValueError('La sede debe tener hasta 3 dígitos y el año 4 dígitos')
+
+@app.route('/escaneo/<sede>/<anio>/limite', methods=['GET'])
+def escaneo_limite(sede, anio):
+    """
+    Número de expediente más alto registrado de una sede en un año (?forzar=1 lo recalcula)
+    """
+    try:
+        _validar_sede_anio(sede, anio)
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    forzar = request.args.get('forzar', '').lower() in ('1', 'true', 'si')
+    try:
+        limite = _obtener_escaner().buscar_limite(sede, anio, forzar=forzar)
+    except ErrorEscaneo as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify({'sede': sede, 'anio': anio, 'limite': limite})
+
+@app.route('/escaneo/<sede>/<anio>', methods=['GET'])
+def escaneo(sede, anio):
+    """
+    Todos los expedientes de una sede en un año, como NDJSON en orden por número,
+    sin necesidad de indicar desde/hasta
+    """
+    try:
+        _validar_sede_anio(sede, anio)
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    usar_cache = _usar_cache()
+
+    def generar():
+        total = 0
+        try:
+            for resultado in _obtener_escaner().escanear(sede, anio, usar_cache=usar_cache):
+                total += 1
+                yield json.dumps(resultado, ensure_ascii=False, default=str) + "\n"
+        except ErrorEscaneo as e:
+            # La respuesta ya empezó: el error va como último evento del stream
+            logger.warning(str(e))
+            yield json.dumps({'fin': False, 'error': str(e), 'total': total}, ensure_ascii=False) + "\n"
+            return
+        yield json.dumps({'fin': True, 'total': total}) + "\n"
+
+    response = Response(stream_with_context(generar()), mimetype='application/x-ndjson')
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+_seguimiento = None
+
+def _obtener_seguimiento():
+    global _seguimiento
+    if _seguimiento is None:
+        _seguimiento = Seguimiento()
+    return _seguimiento
+
+@app.route('/seguimiento', methods=['GET'])
+def seguimiento_listar():
+    return jsonify({'expedientes': _obtener_seguimiento().listar()})
+
+@app.route('/seguimiento', methods=['POST'])
+def seguimiento_agregar():
+    """
+    Agrega IUEs a la lista de seguimiento. Cuerpo JSON: {"iues": ["2-1234/2024", ...]}
+    """
+    datos = request.get_json(silent=True) or {}
+    iues = datos.get('iues')
+    if not isinstance(iues, list) or not iues:
+        return jsonify({'error': 'Debe enviar una lista de IUEs en "iues"'}), 400
+    invalidos = [iue for iue in iues if not isinstance(iue, str) or not re.match(IUE_PATTERN, iue.strip())]
+    if invalidos:
+        return jsonify({'error': 'Formato de IUE inválido', 'iues': invalidos}), 400
+    return jsonify({'agregados': _obtener_seguimiento().agregar(iues)}), 201
+
+@app.route('/seguimiento/cambios', methods=['GET'])
+def seguimiento_cambios():
+    """
+    Movimientos nuevos detectados por `python seguimiento.py ejecutar`.
+    Se paginan con ?desde_id=<id del último evento recibido>.
+    """
+    desde_id = request.args.get('desde_id', 0, type=int)
+    limite = max(1, min(request.args.get('limite', 500, type=int), 500))
+    return jsonify({'eventos': _obtener_seguimiento().cambios(desde_id, limite)})
 
-@app.route('/descargar-pdf/<tipo>/<parametros>')
+@app.route('/api/expedientes/<path:iue>', methods=['GET'])
+def api_expediente(iue):
+    """
+    Resultado de consultar_expediente como JSON, con ETag: si el cliente envía
+    If-None-Match con el ETag vigente se responde 304 sin cuerpo
+    """
+    if not re.match(IUE_PATTERN, iue):
+        return jsonify({'error': 'Formato de IUE inválido. Debe ser: Sede - NroRegistro / Año'}), 400
+    try:
+        resultado = obtener_cliente().consultar_expediente(iue, usar_cache=_usar_cache())
+    except ConnectionError as e:
+        return jsonify({'error': str(e)}), 503
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    except Exception as e:
+        logger.error(f"Error en la API consultando {iue}: {str(e)}")
+        return jsonify({'error': str(e)}), 502
+    if not expediente_encontrado(resultado):
+        return jsonify({'error': 'Expediente no encontrado', 'expediente': resultado.get('expediente', iue)}), 404
+    response = jsonify(resultado)
+    # Débil: el mismo contenido puede serializarse distinto (p. ej. marcado como desactualizado)
+    response.set_etag(etag_resultado(resultado), weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/api/expedientes', methods=['POST'])
+def api_expedientes_lote():
+    """
+    Consulta varios expedientes. Cuerpo JSON:
+        {"iues": ["2-1234/2024", ...], "etags": {"2-1234/2024": "<etag conocido>", ...}}
+    Devuelve en `expedientes` (en el orden pedido) sólo los que cambiaron respecto
+    del ETag enviado, con su ETag nuevo; en `sin_cambios` los demás y en `errores`
+    los que no se pudieron consultar. Los ETags son los mismos que devuelve
+    /api/expedientes/<iue> (se aceptan con o sin W/ y comillas).
+    """
+    datos = request.get_json(silent=True) or {}
+    iues = datos.get('iues')
+    etags = datos.get('etags') or {}
+    if not isinstance(iues, list) or not iues or not isinstance(etags, dict):
+        return jsonify({'error': 'Debe enviar una lista de IUEs en "iues" y, opcionalmente, "etags"'}), 400
+    if len(iues) > BATCH_MAX_SIZE:
+        return jsonify({'error': f'Se pueden consultar como máximo {BATCH_MAX_SIZE} expedientes a la vez'}), 400
+    invalidos = [iue for iue in iues if not isinstance(iue, str) or not re.match(IUE_PATTERN, iue.strip())]
+    if invalidos:
+        return jsonify({'error': 'Formato de IUE inválido', 'iues': invalidos}), 400
+
+    # El IUE de cada ETag conocido puede venir escrito de cualquier forma válida
+    conocidos = {}
+    for iue, etag in etags.items():
+        if isinstance(iue, str) and isinstance(etag, str) and re.match(IUE_PATTERN, iue.strip()):
+            conocidos[ConsultaExpedientes._limpiar_iue(iue)] = etag.strip().removeprefix('W/').strip('"')
+
+    limpios = list(dict.fromkeys(ConsultaExpedientes._limpiar_iue(iue) for iue in iues))
+    respuesta = {'expedientes': [], 'sin_cambios': [], 'no_encontrados': [], 'errores': []}
+    try:
+        resultados = obtener_motor().consultar(limpios, usar_cache=_usar_cache())
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 504
+    for iue, resultado in zip(limpios, resultados):
+        if resultado.get('error'):
+            respuesta['errores'].append({'iue': iue, 'error': resultado.get('caratula')})
+        elif not expediente_encontrado(resultado):
+            respuesta['no_encontrados'].append(iue)
+        else:
+            etag = etag_resultado(resultado)
+            if conocidos.get(iue) == etag:
+                respuesta['sin_cambios'].append(iue)
+            else:
+                respuesta['expedientes'].append({'iue': iue, 'etag': etag, 'resultado': resultado})
+    return jsonify(respuesta)
+
+_historial = None
+
+def _obtener_historial():
+    global _historial
+    if _historial is None:
+        _historial = HistorialExpedientes(HISTORY_DB)
+    return _historial
+
+def _leer_momento(valor, fin_del_dia=False):
+    """
+    Convierte una fecha (aaaa-mm-dd) o fecha y hora ISO en timestamp. Una fecha sola
+    se toma al final del día si fin_del_dia, o al principio si no.
+    Raises:
+        ValueError: Si el formato no es válido
+    """
+    if len(valor) == 10:
+        hora = datetime.max.time() if fin_del_dia else datetime.min.time()
+        return datetime.combine(date.fromisoformat(valor), hora).timestamp()
+    return datetime.fromisoformat(valor).timestamp()
+
+@app.route('/api/expedientes/<path:iue>/historial', methods=['GET'])
+def api_historial(iue):
+    """
+    Historial local del expediente, sin consultar el servicio. Con ?fecha=aaaa-mm-dd
+    (o fecha y hora ISO) devuelve el expediente tal como se lo conocía en ese momento;
+    si no, los cambios de cada versión, opcionalmente entre ?desde y ?hasta.
+    """
+    if not HISTORY_DB:
+        return jsonify({'error': 'El historial está desactivado (HISTORY_DB)'}), 404
+    if not re.match(IUE_PATTERN, iue):
+        return jsonify({'error': 'Formato de IUE inválido. Debe ser: Sede - NroRegistro / Año'}), 400
+    iue = ConsultaExpedientes._limpiar_iue(iue)
+    try:
+        fecha = request.args.get('fecha')
+        desde = request.args.get('desde')
+        hasta = request.args.get('hasta')
+        fecha = _leer_momento(fecha, fin_del_dia=True) if fecha else None
+        desde = _leer_momento(desde) if desde else None
+        hasta = _leer_momento(hasta, fin_del_dia=True) if hasta else None
+    except ValueError:
+        return jsonify({'error': 'Las fechas deben tener el formato aaaa-mm-dd o aaaa-mm-ddThh:mm'}), 400
+
+    historial = _obtener_historial()
+    if fecha is not None:
+        expediente = historial.estado_en(iue, fecha)
+        if expediente is None:
+            return jsonify({'error': 'No hay datos del expediente a esa fecha', 'expediente': iue}), 404
+        return jsonify(expediente)
+    return jsonify({'expediente': iue, 'cambios': historial.cambios(iue, desde, hasta)})
+
+_indice = None
+
+def _obtener_indice():
+    global _indice
+    if _indice is None:
+        _indice = IndiceBusqueda()
+    return _indice
+
+@app.route('/buscar', methods=['GET'])
+def buscar():
+    """
+    Busca en el índice local de expedientes ya consultados, sin consultar el servicio.
+    Parámetros: q (texto), en (expedientes, movimientos o ambos, por defecto),
+    desde/hasta (aaaa-mm-dd) o dias (últimos N días) para filtrar movimientos por fecha
+    y limite. Ej.: /buscar?q=daños  o  /buscar?en=movimientos&q=decreto&dias=7
+    """
+    texto = request.args.get('q', '').strip()
+    en = request.args.get('en', 'ambos')
+    if en not in ('expedientes', 'movimientos', 'ambos'):
+        return jsonify({'error': 'El parámetro "en" debe ser expedientes, movimientos o ambos'}), 400
+    limite = max(1, min(request.args.get('limite', SEARCH_MAX_RESULTS, type=int), SEARCH_MAX_RESULTS))
+    desde, hasta = request.args.get('desde'), request.args.get('hasta')
+    dias = request.args.get('dias', type=int)
+    try:
+        if dias is not None:
+            desde = (date.today() - timedelta(days=dias)).isoformat()
+        for fecha in (desde, hasta):
+            if fecha:
+                date.fromisoformat(fecha)
+    except ValueError:
+        return jsonify({'error': 'Las fechas deben tener el formato aaaa-mm-dd'}), 400
+    if not texto and not (desde or hasta):
+        return jsonify({'error': 'Debe indicar un texto (q) o un rango de fechas'}), 400
+
+    indice = _obtener_indice()
+    respuesta = {}
+    if en in ('expedientes', 'ambos') and texto:
+        respuesta['expedientes'] = indice.buscar_expedientes(texto, limite)
+    if en in ('movimientos', 'ambos'):
+        respuesta['movimientos'] = indice.buscar_movimientos(texto, desde, hasta, limite)
+    return jsonify(respuesta)
+
+@app.route('/importar-iues', methods=['POST'])
+def importar_iues():
+    """
+    Consulta los IUEs de un CSV o XLSX subido en el campo `archivo` y devuelve una fila
+    por IUE distinto, en el orden del archivo. La columna se elige con `columna` (nombre
+    o número) y el formato de salida con `formato` (csv, por defecto, o xlsx).
+    """
+    archivo = request.files.get('archivo')
+    if archivo is None or not archivo.filename:
+        return jsonify({'error': 'Debe enviar un archivo CSV o XLSX en el campo "archivo"'}), 400
+    formato = request.values.get('formato', 'csv').lower()
+    if formato not in ('csv', 'xlsx'):
+        return jsonify({'error': 'Formato de salida no válido'}), 400
+    columna = request.values.get('columna') or None
+    usar_cache = _usar_cache()
+    nombre = secure_filename(os.path.splitext(archivo.filename)[0]) or 'iues'
+
+    # La respuesta se genera después de cerrado el request: se copia la entrada a un
+    # temporal en disco para leerla de a poco mientras se envían los resultados
+    entrada = tempfile.TemporaryFile()
+    archivo.save(entrada)
+    entrada.seek(0)
+    # El archivo y su encabezado se leen ahora, para responder 400 si el XLSX está
+    # dañado o no existe la columna en lugar de cortar una respuesta ya empezada
+    try:
+        valores = leer_archivo(entrada, archivo.filename, columna)
+    except ValueError as ve:
+        entrada.close()
+        return jsonify({'error': str(ve)}), 400
+    filas = ImportadorIUEs().resolver(valores, usar_cache=usar_cache)
+
+    def generar_csv():
+        with entrada:
+            yield from csv_en_partes(filas)
+
+    def generar_xlsx():
+        # El XLSX es un zip y se arma completo en un temporal antes de enviarlo
+        with entrada, tempfile.TemporaryFile() as salida:
+            escribir_xlsx(filas, salida)
+            salida.seek(0)
+            while True:
+                parte = salida.read(64 * 1024)
+                if not parte:
+                    break
+                yield parte
+
+    if formato == 'csv':
+        respuesta = Response(generar_csv(), mimetype='text/csv; charset=utf-8')
+    else:
+        respuesta = Response(
+            generar_xlsx(), mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+    respuesta.headers['Content-Disposition'] = f'attachment; filename=resultados_{nombre}.{formato}'
+    return respuesta
+
+_cola_pdf = None
+_guardados = None
+
+def _obtener_guardados():
+    global _guardados
+    if _guardados is None:
+        _guardados = ResultadosGuardados()
+    return _guardados
+
+def _token_lote(token, sede, desde, hasta, anio):
+    """
+    Devuelve el token si corresponde a resultados guardados de exactamente ese rango
+    """
+    guardado = _obtener_guardados().obtener(token)
+    if not guardado or guardado.get('tipo') != 'lote':
+        return None
+    if (guardado.get('sede'), guardado.get('desde'), guardado.get('hasta'), guardado.get('anio')) != (sede, desde, hasta, anio):
+        return None
+    return token
+
+_plantilla_pdf = None
+
+def _html_pdf(**contexto):
+    """
+    Renderiza pdf_template.html. La plantilla compilada se reutiliza entre llamadas,
+    que son muchas porque los PDF se generan por partes.
+    """
+    global _plantilla_pdf
+    if _plantilla_pdf is None or app.jinja_env.auto_reload:
+        _plantilla_pdf = app.jinja_env.get_template('pdf_template.html')
+    app.update_template_context(contexto)
+    with metricas.medir('render'):
+        return _plantilla_pdf.render(contexto)
+
+def _html_pdf_individual(resultados, iue):
+    with app.app_context():
+        return _html_pdf(resultado=resultados[0], iue=iue, tipo="individual")
+
+def _html_pdf_lote(resultados, sede, desde, hasta, anio):
+    # Se llama desde el hilo trabajador, fuera de cualquier request
+    with app.app_context():
+        return _html_pdf(resultados=resultados, sede=sede, desde=desde, hasta=hasta, anio=anio, tipo="lote")
+
+def _leer_formato():
+    formato = request.values.get('formato', 'pdf').lower()
+    if formato not in RENDERIZADORES:
+        raise ValueError(f"Formato no válido. Opciones: {', '.join(RENDERIZADORES)}")
+    return formato
+
+def _obtener_cola_pdf():
+    global _cola_pdf
+    if _cola_pdf is None:
+        _cola_pdf = ColaTrabajosPDF(_html_pdf_lote, guardados=_obtener_guardados())
+    # Retoma trabajos pendientes aunque el proceso que los encoló ya no exista
+    _cola_pdf.iniciar()
+    return _cola_pdf
+
+def _describir_trabajo(trabajo):
+    datos = {
+        'id': trabajo['id'],
+        'estado': trabajo['estado'],
+        'total': trabajo['total'],
+        'completados': trabajo['completados'],
+        'progreso': round(trabajo['completados'] / trabajo['total'], 3) if trabajo['total'] else 1,
+        'error': trabajo['error']
+    }
+    if trabajo['estado'] == 'terminado':
+        datos['descarga'] = url_for('trabajo_descargar', id_trabajo=trabajo['id'])
+    return datos
+
+@app.route('/trabajos/pdf-lote', methods=['POST'])
+def trabajo_crear():
+    """
+    Encola la exportación a PDF de un rango. Acepta los mismos campos que /consultar-lote
+    y `formato` (pdf, por defecto, csv o json).
+    """
+    datos = request.get_json(silent=True) or request.form
+    if not hasattr(datos, 'get'):
+        return jsonify({'error': 'Se esperaba un objeto JSON'}), 400
+    try:
+        sede, desde, hasta, anio = _leer_rango_lote(datos)
+        formato = datos.get('formato', 'pdf')
+        if not isinstance(formato, str):
+            raise ValueError('El formato debe ser texto')
+        token = datos.get('token')
+        token = _token_lote(token if isinstance(token, str) else None, sede, desde, hasta, anio)
+        id_trabajo = _obtener_cola_pdf().encolar(sede, desde, hasta, anio, usar_cache=_usar_cache(), token=token,
+                                                 formato=formato)
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    response = jsonify({'id': id_trabajo, 'estado': url_for('trabajo_estado', id_trabajo=id_trabajo)})
+    response.status_code = 202
+    response.headers['Location'] = url_for('trabajo_estado', id_trabajo=id_trabajo)
+    return response
+
+@app.route('/trabajos/<id_trabajo>', methods=['GET'])
+def trabajo_estado(id_trabajo):
+    trabajo = _obtener_cola_pdf().estado(id_trabajo)
+    if trabajo is None:
+        return jsonify({'error': 'Trabajo inexistente o vencido'}), 404
+    return jsonify(_describir_trabajo(trabajo))
+
+@app.route('/trabajos/<id_trabajo>/descargar', methods=['GET'])
+def trabajo_descargar(id_trabajo):
+    trabajo = _obtener_cola_pdf().estado(id_trabajo)
+    if trabajo is None or trabajo['estado'] != 'terminado' or not os.path.exists(trabajo['archivo']):
+        return jsonify({'error': 'El archivo no está disponible'}), 404
+    renderizador = RENDERIZADORES[trabajo['formato']]
+    nombre = f"expedientes_{trabajo['sede']}_{trabajo['desde']}_a_{trabajo['hasta']}_{trabajo['anio']}.{renderizador.extension}"
+    return send_file(trabajo['archivo'], mimetype=renderizador.mimetype, as_attachment=True, download_name=nombre)
+
+@app.route('/descargar-pdf/<tipo>/<path:parametros>')
 def descargar_pdf(tipo, parametros):
+    """
+    Exporta un expediente o un rango. Con ?formato=csv o ?formato=json se usa ese
+    renderizador en lugar del PDF.
+    """
+    try:
+        formato = _leer_formato()
+    except ValueError as ve:
+        return str(ve), 400
     try:
         if tipo == 'individual':
             iue = parametros
-            cliente = ConsultaExpedientes()
-            resultado = cliente.consultar_expediente(iue)
-            html = render_template('pdf_template.html', resultado=resultado, iue=iue, tipo="individual")
+            guardado = _obtener_guardados().obtener(request.args.get('token'))
+            if guardado and guardado.get('tipo') == 'individual' and guardado.get('iue') == iue:
+                resultado = guardado['resultado']
+            else:
+                cliente = obtener_cliente()
+                resultado = cliente.consultar_expediente(iue, usar_cache=_usar_cache())
         elif tipo == 'lote':
             sede, desde, hasta, anio = parametros.split('-')
             desde = int(desde)
             hasta = int(hasta)
-            resultados = []
-            cliente = ConsultaExpedientes()
-            
-            with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                futures = {executor.submit(cliente.consultar_expediente, f"{sede}-{nro}/{anio}"): nro for nro in range(desde, hasta + 1)}
-                for future in concurrent.futures.as_completed(futures):
-                    try:
-                        resultado = future.result()
-                        if resultado:
-                            resultados.append(resultado)
-                    except Exception as e:
-                        nro = futures[future]
-                        iue = f"{sede}-{nro}/{anio}"
-                        resultados.append({
-                            'expediente': iue,
-                            'origen': 'Error',
-                            'caratula': f"Error: {str(e)}"
-                        })
-            
-            resultados.sort(key=lambda x: int(re.search(r'-\s*(\d+)\s*/', x['expediente']).group(1)))
-            html = render_template('pdf_template.html', resultados=resultados, sede=sede, desde=desde, hasta=hasta, anio=anio, tipo="lote")
+            if hasta - desde + 1 > BATCH_MAX_SIZE:
+                return f"Se pueden exportar como máximo {BATCH_MAX_SIZE} expedientes a la vez", 400
+            # Si el rango viene de una consulta recién hecha (?token=...) se reutilizan sus resultados
+            token = _token_lote(request.args.get('token'), sede, desde, hasta, anio)
+            # Los lotes se generan en segundo plano: se redirige al estado del trabajo
+            id_trabajo = _obtener_cola_pdf().encolar(sede, desde, hasta, anio, usar_cache=_usar_cache(), token=token,
+                                                     formato=formato)
+            return redirect(url_for('trabajo_estado', id_trabajo=id_trabajo))
         else:
             return "Tipo de descarga no válido", 400
         
-        # Crear PDF desde HTML
-        result = io.BytesIO()
-        pdf = pisa.pisaDocument(io.BytesIO(html.encode("UTF-8")), result)
-        
-        if not pdf.err:
-            response = make_response(result.getvalue())
-            response.headers['Content-Type'] = 'application/pdf'
-            if tipo == 'individual':
-                response.headers['Content-Disposition'] = f'attachment; filename=expediente_{iue.replace("/", "-").replace(" ", "")}.pdf'
-            else:
-                response.headers['Content-Disposition'] = f'attachment; filename=expedientes_{sede}_{desde}_a_{hasta}_{anio}.pdf'
-            return response
-        
-        return "Error al generar PDF", 500
-    
+        # El archivo se genera en un temporal (en memoria mientras es chico) y se envía
+        # por partes desde ahí, sin copiarlo entero a la respuesta
+        renderizador = obtener_renderizador(formato, _html_pdf_individual)
+        archivo = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        try:
+            with metricas.medir(renderizador.nombre):
+                renderizador.escribir([resultado], archivo, iue=iue)
+        except Exception:
+            archivo.close()
+            raise
+        archivo.seek(0)
+        nombre = f'expediente_{iue.replace("/", "-").replace(" ", "")}.{renderizador.extension}'
+        return send_file(archivo, mimetype=renderizador.mimetype, as_attachment=True, download_name=nombre)
+
     except Exception as e:
         logger.error(f"Error al generar PDF: {str(e)}")
         return f"Error: {str(e)}", 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Servidor de desarrollo; el modo debug se activa con FLASK_DEBUG=1.
+    # En producción: gunicorn main:app (toma la configuración de gunicorn.conf.py)
+    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,502 @@
+"""
+Prueba de carga de la aplicación contra el servidor SOAP local
+(servidor_stub.py), para detectar regresiones de rendimiento antes de un
+despliegue.
+
+Levanta el stub y la aplicación en procesos aparte (con bases y cachés en un
+directorio temporal) y, para cada escenario, envía peticiones desde varios
+hilos durante un tiempo fijo:
+
+    consultar       POST /consultar con un IUE distinto por petición
+    consultar-lote  POST /consultar-lote con rangos de --tamano-lote expedientes
+    descargar-pdf   GET /descargar-pdf/individual/<iue> (exportación síncrona)
+    api             GET /api/expedientes/<iue> (JSON, sin plantillas)
+
+Informa peticiones por segundo, latencias p50/p99 y el máximo de memoria
+residente (RSS) del proceso de la aplicación y sus hijos. Sólo las
+respuestas 200 cuentan para el rendimiento y las latencias: una respuesta
+de error suele ser mucho más rápida y no debe parecer una mejora. Un
+escenario con más de --max-errores de respuestas con error se marca como
+no válido y la ejecución termina con código 1.
+
+Con --json se guardan los resultados; con --comparar se comparan con una
+ejecución anterior y se termina con código 1 si alguna métrica empeoró más
+que --tolerancia o si aumentó la proporción de errores.
+
+Por defecto la aplicación corre en el servidor de desarrollo de Flask; con
+--comando se puede medir otra forma de servirla ({puerto} se reemplaza), p. ej.
+    --comando "gunicorn --bind 127.0.0.1:{puerto} main:app"
+La aplicación hereda el entorno, así que su configuración (BATCH_RATE_LIMIT,
+RESULT_CACHE_DB, etc.) se ajusta con las variables de siempre. Para comparar
+el servidor de desarrollo con gunicorn está bench_servidores.py.
+
+Uso:
+    python benchmarks/bench_carga.py [--escenarios consultar,consultar-lote,descargar-pdf,api]
+        [--concurrencia 8] [--duracion 20] [--latencia 0.3] [--movimientos 40]
+        [--max-errores 0.01] [--json resultados.json] [--comparar base.json]
+"""
+import argparse
+import http.client
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+DIRECTORIO_BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+DIRECTORIO_APP = os.path.dirname(DIRECTORIO_BENCHMARKS)
+
+sys.path.insert(0, DIRECTORIO_BENCHMARKS)
+
+from servidor_stub import agregar_argumentos
+
+COMANDO_DESARROLLO = (f"{shlex.quote(sys.executable)} -c "
+                      "\"from app import app; app.run(host='127.0.0.1', port={puerto}, threaded=True)\"")
+
+ESCENARIOS = ('consultar', 'consultar-lote', 'descargar-pdf', 'api')
+
+# Variables de entorno de las bases y cachés de la aplicación, que se llevan a un directorio temporal
+ARCHIVOS_APP = {
+    'WSDL_CACHE_PATH': 'wsConsultaIUE.wsdl',
+    'RESULT_SNAPSHOT_DB': 'resultados_guardados.db',
+    'PDF_JOBS_DB': 'trabajos_pdf.db',
+    'PDF_JOBS_DIR': 'trabajos_pdf',
+    'SEARCH_INDEX_DB': 'indice_busqueda.db',
+    'WATCHLIST_DB': 'seguimiento.db',
+    'RANGE_INDEX_DB': 'escaneo_rangos.db',
+}
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def esperar_puerto(puerto, proceso, espera=30):
+    limite = time.monotonic() + espera
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise RuntimeError(f"El proceso terminó al arrancar (código {proceso.returncode})")
+        try:
+            socket.create_connection(('127.0.0.1', puerto), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nada escucha en el puerto {puerto} después de {espera} s")
+
+
+def rss_arbol(pid):
+    """
+    Memoria residente (bytes) de un proceso y sus descendientes, leída de /proc.
+    Devuelve None fuera de Linux.
+    """
+    hijos = {}
+    try:
+        entradas = os.listdir('/proc')
+    except OSError:
+        return None
+    for entrada in entradas:
+        if not entrada.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entrada}/stat') as archivo:
+                # El nombre del proceso va entre paréntesis y puede tener espacios
+                padre = int(archivo.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        hijos.setdefault(padre, []).append(int(entrada))
+
+    total, pendientes = 0, [pid]
+    while pendientes:
+        actual = pendientes.pop()
+        try:
+            with open(f'/proc/{actual}/status') as archivo:
+                for linea in archivo:
+                    if linea.startswith('VmRSS:'):
+                        total += int(linea.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+        pendientes.extend(hijos.get(actual, ()))
+    return total
+
+
+class MonitorMemoria:
+    """
+    Muestrea el RSS del árbol de procesos de la aplicación y guarda el máximo
+    """
+    def __init__(self, pid, intervalo=0.1):
+        self.pid = pid
+        self.intervalo = intervalo
+        self.maximo = None
+        self._fin = threading.Event()
+        self._hilo = threading.Thread(target=self._muestrear, daemon=True)
+
+    def __enter__(self):
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._fin.set()
+        self._hilo.join()
+
+    def _muestrear(self):
+        while True:
+            rss = rss_arbol(self.pid)
+            if rss is not None:
+                self.maximo = max(self.maximo or 0, rss)
+            if self._fin.wait(self.intervalo):
+                return
+
+
+class Conexion:
+    """
+    Conexión HTTP persistente de un hilo; se reabre si el servidor la cierra
+    """
+    def __init__(self, puerto, timeout=120):
+        self.puerto = puerto
+        self.timeout = timeout
+        self._conexion = None
+
+    def pedir(self, metodo, ruta, formulario=None):
+        cuerpo = urllib.parse.urlencode(formulario).encode() if formulario is not None else None
+        cabeceras = {'Content-Type': 'application/x-www-form-urlencoded'} if cuerpo is not None else {}
+        for intento in range(2):
+            if self._conexion is None:
+                self._conexion = http.client.HTTPConnection('127.0.0.1', self.puerto, timeout=self.timeout)
+            try:
+                self._conexion.request(metodo, ruta, body=cuerpo, headers=cabeceras)
+                respuesta = self._conexion.getresponse()
+                respuesta.read()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                # Conexión reutilizada que el servidor ya había cerrado
+                self.cerrar()
+                if intento:
+                    raise
+                continue
+            if respuesta.will_close:
+                self.cerrar()
+            return respuesta.status
+
+    def cerrar(self):
+        if self._conexion is not None:
+            self._conexion.close()
+            self._conexion = None
+
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(p * len(ordenados)))]
+
+
+class Numerador:
+    """
+    Reparte números de expediente entre los hilos y escenarios. Sin --iues-distintos
+    nunca se repite un número, así ninguna petición se responde desde la caché.
+    """
+    def __init__(self, distintos=0):
+        self.distintos = distintos
+        self._siguiente = 1
+        self._lock = threading.Lock()
+
+    def reservar(self, cantidad=1):
+        """
+        Returns:
+            int: Primer número de un bloque de `cantidad` números consecutivos
+        """
+        with self._lock:
+            primero = self._siguiente
+            self._siguiente += cantidad
+        if self.distintos:
+            primero = (primero - 1) % max(1, self.distintos - cantidad + 1) + 1
+        return primero
+
+
+def crear_peticiones(escenario, args, numerador):
+    """
+    Returns:
+        callable: Recibe una Conexion y devuelve el código HTTP de una petición del escenario
+    """
+    siguiente = numerador.reservar
+
+    if escenario == 'consultar':
+        return lambda conexion: conexion.pedir('POST', '/consultar', {'iue': f"{args.sede}-{siguiente()}/{args.anio}"})
+    if escenario == 'consultar-lote':
+        def lote(conexion):
+            desde = siguiente(args.tamano_lote)
+            return conexion.pedir('POST', '/consultar-lote', {
+                'sede': args.sede, 'desde': desde, 'hasta': desde + args.tamano_lote - 1, 'anio': args.anio
+            })
+        return lote
+    if escenario == 'descargar-pdf':
+        return lambda conexion: conexion.pedir(
+            'GET', f"/descargar-pdf/individual/{args.sede}-{siguiente()}/{args.anio}?formato={args.formato}"
+        )
+    if escenario == 'api':
+        return lambda conexion: conexion.pedir('GET', f"/api/expedientes/{args.sede}-{siguiente()}/{args.anio}")
+    raise ValueError(f"Escenario desconocido: {escenario}")
+
+
+def ejecutar_escenario(escenario, args, puerto, pid, numerador):
+    peticion = crear_peticiones(escenario, args, numerador)
+    # Latencias de las respuestas 200; los errores sólo se cuentan
+    latencias, errores, codigos = [], [0], {}
+    lock = threading.Lock()
+    fin = [0.0]
+
+    def trabajador(hasta):
+        conexion = Conexion(puerto)
+        try:
+            while time.monotonic() < hasta:
+                inicio = time.perf_counter()
+                try:
+                    codigo = peticion(conexion)
+                except (OSError, http.client.HTTPException):
+                    codigo = None
+                duracion = time.perf_counter() - inicio
+                with lock:
+                    if time.monotonic() <= fin[0]:
+                        codigos[codigo] = codigos.get(codigo, 0) + 1
+                        if codigo == 200:
+                            latencias.append(duracion)
+                        else:
+                            errores[0] += 1
+        finally:
+            conexion.cerrar()
+
+    # Calentamiento: se arranca el cliente SOAP y se cargan plantillas antes de medir
+    calentamiento = Conexion(puerto)
+    for _ in range(2):
+        try:
+            peticion(calentamiento)
+        except (OSError, http.client.HTTPException):
+            pass
+    calentamiento.cerrar()
+
+    with MonitorMemoria(pid) as memoria:
+        inicio = time.monotonic()
+        fin[0] = inicio + args.duracion
+        hilos = [threading.Thread(target=trabajador, args=(fin[0],)) for _ in range(args.concurrencia)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        transcurrido = time.monotonic() - inicio
+
+    peticiones = len(latencias) + errores[0]
+    tasa_errores = errores[0] / peticiones if peticiones else 1.0
+    return {
+        'escenario': escenario,
+        'peticiones': peticiones,
+        'errores': errores[0],
+        'tasa_errores': tasa_errores,
+        'valido': peticiones > 0 and tasa_errores <= args.max_errores,
+        'codigos': {str(codigo): cantidad for codigo, cantidad in codigos.items()},
+        # Respuestas correctas por segundo
+        'por_segundo': len(latencias) / transcurrido,
+        'p50_ms': percentil(latencias, 0.5) * 1000 if latencias else None,
+        'p99_ms': percentil(latencias, 0.99) * 1000 if latencias else None,
+        'rss_max_mib': memoria.maximo / (1024 * 1024) if memoria.maximo else None,
+    }
+
+
+def formatear(valor, formato):
+    return format(valor, formato) if valor is not None else '-'
+
+
+def imprimir(resultados):
+    print(f"{'escenario':<16} {'peticiones':>10} {'errores':>8} {'pet/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'RSS MiB':>8}")
+    for r in resultados:
+        print(f"{r['escenario']:<16} {r['peticiones']:>10} {r['errores']:>8} {r['por_segundo']:>8.1f} "
+              f"{formatear(r['p50_ms'], '9.0f')} {formatear(r['p99_ms'], '9.0f')} {formatear(r['rss_max_mib'], '8.0f')}"
+              f"{'' if r['valido'] else '  NO VÁLIDO'}")
+        if r['errores']:
+            print(f"{'':<16} códigos: {r['codigos']}")
+
+
+def invalidos(resultados):
+    """
+    Returns:
+        list: Escenarios con más errores que los admitidos, cuyas métricas no sirven
+    """
+    return [f"{r['escenario']}: {r['errores']} errores en {r['peticiones']} peticiones ({r['tasa_errores']:.0%})"
+            for r in resultados if not r['valido']]
+
+
+def comparar(resultados, base, tolerancia):
+    """
+    Returns:
+        list: Descripción de las métricas que empeoraron más que la tolerancia
+    """
+    anteriores = {r['escenario']: r for r in base}
+    regresiones = []
+    for r in resultados:
+        anterior = anteriores.get(r['escenario'])
+        if anterior is None:
+            continue
+        # Más errores es una regresión aunque el resto de las métricas mejore
+        previo = _tasa_errores(anterior)
+        print(f"{r['escenario']:<16} {'errores':<12} {previo:10.1%} -> {r['tasa_errores']:10.1%}")
+        if r['errores'] and r['tasa_errores'] > previo:
+            regresiones.append(f"{r['escenario']} errores: {previo:.1%} -> {r['tasa_errores']:.1%}")
+        # (métrica, si más es mejor)
+        for metrica, mas_es_mejor in (('por_segundo', True), ('p50_ms', False), ('p99_ms', False), ('rss_max_mib', False)):
+            actual, previo = r.get(metrica), anterior.get(metrica)
+            # Sin respuestas correctas no hay latencias; la caída de pet/s ya lo refleja
+            if actual is None or not previo:
+                continue
+            cambio = (actual - previo) / previo
+            print(f"{r['escenario']:<16} {metrica:<12} {previo:10.1f} -> {actual:10.1f} ({cambio:+.0%})")
+            if (-cambio if mas_es_mejor else cambio) > tolerancia:
+                regresiones.append(f"{r['escenario']} {metrica}: {previo:.1f} -> {actual:.1f}")
+    return regresiones
+
+
+def _tasa_errores(resultado):
+    if 'tasa_errores' in resultado:
+        return resultado['tasa_errores']
+    # Resultados guardados antes de que se registrara la proporción
+    return resultado['errores'] / resultado['peticiones'] if resultado.get('peticiones') else 0.0
+
+
+def agregar_argumentos_carga(parser):
+    """
+    Opciones de la carga y del stub, compartidas con bench_servidores.py
+    """
+    parser.add_argument('--escenarios', default=','.join(ESCENARIOS))
+    parser.add_argument('--concurrencia', type=int, default=8, help='hilos que envían peticiones')
+    parser.add_argument('--duracion', type=float, default=20, help='segundos de medición por escenario')
+    parser.add_argument('--tamano-lote', type=int, default=20, help='expedientes por consulta en lote')
+    parser.add_argument('--formato', default='pdf', help='formato de descargar-pdf (pdf, csv, json)')
+    parser.add_argument('--sede', default='2')
+    parser.add_argument('--anio', default='2024')
+    parser.add_argument('--max-errores', type=float, default=0.01,
+                        help='proporción de respuestas con error por encima de la cual un escenario no es válido')
+    parser.add_argument('--iues-distintos', type=int, default=0,
+                        help='repetir un conjunto de N IUEs (para medir con caché); 0 = siempre distintos')
+    agregar_argumentos(parser)
+
+
+def leer_escenarios(parser, args):
+    escenarios = [e.strip() for e in args.escenarios.split(',') if e.strip()]
+    for escenario in escenarios:
+        if escenario not in ESCENARIOS:
+            parser.error(f"Escenario desconocido: {escenario}")
+    return escenarios
+
+
+def esperar_listo(puerto, proceso, espera=60):
+    """
+    Espera a que la aplicación responda /readyz (con gunicorn el puerto se abre
+    antes de que los workers estén listos)
+    """
+    esperar_puerto(puerto, proceso, espera)
+    limite = time.monotonic() + espera
+    conexion = Conexion(puerto, timeout=espera)
+    try:
+        while time.monotonic() < limite:
+            if proceso.poll() is not None:
+                raise RuntimeError(f"El proceso terminó al arrancar (código {proceso.returncode})")
+            try:
+                if conexion.pedir('GET', '/readyz') == 200:
+                    return
+            except (OSError, http.client.HTTPException):
+                pass
+            time.sleep(0.2)
+    finally:
+        conexion.cerrar()
+    raise RuntimeError(f"La aplicación no quedó lista después de {espera} s")
+
+
+def medir(args, escenarios, comando, entorno=None):
+    """
+    Levanta el stub y la aplicación con `comando` y ejecuta los escenarios
+    Args:
+        entorno (dict): Variables de entorno adicionales para la aplicación
+    Returns:
+        list: Resultados de ejecutar_escenario()
+    """
+    procesos = []
+    with tempfile.TemporaryDirectory() as directorio:
+        try:
+            puerto_stub = puerto_libre()
+            opciones_stub = ['--puerto', str(puerto_stub), '--latencia', str(args.latencia),
+                             '--variacion', str(args.variacion), '--tasa-errores', str(args.tasa_errores),
+                             '--tasa-faults', str(args.tasa_faults), '--movimientos', str(args.movimientos)]
+            if args.max_numero is not None:
+                opciones_stub += ['--max-numero', str(args.max_numero)]
+            if args.reproducir:
+                opciones_stub += ['--reproducir', os.path.abspath(args.reproducir)]
+            stub = subprocess.Popen([sys.executable, os.path.join(DIRECTORIO_BENCHMARKS, 'servidor_stub.py'),
+                                     *opciones_stub], stdout=subprocess.DEVNULL)
+            procesos.append(stub)
+            esperar_puerto(puerto_stub, stub)
+
+            variables = dict(os.environ)
+            variables['SOAP_WSDL_URL'] = f"http://127.0.0.1:{puerto_stub}/wsConsultaIUE.php?wsdl"
+            variables.setdefault('LOG_LEVEL', 'WARNING')
+            for variable, nombre in ARCHIVOS_APP.items():
+                variables[variable] = os.path.join(directorio, nombre)
+            variables.update(entorno or {})
+
+            puerto = puerto_libre()
+            aplicacion = subprocess.Popen(shlex.split(comando.format(puerto=puerto)), cwd=DIRECTORIO_APP,
+                                          env=variables, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            procesos.append(aplicacion)
+            esperar_listo(puerto, aplicacion)
+
+            numerador = Numerador(args.iues_distintos)
+            return [ejecutar_escenario(escenario, args, puerto, aplicacion.pid, numerador)
+                    for escenario in escenarios]
+        finally:
+            for proceso in reversed(procesos):
+                proceso.terminate()
+                try:
+                    proceso.wait(10)
+                except subprocess.TimeoutExpired:
+                    proceso.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    agregar_argumentos_carga(parser)
+    parser.add_argument('--comando', default=COMANDO_DESARROLLO,
+                        help='comando que levanta la aplicación; {puerto} se reemplaza')
+    parser.add_argument('--json', metavar='RUTA', help='guardar los resultados')
+    parser.add_argument('--comparar', metavar='RUTA', help='resultados de una ejecución anterior')
+    parser.add_argument('--tolerancia', type=float, default=0.2, help='empeoramiento admitido al comparar (fracción)')
+    args = parser.parse_args()
+    escenarios = leer_escenarios(parser, args)
+
+    print(f"{args.concurrencia} hilos x {args.duracion:g} s por escenario, latencia SOAP "
+          f"{args.latencia:g}±{args.variacion:g} s, {args.movimientos} movimientos")
+    resultados = medir(args, escenarios, args.comando)
+
+    imprimir(resultados)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as archivo:
+            json.dump(resultados, archivo, indent=2)
+    codigo = 0
+    no_validos = invalidos(resultados)
+    if no_validos:
+        print("Escenarios no válidos (demasiados errores):\n  " + "\n  ".join(no_validos))
+        codigo = 1
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as archivo:
+            regresiones = comparar(resultados, json.load(archivo), args.tolerancia)
+        if regresiones:
+            print("Regresiones:\n  " + "\n  ".join(regresiones))
+            codigo = 1
+    return codigo
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""
+Micro-benchmark del procesamiento de respuestas de consultaIUE
+(ConsultaExpedientes._procesar_respuesta) sobre respuestas sintéticas de
+10, 100 y 1000 movimientos, construidas con los tipos del WSDL de fixtures.
+
+Uso:
+    python benchmarks/bench_parser.py [--repeticiones 200]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from soap_client import ConsultaExpedientes
+
+FIXTURE_WSDL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'wsConsultaIUE.wsdl')
+
+
+def respuesta_sintetica(cliente, cantidad):
+    Resultado = cliente.client.get_type('ns0:resultado')
+    Movimiento = cliente.client.get_type('ns0:movimiento')
+    movimientos = [
+        Movimiento(
+            fecha=f"{(i % 28) + 1:02d}/{(i % 12) + 1:02d}/2024",
+            tipo='Decreto' if i % 3 else 'Escrito',
+            decreto=f"https://www.poderjudicial.gub.uy/decretos/{i}.pdf" if i % 4 == 0 else str(i),
+            vencimiento='',
+            sede='Juzgado Letrado de Primera Instancia'
+        )
+        for i in range(cantidad)
+    ]
+    return Resultado(
+        estado='ok',
+        expediente='2-1234/2024',
+        caratula='AA c/ BB - Daños y perjuicios',
+        origen='Juzgado Letrado de Primera Instancia en lo Civil de 2º Turno',
+        abogado_actor='',
+        abogado_demandado='',
+        movimientos=movimientos
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeticiones', type=int, default=200)
+    args = parser.parse_args()
+
+    cliente = ConsultaExpedientes(wsdl=FIXTURE_WSDL)
+    for cantidad in (10, 100, 1000):
+        response = respuesta_sintetica(cliente, cantidad)
+        repeticiones = max(1, args.repeticiones * 10 // cantidad)
+        total = timeit.timeit(lambda: cliente._procesar_respuesta('2-1234/2024', response), number=repeticiones)
+        por_llamada = total / repeticiones
+        print(f"{cantidad:>5} movimientos: {por_llamada * 1e6:10.1f} µs/respuesta  "
+              f"{por_llamada / cantidad * 1e6:6.2f} µs/movimiento")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Compara el rendimiento de los renderizadores de exportación (renderizadores.py)
+sobre un lote sintético: PDF del lote completo en una sola conversión, PDF por
+partes (en el hilo actual y en un pool de procesos), CSV y JSON.
+
+Usa templates/pdf_template.html si existe; si no, una plantilla mínima
+equivalente.
+
+Uso:
+    python benchmarks/bench_renderizadores.py [--expedientes 50] [--movimientos 40] [--procesos 4]
+        [--partes 1,5,10,20]
+"""
+import argparse
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jinja2 import Environment, FileSystemLoader, DictLoader
+
+from renderizadores import PDF_CHUNK_SIZE, RenderizadorPDF, RenderizadorCSV, RenderizadorJSON
+
+DIRECTORIO_PLANTILLAS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+
+PLANTILLA_MINIMA = """<html><head><style>
+table { width: 100%; } td { border: 1px solid #999; padding: 2px; font-size: 9px; }
+</style></head><body>
+{% for r in resultados %}
+<h2>{{ r.expediente }}</h2><p>{{ r.caratula }}<br>{{ r.origen }}</p>
+<table>{% for m in r.movimientos %}<tr><td>{{ m.fecha }}</td><td>{{ m.tipo }}</td><td>{{ m.decreto }}</td><td>{{ m.sede }}</td></tr>{% endfor %}</table>
+<pdf:nextpage />
+{% endfor %}
+</body></html>"""
+
+
+def resultados_sinteticos(expedientes, movimientos):
+    return [
+        {
+            'expediente': f"2-{n}/2024",
+            'caratula': f"AA c/ BB {n} - Daños y perjuicios",
+            'origen': 'Juzgado Letrado de Primera Instancia en lo Civil de 2º Turno',
+            'primer_movimiento': 'No disponible',
+            'urls_movimientos': [],
+            'movimientos': [
+                {
+                    'fecha': f"{(i % 28) + 1:02d}/{(i % 12) + 1:02d}/2024",
+                    'tipo': 'Decreto' if i % 3 else 'Escrito',
+                    'decreto': f"https://www.poderjudicial.gub.uy/decretos/{i}.pdf" if i % 4 == 0 else str(i),
+                    'vencimiento': '',
+                    'sede': 'Juzgado Letrado de Primera Instancia',
+                    'enlaces': []
+                }
+                for i in range(movimientos)
+            ]
+        }
+        for n in range(1, expedientes + 1)
+    ]
+
+
+def crear_renderizar_html():
+    if os.path.exists(os.path.join(DIRECTORIO_PLANTILLAS, 'pdf_template.html')):
+        entorno = Environment(loader=FileSystemLoader(DIRECTORIO_PLANTILLAS))
+    else:
+        entorno = Environment(loader=DictLoader({'pdf_template.html': PLANTILLA_MINIMA}))
+    plantilla = entorno.get_template('pdf_template.html')
+
+    def renderizar_html(resultados, **contexto):
+        return plantilla.render(resultados=resultados, tipo='lote', **contexto)
+    return renderizar_html
+
+
+def contar_paginas(contenido):
+    from pypdf import PdfReader
+    return len(PdfReader(io.BytesIO(contenido)).pages)
+
+
+def medir(nombre, renderizador, resultados):
+    destino = io.BytesIO()
+    inicio = time.perf_counter()
+    renderizador.escribir(resultados, destino, sede='2', desde=1, hasta=len(resultados), anio='2024')
+    duracion = time.perf_counter() - inicio
+    contenido = destino.getvalue()
+    linea = (f"{nombre:<24} {duracion:8.2f} s  {len(resultados) / duracion:9.1f} expedientes/s  "
+             f"{len(contenido) / 1024:9.0f} KiB")
+    if renderizador.nombre == 'pdf':
+        linea += f"  {contar_paginas(contenido) / duracion:7.1f} páginas/s"
+    print(linea)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--expedientes', type=int, default=50)
+    parser.add_argument('--movimientos', type=int, default=40)
+    parser.add_argument('--procesos', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--partes', default=f'1,{PDF_CHUNK_SIZE}',
+                        help='expedientes por parte a comparar, separados por comas (1,10)')
+    args = parser.parse_args()
+
+    resultados = resultados_sinteticos(args.expedientes, args.movimientos)
+    renderizar_html = crear_renderizar_html()
+    print(f"{args.expedientes} expedientes x {args.movimientos} movimientos")
+
+    medir('pdf lote completo', RenderizadorPDF(renderizar_html, expedientes_por_parte=len(resultados)), resultados)
+    for tamano in sorted({int(valor) for valor in args.partes.split(',') if valor.strip()}):
+        medir(f'pdf de a {tamano}', RenderizadorPDF(renderizar_html, expedientes_por_parte=tamano), resultados)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.procesos, mp_context=multiprocessing.get_context('spawn')
+    ) as pool:
+        # Se arrancan los procesos antes de medir
+        list(pool.map(abs, range(args.procesos)))
+        medir(f'pdf pool ({args.procesos} procesos)',
+              RenderizadorPDF(renderizar_html, ejecutor=pool, en_vuelo=2 * args.procesos),
+              resultados)
+    medir('csv', RenderizadorCSV(), resultados)
+    medir('json', RenderizadorJSON(), resultados)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Compara la forma actual de servir la aplicación (servidor de desarrollo de
+Flask) con gunicorn configurado por gunicorn.conf.py, con la misma carga de
+bench_carga.py contra el servidor SOAP local.
+
+Los servidores medidos se eligen con --servidores:
+    desarrollo       app.run() con hilos, como main.py (sin debug)
+    gunicorn         gunicorn.conf.py: app precargada y workers gthread
+    gunicorn-gevent  lo mismo con workers gevent (si gevent está instalado)
+
+Uso:
+    python benchmarks/bench_servidores.py [--servidores desarrollo,gunicorn] [--workers 4]
+        [--concurrencia 32] [--duracion 20] [--escenarios consultar,descargar-pdf]
+
+Sólo se deben comparar mediciones sin errores: un escenario con más de
+--max-errores de respuestas con error se marca como no válido y el script
+termina con código 1.
+"""
+import argparse
+import importlib.util
+import os
+import shlex
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_carga import COMANDO_DESARROLLO, agregar_argumentos_carga, formatear, invalidos, leer_escenarios, medir
+
+COMANDO_GUNICORN = (f"{shlex.quote(sys.executable)} -m gunicorn --config gunicorn.conf.py "
+                    "--bind 127.0.0.1:{puerto} main:app")
+
+SERVIDORES = {
+    'desarrollo': (COMANDO_DESARROLLO, {}),
+    'gunicorn': (COMANDO_GUNICORN, {'GUNICORN_WORKER_CLASS': 'gthread'}),
+    'gunicorn-gevent': (COMANDO_GUNICORN, {'GUNICORN_WORKER_CLASS': 'gevent'}),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servidores', default='desarrollo,gunicorn')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='workers de gunicorn')
+    agregar_argumentos_carga(parser)
+    parser.set_defaults(concurrencia=32)
+    args = parser.parse_args()
+    escenarios = leer_escenarios(parser, args)
+
+    servidores = [s.strip() for s in args.servidores.split(',') if s.strip()]
+    for servidor in servidores:
+        if servidor not in SERVIDORES:
+            parser.error(f"Servidor desconocido: {servidor}")
+        if servidor == 'gunicorn-gevent' and importlib.util.find_spec('gevent') is None:
+            parser.error("gunicorn-gevent requiere instalar gevent")
+
+    print(f"{args.concurrencia} hilos x {args.duracion:g} s por escenario, latencia SOAP "
+          f"{args.latencia:g}±{args.variacion:g} s, {args.movimientos} movimientos, {args.workers} workers")
+    resultados = {}
+    for servidor in servidores:
+        comando, entorno = SERVIDORES[servidor]
+        print(f"Midiendo {servidor}...", flush=True)
+        resultados[servidor] = {r['escenario']: r for r in medir(
+            args, escenarios, comando, {**entorno, 'GUNICORN_WORKERS': str(args.workers)}
+        )}
+
+    print(f"{'escenario':<16} {'servidor':<16} {'pet/s':>8} {'x':>6} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'errores':>8} {'RSS MiB':>8}")
+    for escenario in escenarios:
+        base = resultados[servidores[0]][escenario]['por_segundo']
+        for servidor in servidores:
+            r = resultados[servidor][escenario]
+            relacion = r['por_segundo'] / base if base else None
+            print(f"{escenario:<16} {servidor:<16} {r['por_segundo']:>8.1f} {formatear(relacion, '6.2f')} "
+                  f"{formatear(r['p50_ms'], '9.0f')} {formatear(r['p99_ms'], '9.0f')} {r['errores']:>8} "
+                  f"{formatear(r['rss_max_mib'], '8.0f')}{'' if r['valido'] else '  NO VÁLIDO'}")
+
+    # Con errores las cifras no comparan servidores sino respuestas de error
+    no_validos = [f"{servidor} {motivo}" for servidor in servidores
+                  for motivo in invalidos(resultados[servidor].values())]
+    if no_validos:
+        print("Mediciones no válidas (demasiados errores):\n  " + "\n  ".join(no_validos))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Compara el tiempo de arranque del cliente SOAP en frío (descarga y parseo del
+WSDL) contra el arranque con la copia local del WSDL ya en caché.
+
+El WSDL se sirve desde un servidor HTTP local con el fixture de
+benchmarks/fixtures, con una latencia simulada configurable.
+
+Uso:
+    python benchmarks/bench_wsdl_startup.py [--repeticiones 20] [--latencia 0.2]
+"""
+import argparse
+import http.server
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from soap_client import ConsultaExpedientes
+
+FIXTURE_WSDL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'wsConsultaIUE.wsdl')
+
+
+def servir_wsdl(latencia):
+    with open(FIXTURE_WSDL, 'rb') as f:
+        contenido = f.read()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latencia)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(contenido)))
+            self.end_headers()
+            self.wfile.write(contenido)
+
+        def log_message(self, *args):
+            pass
+
+    servidor = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return tiempos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeticiones', type=int, default=20)
+    parser.add_argument('--latencia', type=float, default=0.2, help='latencia simulada del WSDL remoto (segundos)')
+    args = parser.parse_args()
+
+    servidor = servir_wsdl(args.latencia)
+    url = f"http://127.0.0.1:{servidor.server_address[1]}/wsConsultaIUE.php?wsdl"
+
+    with tempfile.TemporaryDirectory() as directorio:
+        cache = os.path.join(directorio, 'wsConsultaIUE.wsdl')
+
+        def arranque_frio():
+            if os.path.exists(cache):
+                os.remove(cache)
+            ConsultaExpedientes(wsdl=url, cache_wsdl=cache)
+
+        frio = medir(arranque_frio, args.repeticiones)
+
+        # Con la caché poblada el arranque no debe tocar la red: se apaga el servidor
+        ConsultaExpedientes(wsdl=url, cache_wsdl=cache)
+        servidor.shutdown()
+        caliente = medir(lambda: ConsultaExpedientes(wsdl=url, cache_wsdl=cache), args.repeticiones)
+
+    for nombre, tiempos in (('frío', frio), ('caché', caliente)):
+        print(f"{nombre:>6}: mediana {statistics.median(tiempos) * 1000:8.1f} ms  "
+              f"min {min(tiempos) * 1000:8.1f} ms  max {max(tiempos) * 1000:8.1f} ms")
+    print(f"aceleración: x{statistics.median(frio) / statistics.median(caliente):.1f}")
+
+
+if __name__ == '__main__':
+    main()
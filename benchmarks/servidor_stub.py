@@ -0,0 +1,278 @@
+"""
+Servidor SOAP local que imita a wsConsultaIUE, para pruebas de carga sin
+tocar el servicio del Poder Judicial.
+
+Sirve el WSDL de fixtures/ (con la dirección apuntando al propio servidor) y
+responde consultaIUE con expedientes sintéticos: los mismos datos para el
+mismo IUE, con latencia, tasa de errores y cantidad de movimientos
+configurables. Los números de expediente mayores que --max-numero se
+responden como inexistentes.
+
+Con --grabar las consultas se reenvían al servicio real (o a --upstream) y
+cada respuesta se guarda en el directorio indicado; con --reproducir se
+sirven las respuestas guardadas (los IUEs sin grabación se responden con
+datos sintéticos).
+
+Para que la aplicación lo use:
+    SOAP_WSDL_URL=http://127.0.0.1:8089/wsConsultaIUE.php?wsdl python main.py
+
+Uso:
+    python benchmarks/servidor_stub.py [--puerto 8089] [--latencia 0.3] [--variacion 0.1]
+        [--tasa-errores 0.02] [--tasa-faults 0.01] [--movimientos 40] [--max-numero 500]
+        [--grabar DIR [--upstream URL] | --reproducir DIR]
+"""
+import argparse
+import http.server
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from xml.sax.saxutils import escape
+
+DIRECTORIO_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Dirección del servicio en el WSDL publicado
+DIRECCION_SERVICIO = 'http://www.expedientes.poderjudicial.gub.uy/wsConsultaIUE.php'
+
+SOBRE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+    '<SOAP-ENV:Body>{}</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+)
+RESPUESTA = '<ns1:consultaIUEResponse xmlns:ns1="urn:wsConsultaIUE">{}</ns1:consultaIUEResponse>'
+FAULT = ('<SOAP-ENV:Fault><faultcode>SOAP-ENV:Server</faultcode>'
+         '<faultstring>Error simulado del servicio</faultstring></SOAP-ENV:Fault>')
+
+TIPOS = ('Decreto', 'Escrito', 'Notificación', 'Audiencia', 'Pase a despacho', 'Sentencia')
+SEDES = ('Juzgado Letrado de Primera Instancia en lo Civil de {}º Turno',
+         'Juzgado de Paz Departamental de la Capital de {}º Turno')
+
+PATRON_IUE = re.compile(rb'<iue[^>]*>([^<]*)</iue>')
+
+
+def clave_grabacion(iue):
+    """
+    Nombre de archivo de la respuesta grabada de un IUE
+    """
+    return re.sub(r'[^0-9A-Za-z]+', '_', iue.strip()) + '.xml'
+
+
+def respuesta_sintetica(iue, movimientos, max_numero=None):
+    """
+    Arma la respuesta SOAP de un IUE. El contenido depende sólo del IUE, así las
+    consultas repetidas devuelven lo mismo (y las ETags y la caché se comportan
+    como con el servicio real).
+    """
+    coincidencia = re.match(r'^\s*(\d+)\s*-\s*(\d+)\s*/\s*(\d{4})\s*$', iue)
+    if not coincidencia or (max_numero is not None and int(coincidencia.group(2)) > max_numero):
+        return SOBRE.format(RESPUESTA.format('<return xsi:nil="true"/>')).encode('utf-8')
+
+    sede, numero, anio = coincidencia.groups()
+    azar = random.Random(iue)
+    filas = []
+    for i in range(movimientos):
+        dia = 1 + (i * 7) % 28
+        mes = 12 - (i // 4) % 12
+        decreto = (f"https://www.poderjudicial.gub.uy/decretos/{sede}-{numero}-{i}.pdf"
+                   if azar.random() < 0.3 else str(azar.randint(100, 9999)))
+        filas.append(
+            '<movimientos>'
+            f'<fecha>{dia:02d}/{mes:02d}/{anio}</fecha>'
+            f'<tipo>{escape(azar.choice(TIPOS))}</tipo>'
+            f'<decreto>{escape(decreto)}</decreto>'
+            '<vencimiento></vencimiento>'
+            f'<sede>{escape(azar.choice(SEDES).format(sede))}</sede>'
+            '</movimientos>'
+        )
+    expediente = (
+        '<return>'
+        '<estado>ok</estado>'
+        f'<expediente>{escape(f"{sede}-{numero}/{anio}")}</expediente>'
+        f'<caratula>{escape(f"ACTOR {numero} c/ DEMANDADO {azar.randint(1, 999)} - Daños y perjuicios")}</caratula>'
+        f'<origen>{escape(SEDES[0].format(sede))}</origen>'
+        '<abogado_actor></abogado_actor><abogado_demandado></abogado_demandado>'
+        f'{"".join(filas)}'
+        '</return>'
+    )
+    return SOBRE.format(RESPUESTA.format(expediente)).encode('utf-8')
+
+
+class ServidorStub:
+    def __init__(self, puerto=0, latencia=0.0, variacion=0.0, tasa_errores=0.0, tasa_faults=0.0,
+                 movimientos=20, max_numero=None, grabar=None, reproducir=None, upstream=DIRECCION_SERVICIO):
+        """
+        Args:
+            puerto (int): Puerto donde escuchar (0 elige uno libre)
+            latencia (float): Demora de cada respuesta de consultaIUE (segundos)
+            variacion (float): Variación uniforme de la latencia, en más o en menos
+            tasa_errores (float): Fracción de consultas respondidas con HTTP 503
+            tasa_faults (float): Fracción de consultas respondidas con un SOAP Fault
+            movimientos (int): Movimientos de cada expediente sintético
+            max_numero (int): Los números de expediente mayores se responden como inexistentes
+            grabar (str): Directorio donde guardar las respuestas reenviadas a `upstream`
+            reproducir (str): Directorio con respuestas grabadas a servir
+            upstream (str): Dirección del servicio real al grabar
+        """
+        self.latencia = latencia
+        self.variacion = variacion
+        self.tasa_errores = tasa_errores
+        self.tasa_faults = tasa_faults
+        self.movimientos = movimientos
+        self.max_numero = max_numero
+        self.grabar = grabar
+        self.reproducir = reproducir
+        self.upstream = upstream
+        self.estadisticas = {'consultas': 0, 'errores': 0, 'faults': 0, 'reproducidas': 0, 'grabadas': 0}
+        self._lock = threading.Lock()
+        if grabar:
+            os.makedirs(grabar, exist_ok=True)
+
+        stub = self
+
+        class Manejador(http.server.BaseHTTPRequestHandler):
+            # HTTP/1.1 para que el cliente reutilice las conexiones como con el servicio real
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._responder(200, stub._wsdl)
+
+            def do_POST(self):
+                cuerpo = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                codigo, contenido = stub.atender(cuerpo, self.headers.get('SOAPAction'))
+                self._responder(codigo, contenido)
+
+            def _responder(self, codigo, contenido):
+                self.send_response(codigo)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(contenido)))
+                self.end_headers()
+                self.wfile.write(contenido)
+
+            def log_message(self, *args):
+                pass
+
+        self._servidor = http.server.ThreadingHTTPServer(('127.0.0.1', puerto), Manejador)
+        self._servidor.daemon_threads = True
+        self.puerto = self._servidor.server_address[1]
+        with open(os.path.join(DIRECTORIO_FIXTURES, 'wsConsultaIUE.wsdl'), encoding='utf-8') as archivo:
+            self._wsdl = archivo.read().replace(
+                DIRECCION_SERVICIO, f"http://127.0.0.1:{self.puerto}/wsConsultaIUE.php"
+            ).encode('utf-8')
+
+    @property
+    def url(self):
+        """
+        URL del WSDL, para SOAP_WSDL_URL
+        """
+        return f"http://127.0.0.1:{self.puerto}/wsConsultaIUE.php?wsdl"
+
+    def iniciar(self):
+        threading.Thread(target=self._servidor.serve_forever, daemon=True).start()
+        return self
+
+    def detener(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def _contar(self, clave):
+        with self._lock:
+            self.estadisticas[clave] += 1
+
+    def atender(self, cuerpo, accion=None):
+        """
+        Returns:
+            tuple: (código HTTP, cuerpo de la respuesta)
+        """
+        self._contar('consultas')
+        coincidencia = PATRON_IUE.search(cuerpo)
+        iue = coincidencia.group(1).decode('utf-8', 'replace') if coincidencia else ''
+
+        if self.grabar:
+            return self._reenviar(iue, cuerpo, accion)
+
+        demora = self.latencia + random.uniform(-self.variacion, self.variacion)
+        if demora > 0:
+            time.sleep(demora)
+        azar = random.random()
+        if azar < self.tasa_errores:
+            self._contar('errores')
+            return 503, b''
+        if azar < self.tasa_errores + self.tasa_faults:
+            self._contar('faults')
+            return 500, SOBRE.format(FAULT).encode('utf-8')
+
+        if self.reproducir:
+            ruta = os.path.join(self.reproducir, clave_grabacion(iue))
+            if os.path.exists(ruta):
+                self._contar('reproducidas')
+                with open(ruta, 'rb') as archivo:
+                    return 200, archivo.read()
+        return 200, respuesta_sintetica(iue, self.movimientos, self.max_numero)
+
+    def _reenviar(self, iue, cuerpo, accion):
+        pedido = urllib.request.Request(self.upstream, data=cuerpo, method='POST', headers={
+            'Content-Type': 'text/xml; charset=utf-8', 'SOAPAction': accion or '"urn:wsConsultaIUE#consultaIUE"'
+        })
+        try:
+            with urllib.request.urlopen(pedido, timeout=30) as respuesta:
+                codigo, contenido = respuesta.status, respuesta.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+        except OSError:
+            self._contar('errores')
+            return 503, b''
+        if codigo == 200 and iue:
+            ruta = os.path.join(self.grabar, clave_grabacion(iue))
+            with open(ruta + '.tmp', 'wb') as archivo:
+                archivo.write(contenido)
+            os.replace(ruta + '.tmp', ruta)
+            self._contar('grabadas')
+        return codigo, contenido
+
+
+def agregar_argumentos(parser):
+    """
+    Opciones del servidor, compartidas con bench_carga.py
+    """
+    parser.add_argument('--latencia', type=float, default=0.3, help='latencia de cada consulta (segundos)')
+    parser.add_argument('--variacion', type=float, default=0.1, help='variación de la latencia, en más o en menos')
+    parser.add_argument('--tasa-errores', type=float, default=0.0, help='fracción de consultas con HTTP 503')
+    parser.add_argument('--tasa-faults', type=float, default=0.0, help='fracción de consultas con SOAP Fault')
+    parser.add_argument('--movimientos', type=int, default=40, help='movimientos por expediente')
+    parser.add_argument('--max-numero', type=int, help='números de expediente mayores no existen')
+    parser.add_argument('--reproducir', metavar='DIR', help='servir las respuestas grabadas en DIR')
+
+
+def crear_servidor(args, puerto=0):
+    return ServidorStub(
+        puerto=puerto, latencia=args.latencia, variacion=args.variacion, tasa_errores=args.tasa_errores,
+        tasa_faults=args.tasa_faults, movimientos=args.movimientos, max_numero=args.max_numero,
+        reproducir=args.reproducir, grabar=getattr(args, 'grabar', None),
+        upstream=getattr(args, 'upstream', None) or DIRECCION_SERVICIO
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--puerto', type=int, default=8089)
+    agregar_argumentos(parser)
+    parser.add_argument('--grabar', metavar='DIR', help='reenviar al servicio real y guardar las respuestas en DIR')
+    parser.add_argument('--upstream', help=f'dirección del servicio al grabar (por defecto {DIRECCION_SERVICIO})')
+    args = parser.parse_args()
+
+    servidor = crear_servidor(args, args.puerto).iniciar()
+    print(f"WSDL en {servidor.url}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        servidor.detener()
+        print(servidor.estadisticas)
+
+
+if __name__ == '__main__':
+    main()
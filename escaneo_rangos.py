@@ -0,0 +1,208 @@
+"""
+Escaneo de todos los expedientes de una sede y año sin conocer el rango.
+
+El número más alto registrado se busca con sondeos exponenciales y luego
+binarios. Como la numeración puede tener huecos, cada sondeo consulta un
+bloque de números consecutivos y se considera ocupado si alguno existe.
+El límite encontrado se guarda por (sede, año) en SQLite para no repetir
+la búsqueda, y el escaneo se corta tras N números vacíos seguidos pasado
+ese límite.
+"""
+import logging
+import os
+import time
+
+from recursos import ConexionPorHilo, propiedad_motor
+from soap_client import expediente_encontrado
+
+logger = logging.getLogger(__name__)
+
+RANGE_INDEX_DB = os.environ.get(
+    'RANGE_INDEX_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'rangos.db')
+)
+# Números vacíos seguidos a partir de los cuales se da por terminado el rango
+RANGE_SCAN_MAX_EMPTY = int(os.environ.get('RANGE_SCAN_MAX_EMPTY', 20))
+# Números consultados en cada sondeo de la búsqueda del límite
+RANGE_PROBE_BLOCK = int(os.environ.get('RANGE_PROBE_BLOCK', 5))
+# Antigüedad a partir de la cual un límite guardado se vuelve a verificar
+RANGE_INDEX_TTL = int(os.environ.get('RANGE_INDEX_TTL', 24 * 60 * 60))
+# Cota de seguridad para la búsqueda exponencial
+RANGE_MAX_NUMBER = int(os.environ.get('RANGE_MAX_NUMBER', 200000))
+# Errores seguidos del servicio tras los que se interrumpe un escaneo
+RANGE_SCAN_MAX_ERRORS = int(os.environ.get('RANGE_SCAN_MAX_ERRORS', 10))
+
+
+class ErrorEscaneo(Exception):
+    """
+    El servicio devolvió errores y no se puede saber si los números están vacíos
+    """
+
+
+class IndiceRangos:
+    """
+    Último número registrado conocido por (sede, año)
+    """
+
+    def __init__(self, ruta_db=RANGE_INDEX_DB):
+        self.ruta_db = ruta_db
+        self._conexion = ConexionPorHilo(self.ruta_db)
+        with self._conexion() as conexion:
+            conexion.execute('''
+                CREATE TABLE IF NOT EXISTS rangos (
+                    sede TEXT NOT NULL,
+                    anio TEXT NOT NULL,
+                    maximo INTEGER NOT NULL,
+                    verificado REAL NOT NULL,
+                    PRIMARY KEY (sede, anio)
+                )
+            ''')
+
+    def obtener(self, sede, anio):
+        """
+        Returns:
+            tuple: (máximo, momento de la verificación) o None si no se conoce
+        """
+        return self._conexion().execute(
+            'SELECT maximo, verificado FROM rangos WHERE sede = ? AND anio = ?', (sede, anio)
+        ).fetchone()
+
+    def guardar(self, sede, anio, maximo):
+        with self._conexion() as conexion:
+            conexion.execute(
+                'INSERT OR REPLACE INTO rangos (sede, anio, maximo, verificado) VALUES (?, ?, ?, ?)',
+                (sede, anio, maximo, time.time())
+            )
+
+    def listar(self):
+        filas = self._conexion().execute('SELECT sede, anio, maximo, verificado FROM rangos ORDER BY sede, anio')
+        return [{'sede': sede, 'anio': anio, 'maximo': maximo, 'verificado': verificado}
+                for sede, anio, maximo, verificado in filas]
+
+
+class EscanerRangos:
+    def __init__(self, motor=None, indice=None, max_vacios=RANGE_SCAN_MAX_EMPTY, bloque=RANGE_PROBE_BLOCK,
+                 max_errores=RANGE_SCAN_MAX_ERRORS):
+        """
+        Args:
+            motor (MotorLote): Motor de consultas (por defecto el compartido del proceso)
+            indice (IndiceRangos): Índice persistente de límites conocidos
+            max_vacios (int): Vacíos seguidos tras los que se corta el escaneo
+            bloque (int): Números consultados por sondeo
+            max_errores (int): Errores seguidos tras los que se interrumpe el escaneo
+        """
+        self._motor = motor
+        self.indice = indice or IndiceRangos()
+        self.max_vacios = max_vacios
+        self.bloque = bloque
+        self.max_errores = max_errores
+
+    motor = propiedad_motor()
+
+    def _sondear(self, sede, anio, nro):
+        """
+        Consulta el bloque que empieza en `nro`
+        Returns:
+            int: Número más alto encontrado en el bloque, o 0 si está vacío
+        Raises:
+            ErrorEscaneo: Si alguna consulta del bloque falló; un bloque con errores
+                no prueba que esté vacío ni cuál es su número más alto
+        """
+        iues = [f"{sede}-{n}/{anio}" for n in range(nro, nro + self.bloque)]
+        resultados = self.motor.consultar(iues)
+        errores = [resultado['error'] for resultado in resultados if resultado.get('error')]
+        if errores:
+            raise ErrorEscaneo(f"Sondeo de {iues[0]} a {iues[-1]} con {len(errores)} errores: {errores[0]}")
+        encontrados = [n for n, resultado in zip(range(nro, nro + self.bloque), resultados)
+                       if expediente_encontrado(resultado)]
+        return max(encontrados, default=0)
+
+    def buscar_limite(self, sede, anio, forzar=False):
+        """
+        Busca el número de expediente más alto registrado para una sede y año
+        Args:
+            forzar (bool): Ignorar el límite guardado en el índice
+        Returns:
+            int: Número más alto encontrado (0 si la sede no tiene expedientes ese año)
+        Raises:
+            ErrorEscaneo: Si algún sondeo falló (no se guarda nada en el índice)
+        """
+        conocido = None if forzar else self.indice.obtener(sede, anio)
+        if conocido is not None and time.time() - conocido[1] < RANGE_INDEX_TTL:
+            return conocido[0]
+
+        # Búsqueda exponencial: se duplica el número hasta dar con un bloque vacío
+        maximo = 0
+        ocupado = conocido[0] if conocido else 0
+        if ocupado:
+            maximo = self._sondear(sede, anio, ocupado)
+            if not maximo:
+                ocupado = 0
+        vacio = None
+        nro = max(ocupado, 1)
+        while nro <= RANGE_MAX_NUMBER:
+            encontrado = self._sondear(sede, anio, nro)
+            if not encontrado:
+                vacio = nro
+                break
+            maximo = max(maximo, encontrado)
+            ocupado = nro
+            nro *= 2
+        if vacio is None:
+            vacio = RANGE_MAX_NUMBER
+
+        # Búsqueda binaria entre el último bloque ocupado y el primero vacío
+        while vacio - ocupado > self.bloque:
+            medio = (ocupado + vacio) // 2
+            encontrado = self._sondear(sede, anio, medio)
+            if encontrado:
+                maximo = max(maximo, encontrado)
+                ocupado = medio
+            else:
+                vacio = medio
+
+        logger.info(f"Límite de la sede {sede} en {anio}: {maximo}")
+        self.indice.guardar(sede, anio, maximo)
+        return maximo
+
+    def escanear(self, sede, anio, tamano_lote=50, usar_cache=True):
+        """
+        Recorre todos los expedientes de una sede y año, en orden
+        Yields:
+            dict: Resultado de cada expediente existente
+        Raises:
+            ErrorEscaneo: Si falla la búsqueda del límite o hay `max_errores` errores seguidos
+        """
+        limite = self.buscar_limite(sede, anio)
+        maximo = 0
+        vacios = 0
+        errores = 0
+        desde = 1
+        while desde <= RANGE_MAX_NUMBER:
+            # Pasado el límite conocido se avanza de a pocos para no desperdiciar consultas
+            tamano = tamano_lote if desde <= limite else self.max_vacios
+            hasta = min(desde + tamano - 1, RANGE_MAX_NUMBER)
+            iues = [f"{sede}-{nro}/{anio}" for nro in range(desde, hasta + 1)]
+            for nro, resultado in zip(range(desde, hasta + 1), self.motor.consultar(iues, usar_cache=usar_cache)):
+                if expediente_encontrado(resultado):
+                    maximo = nro
+                    vacios = errores = 0
+                    yield resultado
+                elif resultado.get('error'):
+                    # Un error no prueba que el número esté vacío; muchos seguidos
+                    # indican que el servicio no responde
+                    errores += 1
+                    if errores >= self.max_errores:
+                        raise ErrorEscaneo(
+                            f"Escaneo de la sede {sede} en {anio} interrumpido en el número {nro} "
+                            f"tras {errores} errores seguidos: {resultado['error']}"
+                        )
+                else:
+                    errores = 0
+                    vacios += 1
+                    # Los huecos por debajo del límite conocido no cortan el escaneo
+                    if nro > limite and vacios >= self.max_vacios:
+                        if maximo != limite:
+                            self.indice.guardar(sede, anio, maximo)
+                        return
+            desde = hasta + 1
@@ -0,0 +1,73 @@
+"""
+Configuración de gunicorn para producción. gunicorn la toma sola si se lo
+ejecuta desde esta carpeta:
+
+    gunicorn main:app
+
+La aplicación se carga una vez en el proceso maestro (preload_app) y se
+"calienta" antes de crear los workers: el WSDL ya parseado, las plantillas
+compiladas y los módulos importados quedan compartidos por todos los
+workers (copy-on-write) en lugar de cargarse en cada uno.
+
+Las consultas al servicio SOAP pasan casi todo el tiempo esperando la red,
+así que cada worker atiende varios pedidos a la vez con hilos (gthread). Con
+GUNICORN_WORKER_CLASS=gevent se usan greenlets (requiere instalar gevent).
+
+Variables de entorno:
+    PORT / GUNICORN_BIND      dirección donde escuchar (0.0.0.0:5000)
+    GUNICORN_WORKERS          procesos (por defecto, uno por CPU)
+    GUNICORN_THREADS          hilos por worker con gthread (16)
+    GUNICORN_WORKER_CLASS     gthread (por defecto) o gevent
+    GUNICORN_WORKER_CONNECTIONS  pedidos simultáneos por worker con gevent (200)
+    GUNICORN_TIMEOUT          segundos antes de reiniciar un worker trabado (120)
+    LOG_LEVEL                 nivel de log de gunicorn y de la aplicación (INFO)
+    GUNICORN_ACCESS_LOG       archivo del log de accesos ('-' para stdout, vacío para no registrarlos)
+"""
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+if worker_class == 'gevent':
+    # Con preload_app la aplicación se importa en el maestro, antes de que gunicorn
+    # aplique los parches de gevent en cada worker: hay que aplicarlos ya, antes que
+    # se importen socket, ssl y threading
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+workers = int(os.environ.get('GUNICORN_WORKERS', os.cpu_count() or 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 200))
+
+preload_app = True
+
+# Segundos sin señales de vida tras los cuales el maestro reinicia un worker. Los
+# workers gthread y gevent avisan desde su bucle principal aunque haya pedidos en
+# curso, así que no es un límite por pedido: sólo detecta un worker trabado. Las
+# consultas en lote largas las corta BATCH_TIMEOUT (ver motor_lote.py)
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+loglevel = os.environ.get('LOG_LEVEL', 'INFO').lower()
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-') or None
+errorlog = '-'
+
+
+def when_ready(server):
+    # Se ejecuta en el maestro con la aplicación ya cargada y antes de crear los workers
+    if server.cfg.preload_app:
+        from app import calentar
+        if calentar():
+            server.log.info("Aplicación precargada: cliente SOAP y plantillas listos")
+        else:
+            server.log.warning("Aplicación precargada sin cliente SOAP; cada worker lo creará en la primera consulta")
+        # Las conexiones SQLite que abrió el cliente (caché, índice, historial) no
+        # sobreviven al fork: se cierran aquí y cada worker abre las suyas
+        import soap_client
+        soap_client.cerrar_conexiones()
+
+
+def post_fork(server, worker):
+    import soap_client
+    soap_client.reiniciar_tras_fork()
@@ -0,0 +1,248 @@
+"""
+Historial de los expedientes consultados, para saber qué cambió y cuándo, y
+reconstruir el estado de un expediente en cualquier fecha pasada.
+
+Cada resultado obtenido del servicio se compara con el último estado
+guardado del expediente. Si no cambió no se escribe nada, así que el
+espacio crece con la cantidad de cambios y no con la de consultas. Si
+cambió se agrega una versión al registro (que nunca se modifica) con la
+diferencia: qué tramos de la lista de movimientos se reemplazaron, por
+huellas de movimiento. El contenido de cada movimiento se guarda una sola
+vez por expediente, en la primera versión en que aparece, y cada versión se
+guarda comprimida.
+
+El historial está desactivado salvo que se indique su base en HISTORY_DB.
+El motor de lotes registra los cambios desde su hilo de escritura, fuera
+del event loop.
+"""
+import difflib
+import json
+import logging
+import os
+import time
+import zlib
+
+from recursos import ConexionPorHilo
+from soap_client import expediente_encontrado, huella_movimiento, huella_movimientos
+
+logger = logging.getLogger(__name__)
+
+# Base del historial; vacío (por defecto) para no registrarlo. Registrar un cambio
+# toma un lock de escritura de SQLite, así que sólo se activa si se lo va a consultar
+HISTORY_DB = os.environ.get('HISTORY_DB', '')
+
+
+def _comprimir(datos):
+    return zlib.compress(json.dumps(datos, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8'), 9)
+
+
+def _descomprimir(blob):
+    return json.loads(zlib.decompress(blob))
+
+
+def diferencia(anterior, nueva):
+    """
+    Tramos que hay que reemplazar en la lista de huellas `anterior` para obtener `nueva`
+    Returns:
+        list: [inicio, fin, huellas nuevas] en orden; en el caso habitual (movimientos
+            agregados al principio o al final) es un solo tramo
+    """
+    comparador = difflib.SequenceMatcher(None, anterior, nueva, autojunk=False)
+    return [[i1, i2, nueva[j1:j2]] for op, i1, i2, j1, j2 in comparador.get_opcodes() if op != 'equal']
+
+
+def aplicar(estado, tramos):
+    """
+    Aplica a una lista de huellas la diferencia calculada con diferencia()
+    """
+    # De atrás hacia adelante, para que los índices sigan siendo los de la lista anterior
+    for inicio, fin, huellas in reversed(tramos):
+        estado[inicio:fin] = huellas
+    return estado
+
+
+class HistorialExpedientes:
+    def __init__(self, ruta_db):
+        self.ruta_db = ruta_db
+        self._conexion = ConexionPorHilo(self.ruta_db, filas=True)
+        with self._conexion() as conexion:
+            conexion.executescript('''
+                CREATE TABLE IF NOT EXISTS expedientes_historial (
+                    iue TEXT PRIMARY KEY,
+                    caratula TEXT,
+                    origen TEXT,
+                    huella TEXT NOT NULL,
+                    estado BLOB NOT NULL,
+                    versiones INTEGER NOT NULL,
+                    actualizado REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS versiones (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    iue TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    observado REAL NOT NULL,
+                    datos BLOB NOT NULL
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS versiones_iue ON versiones (iue, version);
+            ''')
+
+    def registrar(self, resultado, momento=None):
+        """
+        Agrega una versión si el expediente cambió desde la última guardada
+        Args:
+            resultado (dict): Resultado de consultar_expediente
+            momento (float): Cuándo se obtuvo el resultado (por defecto ahora)
+        Returns:
+            bool: True si se agregó una versión
+        """
+        if resultado.get('desactualizado') or not expediente_encontrado(resultado):
+            return False
+        iue = resultado['expediente']
+        movimientos = resultado.get('movimientos') or []
+        huella = huella_movimientos(movimientos)
+        caratula, origen = resultado.get('caratula'), resultado.get('origen')
+        conexion = self._conexion()
+
+        # Sin cambios (el caso habitual) se resuelve con una lectura
+        anterior = conexion.execute(
+            'SELECT huella, caratula, origen FROM expedientes_historial WHERE iue = ?', (iue,)
+        ).fetchone()
+        if anterior is not None and tuple(anterior) == (huella, caratula, origen):
+            return False
+
+        momento = time.time() if momento is None else momento
+        huellas = [huella_movimiento(movimiento) for movimiento in movimientos]
+        # IMMEDIATE: dos workers que registran el mismo expediente no deben calcular
+        # la diferencia sobre el mismo estado anterior
+        conexion.execute('BEGIN IMMEDIATE')
+        try:
+            anterior = conexion.execute(
+                'SELECT huella, caratula, origen, estado, versiones FROM expedientes_historial WHERE iue = ?', (iue,)
+            ).fetchone()
+            if anterior is not None and (anterior['huella'], anterior['caratula'], anterior['origen']) == (huella, caratula, origen):
+                conexion.rollback()
+                return False
+
+            estado = _descomprimir(anterior['estado']) if anterior is not None else []
+            version = anterior['versiones'] + 1 if anterior is not None else 1
+            conocidas = set(estado)
+            if anterior is not None and not conocidas.issuperset(huellas):
+                # Huellas que ya aparecieron alguna vez, aunque hoy no estén en la lista
+                conocidas.update(self._huellas_guardadas(conexion, iue))
+            delta = {'tramos': diferencia(estado, huellas)}
+            nuevos = {}
+            for h, movimiento in zip(huellas, movimientos):
+                if h not in conocidas and h not in nuevos:
+                    nuevos[h] = movimiento
+            if nuevos:
+                delta['movimientos'] = nuevos
+            if anterior is None or anterior['caratula'] != caratula:
+                delta['caratula'] = caratula
+            if anterior is None or anterior['origen'] != origen:
+                delta['origen'] = origen
+
+            conexion.execute(
+                'INSERT INTO versiones (iue, version, observado, datos) VALUES (?, ?, ?, ?)',
+                (iue, version, momento, _comprimir(delta))
+            )
+            conexion.execute(
+                'INSERT OR REPLACE INTO expedientes_historial (iue, caratula, origen, huella, estado, versiones, actualizado) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (iue, caratula, origen, huella, _comprimir(huellas), version, momento)
+            )
+            conexion.commit()
+        except BaseException:
+            conexion.rollback()
+            raise
+        return True
+
+    def _huellas_guardadas(self, conexion, iue):
+        huellas = set()
+        for (datos,) in conexion.execute('SELECT datos FROM versiones WHERE iue = ?', (iue,)):
+            huellas.update(_descomprimir(datos).get('movimientos', ()))
+        return huellas
+
+    def _versiones(self, iue, hasta=None):
+        if hasta is None:
+            return self._conexion().execute(
+                'SELECT version, observado, datos FROM versiones WHERE iue = ? ORDER BY version', (iue,)
+            )
+        return self._conexion().execute(
+            'SELECT version, observado, datos FROM versiones WHERE iue = ? AND observado <= ? ORDER BY version',
+            (iue, hasta)
+        )
+
+    def estado_en(self, iue, momento=None):
+        """
+        Reconstruye el expediente tal como se lo conocía en `momento`
+        Args:
+            iue (str): IUE normalizado
+            momento (float): Timestamp; por defecto el último estado conocido
+        Returns:
+            dict: expediente, caratula, origen, movimientos, y la version y el momento
+                (observado) en que se obtuvo ese estado; None si no hay versiones
+                anteriores a `momento`
+        """
+        estado, contenidos = [], {}
+        expediente = None
+        for fila in self._versiones(iue, momento):
+            delta = _descomprimir(fila['datos'])
+            aplicar(estado, delta['tramos'])
+            contenidos.update(delta.get('movimientos', ()))
+            expediente = {
+                'expediente': iue,
+                'caratula': delta.get('caratula', expediente and expediente['caratula']),
+                'origen': delta.get('origen', expediente and expediente['origen']),
+                'version': fila['version'],
+                'observado': fila['observado']
+            }
+        if expediente is None:
+            return None
+        expediente['movimientos'] = [contenidos[h] for h in estado]
+        return expediente
+
+    def cambios(self, iue, desde=None, hasta=None):
+        """
+        Qué cambió en cada versión del expediente
+        Args:
+            desde, hasta (float): Limitar a las versiones observadas en ese intervalo
+        Returns:
+            list: {'version', 'observado', 'agregados', 'quitados'} (listas de
+                movimientos) más 'caratula'/'origen' si cambiaron
+        """
+        estado, contenidos, cambios = [], {}, []
+        for fila in self._versiones(iue, hasta):
+            delta = _descomprimir(fila['datos'])
+            contenidos.update(delta.get('movimientos', ()))
+            anterior = list(estado)
+            aplicar(estado, delta['tramos'])
+            if desde is not None and fila['observado'] < desde:
+                continue
+            quitados = [h for inicio, fin, _ in delta['tramos'] for h in anterior[inicio:fin]]
+            agregados = [h for _, _, huellas in delta['tramos'] for h in huellas]
+            # Un movimiento que sólo cambió de posición no es ni nuevo ni quitado
+            cambio = {
+                'version': fila['version'],
+                'observado': fila['observado'],
+                'agregados': [contenidos[h] for h in agregados if h not in quitados],
+                'quitados': [contenidos[h] for h in quitados if h not in agregados]
+            }
+            for campo in ('caratula', 'origen'):
+                if campo in delta and fila['version'] > 1:
+                    cambio[campo] = delta[campo]
+            cambios.append(cambio)
+        return cambios
+
+    def estadisticas(self):
+        conexion = self._conexion()
+        expedientes, bytes_estado = conexion.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(estado)), 0) FROM expedientes_historial'
+        ).fetchone()
+        versiones, bytes_versiones = conexion.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(datos)), 0) FROM versiones'
+        ).fetchone()
+        return {
+            'expedientes': expedientes,
+            'versiones': versiones,
+            'bytes': bytes_estado + bytes_versiones
+        }
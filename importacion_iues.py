@@ -0,0 +1,307 @@
+"""
+Importación de listas de IUEs desde CSV o Excel (XLSX).
+
+Las planillas pueden mezclar sedes y años. Cada valor se normaliza con el
+mismo patrón y limpieza que la consulta individual. Los IUEs repetidos se
+consultan una sola vez y los valores inválidos o con error quedan
+informados en su propia fila. La entrada se lee y se resuelve por bloques
+con el motor de lotes, y el resultado se escribe a medida que se obtiene,
+así que la memoria no crece con el tamaño del archivo (salvo el conjunto de
+IUEs ya vistos).
+
+Uso:
+    python importacion_iues.py expedientes.csv -o resultados.xlsx
+"""
+import argparse
+import csv
+import io
+import itertools
+import logging
+import os
+import re
+import sys
+import zipfile
+
+from recursos import propiedad_motor
+from soap_client import ConsultaExpedientes, IUE_PATTERN, expediente_encontrado
+
+logger = logging.getLogger(__name__)
+
+# IUEs consultados juntos con el motor de lotes; acota la memoria usada por bloque
+IMPORT_BLOCK_SIZE = int(os.environ.get('IMPORT_BLOCK_SIZE', 500))
+
+COLUMNAS = ('fila', 'iue_original', 'iue', 'estado', 'caratula', 'origen',
+            'primer_movimiento', 'movimientos', 'desactualizado', 'error')
+
+# Encabezados reconocidos para la columna con los IUEs
+ENCABEZADOS_IUE = ('iue', 'expediente', 'ficha')
+
+ENCONTRADO = 'encontrado'
+NO_ENCONTRADO = 'no_encontrado'
+INVALIDO = 'invalido'
+ERROR = 'error'
+
+
+def _elegir_columna(primera_fila, columna):
+    """
+    Returns:
+        tuple: (índice de la columna, si la primera fila es un encabezado)
+    """
+    encabezados = [str(valor or '').strip().lower() for valor in primera_fila]
+    if isinstance(columna, str) and not columna.isdigit():
+        if columna.strip().lower() not in encabezados:
+            raise ValueError(f"No se encontró la columna '{columna}'")
+        return encabezados.index(columna.strip().lower()), True
+    if columna is not None:
+        indice = int(columna) - 1
+        if indice < 0:
+            raise ValueError("El número de columna empieza en 1")
+    else:
+        indice = next((i for i, nombre in enumerate(encabezados) if nombre in ENCABEZADOS_IUE), None)
+        if indice is not None:
+            return indice, True
+        indice = 0
+    # Sin un encabezado conocido, la primera fila es un encabezado si no tiene forma de IUE
+    valor = encabezados[indice] if indice < len(encabezados) else ''
+    return indice, bool(valor) and not re.match(IUE_PATTERN, valor)
+
+
+def leer_csv(archivo, columna=None):
+    """
+    Lee los IUEs de un CSV (separado por comas, punto y coma o tabuladores)
+    Args:
+        archivo: Archivo binario abierto
+        columna: Nombre o número (desde 1) de la columna; por defecto la de encabezado
+            'iue'/'expediente' o la primera
+    Returns:
+        iterator: (número de fila, valor). El encabezado se lee antes de devolverlo,
+            así que una columna inexistente falla enseguida y no al recorrerlo
+    Raises:
+        ValueError: Si no se encuentra la columna
+    """
+    texto = io.TextIOWrapper(archivo, encoding='utf-8-sig', errors='replace', newline='')
+    primera = texto.readline()
+    if not primera:
+        return iter(())
+    # Excel en español guarda los CSV con punto y coma
+    separador = max((',', ';', '\t'), key=primera.count)
+    filas = csv.reader(itertools.chain([primera], texto), delimiter=separador)
+    try:
+        return _valores(filas, columna)
+    except csv.Error as e:
+        raise ValueError(f"El archivo no es un CSV válido: {e}")
+
+
+def leer_xlsx(archivo, columna=None):
+    """
+    Igual que leer_csv() para la primera hoja de un archivo XLSX
+    Raises:
+        ValueError: Si el archivo no es un XLSX válido o no se encuentra la columna
+    """
+    try:
+        from openpyxl import load_workbook
+        from openpyxl.utils.exceptions import InvalidFileException
+    except ImportError:
+        raise ValueError("Para leer archivos XLSX hay que instalar openpyxl")
+    try:
+        # read_only recorre las filas sin cargar la hoja entera en memoria
+        libro = load_workbook(archivo, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError, OSError) as e:
+        raise ValueError(f"El archivo no es un XLSX válido: {e}")
+    try:
+        valores = _valores(libro.worksheets[0].iter_rows(values_only=True), columna)
+    except BaseException:
+        libro.close()
+        raise
+    return _cerrar_al_terminar(valores, libro)
+
+
+def _cerrar_al_terminar(valores, libro):
+    try:
+        yield from valores
+    finally:
+        libro.close()
+
+
+def _valores(filas, columna):
+    # La primera fila se lee ahora; las demás, al recorrer el iterador devuelto
+    filas = iter(filas)
+    primera = next(filas, None)
+    if primera is None:
+        return iter(())
+    indice, con_encabezado = _elegir_columna(primera, columna)
+    inicio = 1
+    if not con_encabezado:
+        filas = itertools.chain([primera], filas)
+    else:
+        inicio = 2
+    return _leer_columna(filas, indice, inicio)
+
+
+def _leer_columna(filas, indice, inicio):
+    for numero, fila in enumerate(filas, start=inicio):
+        valor = fila[indice] if indice < len(fila) else None
+        if isinstance(valor, float) and valor.is_integer():
+            valor = int(valor)
+        valor = '' if valor is None else str(valor).strip()
+        if valor:
+            yield numero, valor
+
+
+def leer_archivo(archivo, nombre, columna=None):
+    """
+    Elige el lector según la extensión del nombre del archivo
+    """
+    if nombre.lower().endswith(('.xlsx', '.xlsm')):
+        return leer_xlsx(archivo, columna)
+    return leer_csv(archivo, columna)
+
+
+def normalizar_iue(valor):
+    """
+    Raises:
+        ValueError: Si el valor no tiene formato de IUE
+    """
+    if not re.match(IUE_PATTERN, valor):
+        raise ValueError('Formato de IUE inválido. Debe ser: Sede - NroRegistro / Año')
+    return ConsultaExpedientes._limpiar_iue(valor)
+
+
+class ImportadorIUEs:
+    def __init__(self, motor=None, tamano_bloque=IMPORT_BLOCK_SIZE):
+        """
+        Args:
+            motor (MotorLote): Motor de consultas (por defecto el compartido del proceso)
+            tamano_bloque (int): IUEs consultados por bloque
+        """
+        self._motor = motor
+        self.tamano_bloque = tamano_bloque
+
+    motor = propiedad_motor()
+
+    def resolver(self, valores, usar_cache=True):
+        """
+        Normaliza, deduplica y consulta los IUEs
+        Args:
+            valores: Iterable de (número de fila, valor) como los de leer_archivo()
+        Yields:
+            dict: Una fila por IUE distinto o valor inválido, en el orden de entrada
+        """
+        vistos = set()
+        bloque = []
+        repetidos = 0
+        for numero, valor in valores:
+            fila = {'fila': numero, 'iue_original': valor}
+            try:
+                fila['iue'] = iue = normalizar_iue(valor)
+            except ValueError as ve:
+                fila.update(estado=INVALIDO, error=str(ve))
+            else:
+                if iue in vistos:
+                    repetidos += 1
+                    continue
+                vistos.add(iue)
+            bloque.append(fila)
+            # Las filas inválidas también cuentan: un archivo con muchas no debe
+            # acumularlas todas en memoria esperando completar un bloque
+            if len(bloque) >= self.tamano_bloque:
+                yield from self._resolver_bloque(bloque, usar_cache)
+                bloque = []
+        yield from self._resolver_bloque(bloque, usar_cache)
+        logger.info(f"Importación terminada: {len(vistos)} IUEs distintos, {repetidos} repetidos")
+
+    def _resolver_bloque(self, bloque, usar_cache):
+        consultas = [fila for fila in bloque if 'estado' not in fila]
+        if not consultas:
+            yield from bloque
+            return
+        for indice, resultado in self.motor.consultar_iter([fila['iue'] for fila in consultas], usar_cache=usar_cache):
+            consultas[indice].update(_resumir(resultado))
+        yield from bloque
+
+
+def _resumir(resultado):
+    if resultado.get('error'):
+        return {'estado': ERROR, 'error': resultado.get('caratula')}
+    if not expediente_encontrado(resultado):
+        return {'estado': NO_ENCONTRADO}
+    return {
+        'estado': ENCONTRADO,
+        'caratula': resultado.get('caratula'),
+        'origen': resultado.get('origen'),
+        'primer_movimiento': resultado.get('primer_movimiento'),
+        'movimientos': len(resultado.get('movimientos') or []),
+        'desactualizado': 'si' if resultado.get('desactualizado') else ''
+    }
+
+
+def csv_en_partes(filas, filas_por_parte=100):
+    """
+    Serializa las filas como CSV
+    Yields:
+        str: Fragmentos de texto (encabezado incluido) listos para enviar
+    """
+    buffer = io.StringIO()
+    escritor = csv.DictWriter(buffer, fieldnames=COLUMNAS, extrasaction='ignore')
+    escritor.writeheader()
+    for numero, fila in enumerate(filas, start=1):
+        escritor.writerow(fila)
+        if numero % filas_por_parte == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def escribir_xlsx(filas, destino):
+    """
+    Escribe las filas en un XLSX sin mantener la hoja en memoria
+    Args:
+        destino: Ruta o archivo binario
+    """
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise ValueError("Para generar archivos XLSX hay que instalar openpyxl")
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet('Expedientes')
+    hoja.append(list(COLUMNAS))
+    for fila in filas:
+        hoja.append([fila.get(columna) for columna in COLUMNAS])
+    libro.save(destino)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Consulta una lista de IUEs tomada de un CSV o XLSX')
+    parser.add_argument('entrada', help='archivo CSV o XLSX con los IUEs')
+    parser.add_argument('-o', '--salida', help='archivo de resultados (.csv o .xlsx); por defecto CSV por la salida estándar')
+    parser.add_argument('-c', '--columna', help='nombre o número (desde 1) de la columna con los IUEs')
+    parser.add_argument('--sin-cache', action='store_true', help='no usar la caché de resultados')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    importador = ImportadorIUEs()
+
+    try:
+        with open(args.entrada, 'rb') as entrada:
+            filas = importador.resolver(leer_archivo(entrada, args.entrada, args.columna),
+                                        usar_cache=not args.sin_cache)
+            if args.salida and args.salida.lower().endswith('.xlsx'):
+                escribir_xlsx(filas, args.salida)
+            elif args.salida:
+                with open(args.salida, 'w', encoding='utf-8', newline='') as salida:
+                    salida.writelines(csv_en_partes(filas))
+            else:
+                for parte in csv_en_partes(filas):
+                    sys.stdout.write(parte)
+                    sys.stdout.flush()
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        return 130
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""
+Índice de búsqueda local (SQLite FTS5) de los expedientes ya consultados.
+
+Cada resultado obtenido del servicio se indexa: carátula y origen del
+expediente, y fecha, tipo y decreto de cada movimiento. La actualización es
+incremental: si la huella de los movimientos no cambió no se escribe nada.
+Las búsquedas se responden sólo con el índice, sin consultar el servicio.
+"""
+import logging
+import os
+import re
+import time
+
+from recursos import ConexionPorHilo
+from soap_client import expediente_encontrado, huella_movimientos
+
+logger = logging.getLogger(__name__)
+
+SEARCH_INDEX_DB = os.environ.get(
+    'SEARCH_INDEX_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'indice_busqueda.db')
+)
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 200))
+
+FECHA_DMA = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})')
+FECHA_ISO = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+
+def fecha_iso(fecha):
+    """
+    Convierte la fecha de un movimiento (dd/mm/aaaa) a aaaa-mm-dd para poder filtrar por rango
+    Returns:
+        str: Fecha ISO, o None si no se reconoce el formato
+    """
+    fecha = str(fecha or '').strip()
+    coincidencia = FECHA_DMA.match(fecha)
+    if coincidencia:
+        dia, mes, anio = coincidencia.groups()
+        return f"{anio}-{int(mes):02d}-{int(dia):02d}"
+    if FECHA_ISO.match(fecha):
+        return fecha[:10]
+    return None
+
+
+def consulta_fts(texto):
+    """
+    Convierte el texto ingresado por el usuario en una consulta FTS5: todas las
+    palabras deben aparecer, cada una como prefijo (sin operadores de FTS5)
+    """
+    palabras = re.findall(r'\w+', texto or '')
+    return ' '.join(f'"{palabra}"*' for palabra in palabras)
+
+
+class IndiceBusqueda:
+    def __init__(self, ruta_db=SEARCH_INDEX_DB):
+        self.ruta_db = ruta_db
+        self._conexion = ConexionPorHilo(self.ruta_db, filas=True)
+        with self._conexion() as conexion:
+            conexion.executescript('''
+                CREATE TABLE IF NOT EXISTS expedientes (
+                    id INTEGER PRIMARY KEY,
+                    iue TEXT NOT NULL UNIQUE,
+                    caratula TEXT,
+                    origen TEXT,
+                    huella TEXT NOT NULL,
+                    actualizado REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS movimientos (
+                    id INTEGER PRIMARY KEY,
+                    iue TEXT NOT NULL,
+                    fecha TEXT,
+                    fecha_iso TEXT,
+                    tipo TEXT,
+                    decreto TEXT,
+                    sede TEXT
+                );
+                CREATE INDEX IF NOT EXISTS movimientos_iue ON movimientos (iue);
+                CREATE INDEX IF NOT EXISTS movimientos_fecha ON movimientos (fecha_iso);
+                CREATE VIRTUAL TABLE IF NOT EXISTS expedientes_fts USING fts5(
+                    caratula, origen, content='expedientes', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS movimientos_fts USING fts5(
+                    tipo, decreto, content='movimientos', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                );
+            ''')
+
+    def indexar(self, resultado):
+        """
+        Agrega o actualiza un expediente en el índice
+        Args:
+            resultado (dict): Resultado de consultar_expediente
+        Returns:
+            bool: True si el índice cambió
+        """
+        if resultado.get('desactualizado') or not expediente_encontrado(resultado):
+            return False
+        iue = resultado['expediente']
+        movimientos = resultado.get('movimientos') or []
+        huella = huella_movimientos(movimientos)
+        conexion = self._conexion()
+        anterior = conexion.execute(
+            'SELECT id, caratula, origen, huella FROM expedientes WHERE iue = ?', (iue,)
+        ).fetchone()
+        caratula, origen = resultado.get('caratula'), resultado.get('origen')
+        if anterior is not None and (anterior['huella'], anterior['caratula'], anterior['origen']) == (huella, caratula, origen):
+            return False
+
+        with conexion:
+            if anterior is not None:
+                # Las tablas FTS5 con contenido externo se actualizan borrando los valores anteriores
+                conexion.execute(
+                    "INSERT INTO expedientes_fts (expedientes_fts, rowid, caratula, origen) VALUES ('delete', ?, ?, ?)",
+                    (anterior['id'], anterior['caratula'], anterior['origen'])
+                )
+                conexion.execute(
+                    'UPDATE expedientes SET caratula = ?, origen = ?, huella = ?, actualizado = ? WHERE id = ?',
+                    (caratula, origen, huella, time.time(), anterior['id'])
+                )
+                id_expediente = anterior['id']
+            else:
+                id_expediente = conexion.execute(
+                    'INSERT INTO expedientes (iue, caratula, origen, huella, actualizado) VALUES (?, ?, ?, ?, ?)',
+                    (iue, caratula, origen, huella, time.time())
+                ).lastrowid
+            conexion.execute(
+                'INSERT INTO expedientes_fts (rowid, caratula, origen) VALUES (?, ?, ?)',
+                (id_expediente, caratula, origen)
+            )
+
+            if anterior is None or anterior['huella'] != huella:
+                conexion.execute(
+                    "INSERT INTO movimientos_fts (movimientos_fts, rowid, tipo, decreto) "
+                    "SELECT 'delete', id, tipo, decreto FROM movimientos WHERE iue = ?", (iue,)
+                )
+                conexion.execute('DELETE FROM movimientos WHERE iue = ?', (iue,))
+                for movimiento in movimientos:
+                    id_movimiento = conexion.execute(
+                        'INSERT INTO movimientos (iue, fecha, fecha_iso, tipo, decreto, sede) VALUES (?, ?, ?, ?, ?, ?)',
+                        (iue, movimiento.get('fecha'), fecha_iso(movimiento.get('fecha')),
+                         movimiento.get('tipo'), movimiento.get('decreto'), movimiento.get('sede'))
+                    ).lastrowid
+                    conexion.execute(
+                        'INSERT INTO movimientos_fts (rowid, tipo, decreto) VALUES (?, ?, ?)',
+                        (id_movimiento, movimiento.get('tipo'), movimiento.get('decreto'))
+                    )
+        return True
+
+    def buscar_expedientes(self, texto, limite=SEARCH_MAX_RESULTS):
+        """
+        Expedientes cuya carátula u origen contienen todas las palabras de `texto`
+        """
+        consulta = consulta_fts(texto)
+        if not consulta:
+            return []
+        filas = self._conexion().execute(
+            'SELECT e.iue, e.caratula, e.origen, e.actualizado FROM expedientes_fts '
+            'JOIN expedientes e ON e.id = expedientes_fts.rowid '
+            'WHERE expedientes_fts MATCH ? ORDER BY rank LIMIT ?',
+            (consulta, limite)
+        )
+        return [dict(fila) for fila in filas]
+
+    def buscar_movimientos(self, texto=None, desde=None, hasta=None, limite=SEARCH_MAX_RESULTS):
+        """
+        Movimientos cuyo tipo o decreto contienen `texto` y/o con fecha entre `desde`
+        y `hasta` (aaaa-mm-dd, inclusive), del más reciente al más antiguo
+        """
+        consulta = consulta_fts(texto)
+        condiciones, parametros = [], []
+        if consulta:
+            condiciones.append('m.id IN (SELECT rowid FROM movimientos_fts WHERE movimientos_fts MATCH ?)')
+            parametros.append(consulta)
+        if desde:
+            condiciones.append('m.fecha_iso >= ?')
+            parametros.append(desde)
+        if hasta:
+            condiciones.append('m.fecha_iso <= ?')
+            parametros.append(hasta)
+        if not condiciones:
+            return []
+        filas = self._conexion().execute(
+            'SELECT m.iue, m.fecha, m.tipo, m.decreto, m.sede, e.caratula FROM movimientos m '
+            'JOIN expedientes e ON e.iue = m.iue '
+            f'WHERE {" AND ".join(condiciones)} ORDER BY m.fecha_iso DESC, m.id LIMIT ?',
+            (*parametros, limite)
+        )
+        return [dict(fila) for fila in filas]
+
+    def estadisticas(self):
+        conexion = self._conexion()
+        return {
+            'expedientes': conexion.execute('SELECT COUNT(*) FROM expedientes').fetchone()[0],
+            'movimientos': conexion.execute('SELECT COUNT(*) FROM movimientos').fetchone()[0]
+        }
@@ -5,4 +5,6 @@ from flask import Flask
 from app import app
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Servidor de desarrollo (FLASK_DEBUG=1 para el modo debug).
+    # En producción: gunicorn main:app, con la configuración de gunicorn.conf.py
+    app.run(host="0.0.0.0", port=5000)
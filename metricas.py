@@ -0,0 +1,196 @@
+"""
+Métricas de latencia por etapa y contadores de errores, en formato de texto
+de Prometheus.
+
+Cada etapa (carga del WSDL, consulta SOAP, procesamiento de movimientos,
+render de plantillas, generación de PDF, request completo) se registra en un
+histograma con buckets fijos y, además, se exportan percentiles calculados
+sobre las últimas observaciones. Las métricas son por proceso: con varios
+workers de gunicorn cada uno expone las suyas.
+
+El perfil por request es opcional: si está activo (ver activar_perfil) las
+etapas medidas durante el request se acumulan para devolverlas en el
+encabezado Server-Timing.
+"""
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Buckets en segundos, pensados para latencias de entre milisegundos y el timeout del servicio
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CUANTILES = (0.5, 0.9, 0.99)
+# Observaciones recientes por serie sobre las que se calculan los percentiles
+VENTANA_PERCENTILES = 1024
+
+_perfil = contextvars.ContextVar('perfil', default=None)
+
+
+class Histograma:
+    def __init__(self, nombre, ayuda, etiqueta, buckets=BUCKETS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiqueta = etiqueta
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observar(self, valor_etiqueta, segundos):
+        with self._lock:
+            serie = self._series.get(valor_etiqueta)
+            if serie is None:
+                serie = self._series[valor_etiqueta] = {
+                    'buckets': [0] * len(self.buckets),
+                    'suma': 0.0,
+                    'cantidad': 0,
+                    'recientes': deque(maxlen=VENTANA_PERCENTILES)
+                }
+            for i, limite in enumerate(self.buckets):
+                if segundos <= limite:
+                    serie['buckets'][i] += 1
+            serie['suma'] += segundos
+            serie['cantidad'] += 1
+            serie['recientes'].append(segundos)
+
+    def percentiles(self, valor_etiqueta):
+        with self._lock:
+            serie = self._series.get(valor_etiqueta)
+            recientes = sorted(serie['recientes']) if serie else []
+        if not recientes:
+            return {}
+        return {q: recientes[min(len(recientes) - 1, int(q * len(recientes)))] for q in CUANTILES}
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with self._lock:
+            series = {valor: (list(s['buckets']), s['suma'], s['cantidad']) for valor, s in self._series.items()}
+        for valor, (buckets, suma, cantidad) in sorted(series.items()):
+            etiqueta = f'{self.etiqueta}="{valor}"'
+            for limite, acumulado in zip(self.buckets, buckets):
+                lineas.append(f'{self.nombre}_bucket{{{etiqueta},le="{limite}"}} {acumulado}')
+            lineas.append(f'{self.nombre}_bucket{{{etiqueta},le="+Inf"}} {cantidad}')
+            lineas.append(f'{self.nombre}_sum{{{etiqueta}}} {suma}')
+            lineas.append(f'{self.nombre}_count{{{etiqueta}}} {cantidad}')
+
+        # Los percentiles se exportan como un summary aparte (Prometheus no permite mezclarlos)
+        lineas.append(f"# HELP {self.nombre}_percentil {self.ayuda} (últimas {VENTANA_PERCENTILES} observaciones)")
+        lineas.append(f"# TYPE {self.nombre}_percentil summary")
+        for valor in sorted(series):
+            for q, segundos in self.percentiles(valor).items():
+                lineas.append(f'{self.nombre}_percentil{{{self.etiqueta}="{valor}",quantile="{q}"}} {segundos}')
+        return lineas
+
+
+class Contador:
+    def __init__(self, nombre, ayuda, etiqueta):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiqueta = etiqueta
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, valor_etiqueta, cantidad=1):
+        with self._lock:
+            self._valores[valor_etiqueta] = self._valores.get(valor_etiqueta, 0) + cantidad
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        with self._lock:
+            valores = dict(self._valores)
+        for valor, cantidad in sorted(valores.items()):
+            lineas.append(f'{self.nombre}{{{self.etiqueta}="{valor}"}} {cantidad}')
+        return lineas
+
+
+ETAPAS = Histograma('expedientes_etapa_duracion_segundos', 'Duración de cada etapa del procesamiento', 'etapa')
+REQUESTS = Histograma('expedientes_request_duracion_segundos', 'Duración de los requests HTTP por endpoint', 'endpoint')
+ERRORES_SOAP = Contador('expedientes_errores_soap_total', 'Errores al consultar el servicio SOAP por tipo', 'tipo')
+
+# Funciones que devuelven líneas adicionales (p. ej. estadísticas de la caché)
+_exportadores = []
+
+
+def registrar_exportador(funcion):
+    _exportadores.append(funcion)
+
+
+def lineas_metrica(nombre, ayuda, valores, tipo='gauge'):
+    """
+    Líneas de una métrica simple para los exportadores
+    Args:
+        valores: Un número, o un dict {etiquetas (str, p. ej. 'estado="abierto"'): número}
+    """
+    lineas = [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} {tipo}"]
+    if not isinstance(valores, dict):
+        valores = {'': valores}
+    for etiquetas, valor in valores.items():
+        lineas.append(f"{nombre}{{{etiquetas}}} {valor}" if etiquetas else f"{nombre} {valor}")
+    return lineas
+
+
+def observar(etapa, segundos):
+    ETAPAS.observar(etapa, segundos)
+    perfil = _perfil.get()
+    if perfil is not None:
+        perfil.append((etapa, segundos))
+
+
+@contextmanager
+def medir(etapa):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        observar(etapa, time.perf_counter() - inicio)
+
+
+def registrar_error(error):
+    ERRORES_SOAP.incrementar(type(error).__name__)
+
+
+def activar_perfil(perfil=None):
+    """
+    Activa el perfil en el contexto actual (request, hilo o tarea asyncio)
+    Returns:
+        tuple: (lista donde se acumulan (etapa, segundos), token para desactivar_perfil)
+    """
+    perfil = [] if perfil is None else perfil
+    return perfil, _perfil.set(perfil)
+
+
+def desactivar_perfil(token):
+    """
+    Vuelve al perfil que había antes de activar_perfil. Hace falta en los hilos que
+    se reutilizan entre requests (gthread), que si no heredarían el perfil anterior.
+    """
+    try:
+        _perfil.reset(token)
+    except ValueError:
+        # El token es de otro contexto (p. ej. una respuesta en streaming terminada
+        # en otro hilo): basta con no dejar un perfil activo en este
+        _perfil.set(None)
+
+
+def perfil_actual():
+    return _perfil.get()
+
+
+def server_timing(perfil):
+    """
+    Resume un perfil en el formato del encabezado Server-Timing (duraciones en ms)
+    """
+    totales = {}
+    for etapa, segundos in perfil:
+        total, cantidad = totales.get(etapa, (0.0, 0))
+        totales[etapa] = (total + segundos, cantidad + 1)
+    return ', '.join(
+        f'{etapa};dur={total * 1000:.1f};desc="{cantidad}x"' for etapa, (total, cantidad) in totales.items()
+    )
+
+
+def exportar():
+    lineas = ETAPAS.exportar() + REQUESTS.exportar() + ERRORES_SOAP.exportar()
+    for funcion in _exportadores:
+        lineas.extend(funcion())
+    return '\n'.join(lineas) + '\n'
@@ -0,0 +1,504 @@
+"""
+Motor asíncrono para consultas en lote.
+
+Las consultas se hacen con el cliente asíncrono de zeep (httpx) dentro de un
+único event loop por proceso, de modo que todas las consultas en lote que
+lleguen en paralelo comparten:
+  - un control de concurrencia AIMD que sube la cantidad de consultas
+    simultáneas mientras el servicio responde bien y la reduce a la mitad
+    ante errores o latencias altas, y
+  - un limitador de tasa global (consultas por segundo). Con varios workers
+    de gunicorn el límite se comparte entre todos los procesos a través de
+    una base SQLite (BATCH_RATE_LIMIT_DB).
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from zeep import AsyncClient
+from zeep.exceptions import Fault
+from zeep.transports import AsyncTransport
+
+import metricas
+from recursos import ConexionPorHilo
+from soap_client import VUELO_INTERRUMPIDO, obtener_cliente, registrar_respuesta
+from transporte import CircuitoAbierto, crear_cliente_httpx, es_error_transitorio, llamar_con_reintentos_async
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 1000))
+BATCH_MIN_CONCURRENCY = int(os.environ.get('BATCH_MIN_CONCURRENCY', 1))
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', 20))
+BATCH_INITIAL_CONCURRENCY = int(os.environ.get('BATCH_INITIAL_CONCURRENCY', 5))
+# Consultas por segundo hacia el Poder Judicial, sumando todos los lotes de todos los workers
+BATCH_RATE_LIMIT = float(os.environ.get('BATCH_RATE_LIMIT', 10))
+# Base donde los workers comparten el limitador de tasa. Vacío para un límite por
+# proceso (con N workers el total pasa a ser N * BATCH_RATE_LIMIT).
+BATCH_RATE_LIMIT_DB = os.environ.get(
+    'BATCH_RATE_LIMIT_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'limite_tasa.db')
+)
+# Latencia por encima de la cual se considera que el servicio está saturado
+BATCH_TARGET_LATENCY = float(os.environ.get('BATCH_TARGET_LATENCY', 2.0))
+# Segundos que un request espera un lote (o, en consultar_iter, el siguiente resultado)
+# antes de abandonarlo, para que un event loop trabado no deje hilos colgados para siempre
+BATCH_TIMEOUT = float(os.environ.get('BATCH_TIMEOUT', 600))
+# Intervalo máximo entre sondeos del bloqueo entre procesos de un IUE
+BLOQUEO_ESPERA_MAXIMA = 0.2
+
+
+class ControlConcurrencia:
+    """
+    Limita las consultas simultáneas con un esquema AIMD
+    (incremento aditivo, disminución multiplicativa).
+    """
+
+    def __init__(self, minimo, maximo, inicial, latencia_objetivo):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.limite = float(max(minimo, min(inicial, maximo)))
+        self.latencia_objetivo = latencia_objetivo
+        self.en_curso = 0
+        self._condicion = asyncio.Condition()
+        self._ultima_reduccion = 0.0
+
+    async def adquirir(self):
+        async with self._condicion:
+            await self._condicion.wait_for(lambda: self.en_curso < int(self.limite))
+            self.en_curso += 1
+
+    async def liberar(self, latencia, error):
+        """
+        Args:
+            latencia (float): Duración de la consulta, o None si no se llegó a consultar
+                al servicio (el límite no se modifica)
+            error (bool): Si la consulta indica que el servicio está saturado
+        """
+        async with self._condicion:
+            self.en_curso -= 1
+            if latencia is None:
+                self._condicion.notify_all()
+                return
+            ahora = time.monotonic()
+            if error or latencia > self.latencia_objetivo:
+                # Como mucho una reducción por ventana, para no colapsar a 1 por una ráfaga de errores
+                if ahora - self._ultima_reduccion > self.latencia_objetivo:
+                    self.limite = max(self.minimo, self.limite / 2)
+                    self._ultima_reduccion = ahora
+                    logger.info(f"Concurrencia del lote reducida a {int(self.limite)}")
+            else:
+                # Aproximadamente +1 por cada ventana completa de respuestas correctas
+                self.limite = min(self.maximo, self.limite + 1 / self.limite)
+            self._condicion.notify_all()
+
+
+class LimitadorTasa:
+    """
+    Token bucket: permite como mucho `por_segundo` consultas por segundo,
+    con ráfagas de hasta `rafaga` consultas.
+    """
+
+    def __init__(self, por_segundo, rafaga=None):
+        self.por_segundo = por_segundo
+        self.capacidad = rafaga or max(1.0, por_segundo)
+        self.tokens = self.capacidad
+        self._ultimo = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def esperar(self):
+        if self.por_segundo <= 0:
+            return
+        # El lock mantiene el orden de llegada entre los que esperan
+        async with self._lock:
+            await self._esperar_token()
+
+    async def _esperar_token(self):
+        while True:
+            ahora = time.monotonic()
+            self.tokens = min(self.capacidad, self.tokens + (ahora - self._ultimo) * self.por_segundo)
+            self._ultimo = ahora
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.por_segundo)
+
+
+class LimitadorTasaCompartido(LimitadorTasa):
+    """
+    Token bucket guardado en SQLite y compartido por todos los procesos que usan
+    la misma base, para que el límite sea el total de los workers y no el de
+    cada uno. Si la base falla se sigue con el bucket local del proceso.
+    """
+
+    def __init__(self, por_segundo, ruta_db=BATCH_RATE_LIMIT_DB, rafaga=None):
+        super().__init__(por_segundo, rafaga)
+        self.ruta_db = ruta_db
+        self._conexion = ConexionPorHilo(self.ruta_db)
+        # Hilo propio para la transacción del bucket: en el executor por defecto del loop
+        # quedaría en cola detrás de cualquier tarea lenta. Basta uno, porque esperar()
+        # ya deja pasar de a un pedido por vez
+        self._ejecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='limite-tasa')
+        with self._conexion() as conexion:
+            conexion.execute('''
+                CREATE TABLE IF NOT EXISTS limite_tasa (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    tokens REAL NOT NULL,
+                    ultimo REAL NOT NULL
+                )
+            ''')
+
+    def _tomar(self):
+        """
+        Toma un token del bucket compartido
+        Returns:
+            float: 0 si se tomó el token; si no, segundos a esperar antes de reintentar
+        """
+        conexion = self._conexion()
+        # IMMEDIATE: leer y descontar tokens sin que otro proceso escriba en el medio
+        conexion.execute('BEGIN IMMEDIATE')
+        try:
+            ahora = time.time()
+            fila = conexion.execute('SELECT tokens, ultimo FROM limite_tasa WHERE id = 1').fetchone()
+            if fila is None:
+                tokens = self.capacidad
+            else:
+                tokens = min(self.capacidad, fila[0] + max(0.0, ahora - fila[1]) * self.por_segundo)
+            espera = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                espera = (1 - tokens) / self.por_segundo
+            conexion.execute(
+                'INSERT OR REPLACE INTO limite_tasa (id, tokens, ultimo) VALUES (1, ?, ?)', (tokens, ahora)
+            )
+            conexion.commit()
+        except BaseException:
+            conexion.rollback()
+            raise
+        return espera
+
+    async def _esperar_token(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                espera = await loop.run_in_executor(self._ejecutor, self._tomar)
+            except sqlite3.Error as e:
+                logger.warning(f"Limitador de tasa compartido no disponible, se usa el del proceso: {e}")
+                return await super()._esperar_token()
+            if espera <= 0:
+                return
+            await asyncio.sleep(espera)
+
+
+class MotorLote:
+    def __init__(self, cliente, min_concurrencia=BATCH_MIN_CONCURRENCY, max_concurrencia=BATCH_MAX_CONCURRENCY,
+                 concurrencia_inicial=BATCH_INITIAL_CONCURRENCY, tasa=BATCH_RATE_LIMIT,
+                 latencia_objetivo=BATCH_TARGET_LATENCY, timeout=BATCH_TIMEOUT):
+        """
+        Args:
+            cliente (ConsultaExpedientes): Cliente sincrónico del que se reutilizan el WSDL
+                ya parseado, la caché de resultados y el procesamiento de respuestas
+            tasa (float): Consultas por segundo como máximo (0 para no limitar)
+            timeout (float): Segundos que consultar() espera el lote completo
+        """
+        self.cliente = cliente
+        self.timeout = timeout
+        self.max_concurrencia = max_concurrencia
+        self.control = ControlConcurrencia(min_concurrencia, max_concurrencia, concurrencia_inicial, latencia_objetivo)
+        self.limitador = self._crear_limitador(tasa)
+        self._soap = None
+        self._loop = asyncio.new_event_loop()
+        # Los resultados se guardan (caché SQLite, índice, historial) en un hilo aparte
+        # para no frenar el event loop
+        self._escritor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='motor-lote-escritor')
+        self._hilo = threading.Thread(target=self._loop.run_forever, name='motor-lote', daemon=True)
+        self._hilo.start()
+
+    @staticmethod
+    def _crear_limitador(tasa):
+        if tasa > 0 and BATCH_RATE_LIMIT_DB:
+            try:
+                return LimitadorTasaCompartido(tasa, BATCH_RATE_LIMIT_DB)
+            except sqlite3.Error as e:
+                logger.warning(f"No se pudo abrir {BATCH_RATE_LIMIT_DB}, el límite de tasa será por proceso: {e}")
+        return LimitadorTasa(tasa)
+
+    def _cliente_async(self):
+        if self._soap is None:
+            transporte = AsyncTransport(client=crear_cliente_httpx(pool=self.max_concurrencia))
+            # Se reutiliza el WSDL ya parseado por el cliente sincrónico
+            self._soap = AsyncClient(wsdl=self.cliente.client.wsdl, transport=transporte)
+        return self._soap
+
+    def consultar(self, iues, usar_cache=True):
+        """
+        Consulta una lista de IUEs y bloquea hasta tener todos los resultados
+        Args:
+            iues (list): IUEs a consultar
+            usar_cache (bool): Si es False se saltea la caché de resultados
+        Returns:
+            list: Resultados en el mismo orden que `iues`
+        Raises:
+            TimeoutError: Si el lote no terminó en `timeout` segundos (se cancela)
+        """
+        futuro = asyncio.run_coroutine_threadsafe(
+            self._con_perfil(self.consultar_async(iues, usar_cache), metricas.perfil_actual()), self._loop
+        )
+        try:
+            return futuro.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            futuro.cancel()
+            raise TimeoutError(f"El lote de {len(iues)} expedientes no terminó en {self.timeout:g} s")
+
+    def consultar_iter(self, iues, usar_cache=True):
+        """
+        Igual que consultar() pero genera los resultados a medida que se completan
+        Yields:
+            tuple: (posición en `iues`, resultado)
+        Raises:
+            TimeoutError: Si pasan `timeout` segundos sin ningún resultado nuevo
+        """
+        cola = queue.Queue()
+
+        async def ejecutar():
+            async def consultar_y_encolar(indice, iue):
+                cola.put((indice, await self.consultar_uno(iue, usar_cache)))
+            try:
+                await asyncio.gather(*(consultar_y_encolar(i, iue) for i, iue in enumerate(iues)))
+            finally:
+                cola.put(None)
+
+        futuro = asyncio.run_coroutine_threadsafe(self._con_perfil(ejecutar(), metricas.perfil_actual()), self._loop)
+        try:
+            while True:
+                try:
+                    item = cola.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"El lote no devolvió resultados en {self.timeout:g} s")
+                if item is None:
+                    break
+                yield item
+        finally:
+            # Si el consumidor abandona (p. ej. el navegador cerró la conexión) se cancela el resto
+            futuro.cancel()
+
+    @staticmethod
+    async def _con_perfil(corrutina, perfil=None):
+        # Las tareas del loop no heredan el contexto del hilo que las programa:
+        # el perfil del request, si lo hay, se activa en la tarea
+        if perfil is not None:
+            metricas.activar_perfil(perfil)
+        return await corrutina
+
+    async def consultar_async(self, iues, usar_cache=True):
+        return await asyncio.gather(*(self.consultar_uno(iue, usar_cache) for iue in iues))
+
+    async def consultar_uno(self, iue, usar_cache=True):
+        """
+        Consulta un IUE. Nunca lanza excepciones: los errores se devuelven como resultado.
+        """
+        try:
+            iue_limpio = self.cliente._limpiar_iue(iue)
+        except ValueError as e:
+            return _resultado_error(iue, str(e))
+
+        cache = self.cliente.cache
+        if usar_cache and cache is not None:
+            resultado = cache.obtener(iue_limpio)
+            if resultado is not None:
+                return resultado
+
+        # Si el mismo IUE ya se está consultando (en este lote, en otro o desde una
+        # consulta individual) se espera ese resultado en lugar de repetir la consulta
+        try:
+            while True:
+                futuro, lider = self.cliente._unirse(iue_limpio)
+                if lider:
+                    break
+                resultado = await asyncio.wrap_future(futuro)
+                if resultado is not VUELO_INTERRUMPIDO:
+                    return resultado
+            try:
+                resultado = await self._consultar_servicio(iue_limpio, usar_cache)
+            except Exception as e:
+                self.cliente._terminar_vuelo(iue_limpio, futuro, error=e)
+                raise
+            except BaseException:
+                self.cliente._terminar_vuelo(iue_limpio, futuro, resultado=VUELO_INTERRUMPIDO)
+                raise
+            self.cliente._terminar_vuelo(iue_limpio, futuro, resultado=resultado)
+            return resultado
+        except CircuitoAbierto as e:
+            return self._resultado_sin_servicio(iue_limpio, str(e))
+        except Fault as e:
+            logger.error(f"Error SOAP consultando {iue_limpio}: {str(e)}")
+            return _resultado_error(iue_limpio, f"Error en la consulta: {str(e)}")
+        except Exception as e:
+            logger.error(f"Error consultando {iue_limpio}: {str(e)}")
+            if es_error_transitorio(e):
+                return self._resultado_sin_servicio(iue_limpio, str(e) or type(e).__name__)
+            return _resultado_error(iue_limpio, str(e) or type(e).__name__)
+
+    async def _consultar_servicio(self, iue_limpio, usar_cache):
+        """
+        Consulta el servicio (con el límite de concurrencia y de tasa) y guarda el resultado.
+        El bloqueo entre procesos se pide recién con el lugar de concurrencia y el primer
+        token de tasa ya obtenidos, y se espera sin ocupar hilos: quien tiene un bloqueo
+        nunca queda esperando detrás de quienes esperan un bloqueo
+        Raises:
+            Exception: Los errores de la consulta, sin convertir
+        """
+        await self.control.adquirir()
+        en_control = True
+        bloqueo = self.cliente.bloqueo
+        descriptor = None
+        # Latencia de la última llamada al servicio, sin contar la espera del limitador
+        # de tasa; None mientras no se llamó
+        latencia = None
+        try:
+            await self.limitador.esperar()
+            token_disponible = True
+            if bloqueo is not None:
+                descriptor, espero = await _adquirir_bloqueo(bloqueo, iue_limpio)
+                cache = self.cliente.cache
+                if espero and usar_cache and cache is not None:
+                    # Otro worker acaba de consultar este IUE
+                    resultado = cache.obtener(iue_limpio)
+                    if resultado is not None:
+                        return resultado
+
+            async def llamar():
+                nonlocal latencia, token_disponible
+                # El primer intento usa el token ya obtenido; los reintentos piden otro
+                if token_disponible:
+                    token_disponible = False
+                else:
+                    await self.limitador.esperar()
+                inicio = time.monotonic()
+                try:
+                    return await self._cliente_async().service.consultaIUE(iue=iue_limpio)
+                finally:
+                    latencia = time.monotonic() - inicio
+                    metricas.observar('soap', latencia)
+
+            error = False
+            try:
+                response = await llamar_con_reintentos_async(llamar, self.cliente.circuito)
+            except Exception as e:
+                # Sólo los errores de red o del servidor indican saturación: un Fault es
+                # una respuesta normal del servicio
+                error = es_error_transitorio(e)
+                raise
+            except BaseException:
+                # Cancelación (p. ej. el cliente de /stream se desconectó): no dice nada
+                # del servicio, se libera el lugar sin tocar el límite
+                latencia = None
+                raise
+            finally:
+                en_control = False
+                await self.control.liberar(latencia, error)
+
+            registrar_respuesta(iue_limpio, response)
+            try:
+                with metricas.medir('parseo'):
+                    resultado = self.cliente._procesar_respuesta(iue_limpio, response)
+            except Exception as e:
+                logger.error(f"Error procesando la respuesta de {iue_limpio}: {str(e)}")
+                raise RuntimeError("Error al procesar la consulta") from e
+            # Antes de soltar el bloqueo, para que quien lo espera lo encuentre en la caché
+            await self._loop.run_in_executor(self._escritor, self.cliente._guardar_resultado, iue_limpio, resultado)
+            return resultado
+        finally:
+            if descriptor is not None:
+                bloqueo.liberar(descriptor)
+            if en_control:
+                await self.control.liberar(None, False)
+
+    def _resultado_sin_servicio(self, iue_limpio, mensaje):
+        """
+        Con el servicio caído se devuelve el último resultado conocido, si lo hay
+        """
+        cache = self.cliente.cache
+        vencido = cache.obtener_vencido(iue_limpio) if cache is not None else None
+        if vencido is not None:
+            return vencido
+        return _resultado_error(iue_limpio, mensaje)
+
+    def cerrar(self):
+        if self._soap is not None:
+            asyncio.run_coroutine_threadsafe(self._soap.transport.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._escritor.shutdown(wait=True)
+        if isinstance(self.limitador, LimitadorTasaCompartido):
+            self.limitador._ejecutor.shutdown(wait=True)
+
+
+async def _adquirir_bloqueo(bloqueo, iue_limpio):
+    """
+    Espera el bloqueo entre procesos de un IUE sondeándolo (flock sin bloquear) desde
+    el event loop. Esperarlo con flock bloqueante en un executor deja hilos trabados
+    mientras otro IUE que comparte archivo de bloqueo termina su consulta
+    Returns:
+        tuple: (descriptor para liberar(), si hubo que esperar a otro proceso)
+    """
+    descriptor = bloqueo.abrir(iue_limpio)
+    try:
+        if bloqueo.intentar(descriptor):
+            return descriptor, False
+        espera = 0.01
+        while True:
+            await asyncio.sleep(espera)
+            if bloqueo.intentar(descriptor):
+                return descriptor, True
+            espera = min(espera * 2, BLOQUEO_ESPERA_MAXIMA)
+    except BaseException:
+        os.close(descriptor)
+        raise
+
+
+def _resultado_error(iue, mensaje):
+    return {
+        'expediente': iue,
+        'origen': 'Error en la consulta',
+        'caratula': mensaje,
+        'error': True
+    }
+
+
+_motor = None
+_motor_pid = None
+_motor_lock = threading.Lock()
+
+
+def _exportar_metricas():
+    motor = _motor
+    if motor is None or _motor_pid != os.getpid():
+        return []
+    return (
+        metricas.lineas_metrica('expedientes_lote_concurrencia_limite', 'Límite de concurrencia actual (AIMD)',
+                                int(motor.control.limite))
+        + metricas.lineas_metrica('expedientes_lote_consultas_en_curso', 'Consultas de lote en curso',
+                                  motor.control.en_curso)
+    )
+
+
+metricas.registrar_exportador(_exportar_metricas)
+
+
+def obtener_motor():
+    """
+    Devuelve el motor de lotes del proceso. Se recrea si el proceso fue
+    forkeado (el hilo del event loop no sobrevive al fork).
+    """
+    global _motor, _motor_pid
+    if _motor is None or _motor_pid != os.getpid():
+        with _motor_lock:
+            if _motor is None or _motor_pid != os.getpid():
+                _motor = MotorLote(obtener_cliente())
+                _motor_pid = os.getpid()
+    return _motor
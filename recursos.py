@@ -0,0 +1,68 @@
+"""
+Piezas compartidas por los almacenes SQLite y los servicios que consultan en
+lote: la conexión por hilo a una base en modo WAL y el acceso perezoso al
+motor de lotes del proceso.
+"""
+import os
+import sqlite3
+import threading
+
+
+class ConexionPorHilo:
+    """
+    Conexión a una base SQLite, una por hilo: sqlite3 no permite compartir
+    conexiones entre hilos. Se llama como función para obtener la del hilo actual,
+    creándola (y la carpeta de la base) la primera vez.
+    """
+
+    def __init__(self, ruta_db, filas=False, pragmas=(), **opciones):
+        """
+        Args:
+            ruta_db (str): Ruta del archivo de la base
+            filas (bool): Si las consultas devuelven sqlite3.Row en lugar de tuplas
+            pragmas: PRAGMAs adicionales a journal_mode=WAL, p. ej. ('synchronous=NORMAL',)
+            **opciones: Argumentos de sqlite3.connect (timeout por defecto, 10 s)
+        """
+        self.ruta_db = ruta_db
+        self.filas = filas
+        self.pragmas = ('journal_mode=WAL',) + tuple(pragmas)
+        self.opciones = {'timeout': 10, **opciones}
+        self._local = threading.local()
+
+    def __call__(self):
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            directorio = os.path.dirname(self.ruta_db)
+            if directorio:
+                os.makedirs(directorio, exist_ok=True)
+            conexion = sqlite3.connect(self.ruta_db, **self.opciones)
+            if self.filas:
+                conexion.row_factory = sqlite3.Row
+            for pragma in self.pragmas:
+                conexion.execute(f'PRAGMA {pragma}')
+            self._local.conexion = conexion
+        return conexion
+
+    def cerrar(self):
+        """
+        Cierra la conexión del hilo actual, si la hay; la próxima llamada abre otra
+        """
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is not None:
+            del self._local.conexion
+            conexion.close()
+
+
+def propiedad_motor():
+    """
+    Propiedad `motor` de las clases que consultan en lote: el motor recibido en el
+    constructor (guardado en `_motor`) o, si no se recibió ninguno, el compartido del
+    proceso. motor_lote se importa recién al primer uso porque carga el cliente
+    asíncrono de zeep.
+    """
+    def motor(self):
+        if self._motor is None:
+            from motor_lote import obtener_motor
+            self._motor = obtener_motor()
+        return self._motor
+    return property(motor)
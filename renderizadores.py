@@ -0,0 +1,190 @@
+"""
+Exportación de resultados a archivos, con renderizadores intercambiables.
+
+Un renderizador escribe una lista de resultados (los diccionarios de
+consultar_expediente) en un archivo binario. Se incluyen PDF (xhtml2pdf),
+CSV y JSON; otros backends se agregan con registrar_renderizador().
+
+El PDF se genera por partes de pocos expedientes: cada parte se convierte
+por separado (opcionalmente en un pool de procesos) y las partes se unen
+al final, así xhtml2pdf nunca procesa el HTML del lote completo.
+"""
+import csv
+import io
+import json
+import os
+
+# Expedientes por conversión de xhtml2pdf. De a uno, cada parte repite fuentes y
+# estilos y la unión cuesta más: en bench_renderizadores (40 expedientes de 40
+# movimientos) salen 4.7 páginas/s de a uno, 5.5 de a 10 y 5.7 con el lote completo
+# en una sola conversión. De a 10 se está cerca del lote completo sin que xhtml2pdf
+# tenga que procesar el HTML de todo el lote
+PDF_CHUNK_SIZE = int(os.environ.get('PDF_CHUNK_SIZE', 10))
+
+CAMPOS_CSV = ('expediente', 'caratula', 'origen', 'fecha', 'tipo', 'decreto', 'vencimiento', 'sede')
+
+
+def html_a_pdf(html, destino=None):
+    """
+    Convierte HTML a PDF con xhtml2pdf. Puede ejecutarse en un proceso del pool.
+    Args:
+        destino: Archivo binario donde escribir; si es None se devuelven los bytes
+    Raises:
+        RuntimeError: Si xhtml2pdf informa errores
+    """
+    from xhtml2pdf import pisa
+
+    salida = io.BytesIO() if destino is None else destino
+    pdf = pisa.pisaDocument(io.BytesIO(html.encode('UTF-8')), salida)
+    if pdf.err:
+        raise RuntimeError("Error al generar PDF")
+    return salida.getvalue() if destino is None else None
+
+
+class Renderizador:
+    """
+    Interfaz de los renderizadores
+    """
+    nombre = None
+    extension = None
+    mimetype = None
+
+    def __init__(self, renderizar_html=None, **opciones):
+        """
+        Args:
+            renderizar_html (callable): Arma el HTML de una lista de resultados, para
+                los formatos que parten de la plantilla
+            opciones: Opciones propias del renderizador (se ignoran las desconocidas)
+        """
+        self.renderizar_html = renderizar_html
+
+    def escribir(self, resultados, destino, **contexto):
+        """
+        Args:
+            resultados (list): Resultados de consultar_expediente
+            destino: Archivo binario abierto para escritura
+            contexto: Datos de la exportación (iue, sede, desde, hasta, anio...)
+        """
+        raise NotImplementedError
+
+
+class RenderizadorPDF(Renderizador):
+    nombre = 'pdf'
+    extension = 'pdf'
+    mimetype = 'application/pdf'
+
+    def __init__(self, renderizar_html, ejecutor=None, expedientes_por_parte=PDF_CHUNK_SIZE, en_vuelo=4, **opciones):
+        """
+        Args:
+            renderizar_html (callable): Recibe (resultados, **contexto) y devuelve el HTML
+                de esos expedientes. Cada parte es una página completa de la plantilla,
+                así que el encabezado del documento se repite al comienzo de cada parte
+            ejecutor (Executor): Pool donde convertir las partes en paralelo, o None
+                para convertirlas en el hilo actual (si se indica, se usa aunque haya
+                una sola parte)
+            expedientes_por_parte (int): Expedientes por cada conversión de xhtml2pdf
+            en_vuelo (int): Partes enviadas al pool sin esperar su resultado
+        """
+        self.renderizar_html = renderizar_html
+        self.ejecutor = ejecutor
+        self.expedientes_por_parte = max(1, expedientes_por_parte)
+        self.en_vuelo = max(1, en_vuelo)
+
+    def escribir(self, resultados, destino, **contexto):
+        partes = [resultados[i:i + self.expedientes_por_parte]
+                  for i in range(0, len(resultados), self.expedientes_por_parte)] or [[]]
+        if len(partes) == 1:
+            if self.ejecutor is None:
+                html_a_pdf(self._html(partes, 0, contexto), destino)
+            else:
+                # En el pool aunque sea una sola parte: quien llama (p. ej. el hilo de
+                # un worker web) no debe quedar ocupado con xhtml2pdf
+                destino.write(self.ejecutor.submit(html_a_pdf, self._html(partes, 0, contexto)).result())
+            return
+
+        from pypdf import PdfReader, PdfWriter
+
+        documento = PdfWriter()
+        for pdf in self._convertir(partes, contexto):
+            documento.append(PdfReader(io.BytesIO(pdf)))
+        documento.write(destino)
+
+    def _html(self, partes, indice, contexto):
+        return self.renderizar_html(partes[indice], **contexto)
+
+    def _convertir(self, partes, contexto):
+        """
+        Genera el PDF de cada parte, en orden. Con un pool se mantienen pocas partes
+        en vuelo para no acumular el HTML de todo el lote.
+        """
+        if self.ejecutor is None:
+            for indice in range(len(partes)):
+                yield html_a_pdf(self._html(partes, indice, contexto))
+            return
+        en_vuelo = []
+        for indice in range(len(partes)):
+            en_vuelo.append(self.ejecutor.submit(html_a_pdf, self._html(partes, indice, contexto)))
+            if len(en_vuelo) >= self.en_vuelo:
+                yield en_vuelo.pop(0).result()
+        for futuro in en_vuelo:
+            yield futuro.result()
+
+
+class RenderizadorCSV(Renderizador):
+    """
+    Una fila por movimiento (los expedientes sin movimientos ocupan una fila)
+    """
+    nombre = 'csv'
+    extension = 'csv'
+    mimetype = 'text/csv; charset=utf-8'
+
+    def escribir(self, resultados, destino, **contexto):
+        texto = io.TextIOWrapper(destino, encoding='utf-8', newline='', write_through=True)
+        try:
+            escritor = csv.DictWriter(texto, fieldnames=CAMPOS_CSV, extrasaction='ignore')
+            escritor.writeheader()
+            for resultado in resultados:
+                expediente = {campo: resultado.get(campo) for campo in ('expediente', 'caratula', 'origen')}
+                movimientos = resultado.get('movimientos') or [{}]
+                for movimiento in movimientos:
+                    escritor.writerow({**expediente, **{campo: movimiento.get(campo) for campo in CAMPOS_CSV[3:]}})
+        finally:
+            # Se suelta el archivo sin cerrarlo: lo cierra quien lo abrió
+            texto.detach()
+
+
+class RenderizadorJSON(Renderizador):
+    nombre = 'json'
+    extension = 'json'
+    mimetype = 'application/json'
+
+    def escribir(self, resultados, destino, **contexto):
+        # Se escribe expediente por expediente para no armar todo el documento en memoria
+        destino.write(b'[')
+        for i, resultado in enumerate(resultados):
+            if i:
+                destino.write(b',\n')
+            destino.write(json.dumps(resultado, ensure_ascii=False, default=str).encode('utf-8'))
+        destino.write(b']\n')
+
+
+RENDERIZADORES = {clase.nombre: clase for clase in (RenderizadorPDF, RenderizadorCSV, RenderizadorJSON)}
+
+
+def registrar_renderizador(clase):
+    """
+    Agrega un backend de exportación (p. ej. un renderizador de PDF más rápido)
+    """
+    RENDERIZADORES[clase.nombre] = clase
+    return clase
+
+
+def obtener_renderizador(nombre, renderizar_html=None, **opciones):
+    """
+    Raises:
+        ValueError: Si no hay un renderizador con ese nombre
+    """
+    clase = RENDERIZADORES.get(nombre)
+    if clase is None:
+        raise ValueError(f"Formato de exportación no válido: {nombre}")
+    return clase(renderizar_html, **opciones)
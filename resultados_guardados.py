@@ -0,0 +1,110 @@
+"""
+Resultados ya consultados guardados bajo un token de vida corta, para que la
+exportación a PDF use lo que el usuario acaba de ver en lugar de volver a
+consultar el servicio del Poder Judicial.
+
+Se guardan comprimidos en SQLite (compartido por todos los workers de
+gunicorn), con vencimiento y un tamaño total máximo: al superarlo se
+descartan los más antiguos.
+"""
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import time
+import zlib
+
+from recursos import ConexionPorHilo
+
+logger = logging.getLogger(__name__)
+
+RESULT_SNAPSHOT_DB = os.environ.get(
+    'RESULT_SNAPSHOT_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'resultados_guardados.db')
+)
+RESULT_SNAPSHOT_TTL = int(os.environ.get('RESULT_SNAPSHOT_TTL', 30 * 60))
+RESULT_SNAPSHOT_MAX_BYTES = int(os.environ.get('RESULT_SNAPSHOT_MAX_BYTES', 100 * 1024 * 1024))
+
+
+class ResultadosGuardados:
+    def __init__(self, ruta_db=RESULT_SNAPSHOT_DB, ttl=RESULT_SNAPSHOT_TTL, max_bytes=RESULT_SNAPSHOT_MAX_BYTES):
+        self.ruta_db = ruta_db
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._conexion = ConexionPorHilo(self.ruta_db)
+        with self._conexion() as conexion:
+            # El tamaño total se lleva en `total` con triggers, para no sumar la tabla
+            # entera en cada guardar()
+            conexion.executescript('''
+                CREATE TABLE IF NOT EXISTS resultados_guardados (
+                    token TEXT PRIMARY KEY,
+                    datos BLOB NOT NULL,
+                    tamano INTEGER NOT NULL,
+                    creado REAL NOT NULL,
+                    expira REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS resultados_guardados_expira ON resultados_guardados (expira);
+                CREATE INDEX IF NOT EXISTS resultados_guardados_creado ON resultados_guardados (creado);
+                CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL);
+                INSERT OR IGNORE INTO total (id, bytes)
+                    SELECT 0, COALESCE(SUM(tamano), 0) FROM resultados_guardados;
+                CREATE TRIGGER IF NOT EXISTS resultados_guardados_alta AFTER INSERT ON resultados_guardados
+                BEGIN
+                    UPDATE total SET bytes = bytes + NEW.tamano WHERE id = 0;
+                END;
+                CREATE TRIGGER IF NOT EXISTS resultados_guardados_baja AFTER DELETE ON resultados_guardados
+                BEGIN
+                    UPDATE total SET bytes = bytes - OLD.tamano WHERE id = 0;
+                END;
+            ''')
+
+    def guardar(self, datos):
+        """
+        Args:
+            datos (dict): Resultados y parámetros de la consulta (serializable a JSON)
+        Returns:
+            str: Token con el que se recuperan, o None si no se pudieron guardar
+        """
+        token = secrets.token_urlsafe(12)
+        comprimido = zlib.compress(json.dumps(datos, ensure_ascii=False, default=str).encode('utf-8'), 6)
+        ahora = time.time()
+        try:
+            with self._conexion() as conexion:
+                conexion.execute(
+                    'INSERT INTO resultados_guardados (token, datos, tamano, creado, expira) VALUES (?, ?, ?, ?, ?)',
+                    (token, comprimido, len(comprimido), ahora, ahora + self.ttl)
+                )
+                self._recortar(conexion, ahora)
+        except sqlite3.Error as e:
+            logger.warning(f"No se pudieron guardar los resultados: {str(e)}")
+            return None
+        return token
+
+    def obtener(self, token):
+        if not token:
+            return None
+        try:
+            fila = self._conexion().execute(
+                'SELECT datos FROM resultados_guardados WHERE token = ? AND expira > ?', (token, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"No se pudieron leer los resultados guardados: {str(e)}")
+            return None
+        if fila is None:
+            return None
+        return json.loads(zlib.decompress(fila[0]))
+
+    def _recortar(self, conexion, ahora):
+        conexion.execute('DELETE FROM resultados_guardados WHERE expira <= ?', (ahora,))
+        total = conexion.execute('SELECT bytes FROM total WHERE id = 0').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Se descartan los más antiguos hasta volver a estar dentro del límite
+        descartar = []
+        for token, tamano in conexion.execute('SELECT token, tamano FROM resultados_guardados ORDER BY creado'):
+            if total <= self.max_bytes:
+                break
+            descartar.append((token,))
+            total -= tamano
+        conexion.executemany('DELETE FROM resultados_guardados WHERE token = ?', descartar)
@@ -0,0 +1,283 @@
+"""
+Seguimiento de expedientes: consulta periódicamente una lista de IUEs y
+avisa sólo de los movimientos nuevos.
+
+Por cada IUE se guarda (en SQLite) la huella de los movimientos ya vistos.
+Los expedientes con movimientos recientes se consultan más seguido que los
+inactivos, y cada movimiento nuevo queda registrado como evento de cambio.
+
+Uso:
+    python seguimiento.py agregar 2-1234/2024 "40 - 12 / 2023"
+    python seguimiento.py quitar 2-1234/2024
+    python seguimiento.py listar
+    python seguimiento.py ejecutar [--una-vez] [--intervalo 60]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from recursos import ConexionPorHilo, propiedad_motor
+from soap_client import ConsultaExpedientes, huella_movimiento, huella_movimientos
+
+logger = logging.getLogger(__name__)
+
+WATCHLIST_DB = os.environ.get(
+    'WATCHLIST_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'seguimiento.db')
+)
+# Cuántos expedientes se consultan como máximo en cada ronda
+WATCH_BATCH_SIZE = int(os.environ.get('WATCH_BATCH_SIZE', 200))
+
+HORA = 60 * 60
+DIA = 24 * HORA
+
+# Intervalo de consulta según la antigüedad del último cambio detectado:
+# (antigüedad máxima, intervalo). El último escalón aplica a todo lo demás.
+INTERVALOS = (
+    (7 * DIA, HORA),
+    (30 * DIA, 6 * HORA),
+    (None, DIA),
+)
+# Reintento tras un error de consulta
+INTERVALO_ERROR = 15 * 60
+
+
+def intervalo_para(ultimo_cambio, ahora):
+    """
+    Devuelve cada cuántos segundos conviene consultar un expediente según
+    cuándo fue su último cambio (None si nunca se detectó uno)
+    """
+    antiguedad = None if ultimo_cambio is None else ahora - ultimo_cambio
+    for maximo, intervalo in INTERVALOS:
+        if maximo is None or (antiguedad is not None and antiguedad <= maximo):
+            return intervalo
+    return INTERVALOS[-1][1]
+
+
+class Seguimiento:
+    def __init__(self, ruta_db=WATCHLIST_DB, motor=None):
+        """
+        Args:
+            ruta_db (str): Archivo SQLite con la lista de seguimiento y los eventos
+            motor (MotorLote): Motor con el que se consultan los expedientes
+                (por defecto el motor compartido del proceso)
+        """
+        self.ruta_db = ruta_db
+        self._motor = motor
+        self._conexion = ConexionPorHilo(self.ruta_db, filas=True)
+        with self._conexion() as conexion:
+            conexion.executescript('''
+                CREATE TABLE IF NOT EXISTS seguimiento (
+                    iue TEXT PRIMARY KEY,
+                    huella TEXT,
+                    vistos TEXT NOT NULL DEFAULT '[]',
+                    agregado REAL NOT NULL,
+                    ultima_consulta REAL,
+                    ultimo_cambio REAL,
+                    proxima_consulta REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS seguimiento_proxima ON seguimiento (proxima_consulta);
+                CREATE TABLE IF NOT EXISTS eventos (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    iue TEXT NOT NULL,
+                    detectado REAL NOT NULL,
+                    movimientos TEXT NOT NULL
+                );
+            ''')
+
+    motor = propiedad_motor()
+
+    def agregar(self, iues):
+        """
+        Agrega IUEs a la lista de seguimiento (los ya existentes se ignoran)
+        Returns:
+            list: IUEs normalizados
+        Raises:
+            ValueError: Si algún IUE no tiene un formato válido
+        """
+        limpios = [ConsultaExpedientes._limpiar_iue(iue) for iue in iues]
+        ahora = time.time()
+        with self._conexion() as conexion:
+            conexion.executemany(
+                'INSERT OR IGNORE INTO seguimiento (iue, agregado, proxima_consulta) VALUES (?, ?, ?)',
+                [(iue, ahora, ahora) for iue in limpios]
+            )
+        return limpios
+
+    def quitar(self, iues):
+        limpios = [ConsultaExpedientes._limpiar_iue(iue) for iue in iues]
+        with self._conexion() as conexion:
+            conexion.executemany('DELETE FROM seguimiento WHERE iue = ?', [(iue,) for iue in limpios])
+        return limpios
+
+    def listar(self):
+        filas = self._conexion().execute(
+            'SELECT iue, huella, agregado, ultima_consulta, ultimo_cambio, proxima_consulta '
+            'FROM seguimiento ORDER BY proxima_consulta'
+        ).fetchall()
+        return [dict(fila) for fila in filas]
+
+    def pendientes(self, limite=WATCH_BATCH_SIZE, ahora=None):
+        """
+        IUEs cuya próxima consulta ya venció, los más atrasados primero
+        """
+        ahora = time.time() if ahora is None else ahora
+        filas = self._conexion().execute(
+            'SELECT iue FROM seguimiento WHERE proxima_consulta <= ? ORDER BY proxima_consulta LIMIT ?',
+            (ahora, limite)
+        ).fetchall()
+        return [fila['iue'] for fila in filas]
+
+    def registrar(self, iue, resultado, ahora=None):
+        """
+        Compara el resultado de una consulta con lo ya visto del expediente
+        Returns:
+            list: Movimientos nuevos (vacía si no hubo cambios, en la primera
+                consulta del expediente o si la consulta falló)
+        """
+        ahora = time.time() if ahora is None else ahora
+        conexion = self._conexion()
+        fila = conexion.execute(
+            'SELECT huella, vistos, ultimo_cambio FROM seguimiento WHERE iue = ?', (iue,)
+        ).fetchone()
+        if fila is None:
+            return []
+
+        if resultado.get('error'):
+            with conexion:
+                conexion.execute(
+                    'UPDATE seguimiento SET ultima_consulta = ?, proxima_consulta = ? WHERE iue = ?',
+                    (ahora, ahora + INTERVALO_ERROR, iue)
+                )
+            return []
+
+        movimientos = resultado.get('movimientos') or []
+        huella = huella_movimientos(movimientos)
+        ultimo_cambio = fila['ultimo_cambio']
+        nuevos = []
+
+        if huella != fila['huella']:
+            vistos = set(json.loads(fila['vistos']))
+            huellas = [huella_movimiento(mov) for mov in movimientos]
+            # En la primera consulta sólo se toma la línea de base, sin emitir eventos
+            if fila['huella'] is not None:
+                nuevos = [mov for mov, h in zip(movimientos, huellas) if h not in vistos]
+            if nuevos:
+                ultimo_cambio = ahora
+            vistos.update(huellas)
+        else:
+            vistos = None
+
+        with conexion:
+            if vistos is None:
+                conexion.execute(
+                    'UPDATE seguimiento SET ultima_consulta = ?, proxima_consulta = ? WHERE iue = ?',
+                    (ahora, ahora + intervalo_para(ultimo_cambio, ahora), iue)
+                )
+            else:
+                conexion.execute(
+                    'UPDATE seguimiento SET huella = ?, vistos = ?, ultima_consulta = ?, ultimo_cambio = ?, '
+                    'proxima_consulta = ? WHERE iue = ?',
+                    (huella, json.dumps(sorted(vistos)), ahora, ultimo_cambio,
+                     ahora + intervalo_para(ultimo_cambio, ahora), iue)
+                )
+            if nuevos:
+                conexion.execute(
+                    'INSERT INTO eventos (iue, detectado, movimientos) VALUES (?, ?, ?)',
+                    (iue, ahora, json.dumps(nuevos, ensure_ascii=False, default=str))
+                )
+        return nuevos
+
+    def sondear(self, limite=WATCH_BATCH_SIZE):
+        """
+        Consulta los expedientes pendientes y registra los cambios
+        Returns:
+            list: Eventos de cambio ({'iue', 'detectado', 'movimientos'})
+        """
+        iues = self.pendientes(limite)
+        if not iues:
+            return []
+        logger.info(f"Consultando {len(iues)} expedientes en seguimiento")
+        eventos = []
+        resultados = self.motor.consultar(iues, usar_cache=False)
+        for iue, resultado in zip(iues, resultados):
+            ahora = time.time()
+            nuevos = self.registrar(iue, resultado, ahora)
+            if nuevos:
+                eventos.append({'iue': iue, 'detectado': ahora, 'movimientos': nuevos})
+        return eventos
+
+    def cambios(self, desde_id=0, limite=500):
+        """
+        Eventos de cambio posteriores a `desde_id`, para consumirlos como un cursor
+        """
+        filas = self._conexion().execute(
+            'SELECT id, iue, detectado, movimientos FROM eventos WHERE id > ? ORDER BY id LIMIT ?',
+            (desde_id, limite)
+        ).fetchall()
+        return [
+            {'id': fila['id'], 'iue': fila['iue'], 'detectado': fila['detectado'],
+             'movimientos': json.loads(fila['movimientos'])}
+            for fila in filas
+        ]
+
+    def ejecutar(self, intervalo=60, al_detectar=None):
+        """
+        Sondea indefinidamente, esperando `intervalo` segundos cuando no hay pendientes
+        """
+        while True:
+            eventos = self.sondear()
+            for evento in eventos:
+                if al_detectar is not None:
+                    al_detectar(evento)
+            if not eventos and not self.pendientes(1):
+                time.sleep(intervalo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seguimiento de movimientos nuevos de expedientes')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+    agregar = subparsers.add_parser('agregar', help='agregar IUEs a la lista de seguimiento')
+    agregar.add_argument('iues', nargs='+')
+    quitar = subparsers.add_parser('quitar', help='quitar IUEs de la lista de seguimiento')
+    quitar.add_argument('iues', nargs='+')
+    subparsers.add_parser('listar', help='mostrar la lista de seguimiento')
+    ejecutar = subparsers.add_parser('ejecutar', help='consultar los expedientes y emitir los cambios como JSON')
+    ejecutar.add_argument('--una-vez', action='store_true', help='hacer una sola ronda y salir')
+    ejecutar.add_argument('--intervalo', type=int, default=60, help='espera entre rondas sin pendientes (segundos)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    seguimiento = Seguimiento()
+
+    def imprimir(evento):
+        print(json.dumps(evento, ensure_ascii=False, default=str), flush=True)
+
+    try:
+        if args.comando == 'agregar':
+            for iue in seguimiento.agregar(args.iues):
+                print(iue)
+        elif args.comando == 'quitar':
+            for iue in seguimiento.quitar(args.iues):
+                print(iue)
+        elif args.comando == 'listar':
+            for fila in seguimiento.listar():
+                imprimir(fila)
+        elif args.una_vez:
+            for evento in seguimiento.sondear():
+                imprimir(evento)
+        else:
+            seguimiento.ejecutar(args.intervalo, al_detectar=imprimir)
+    except ValueError as ve:
+        print(f"Error: {ve}", file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,491 @@
+import concurrent.futures
+import hashlib
+import json
 import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: no hay bloqueo entre procesos
+    fcntl = None
 from zeep import Client
 from zeep.exceptions import TransportError, Fault
 import re
 
+import metricas
+from recursos import ConexionPorHilo
+from transporte import (
+    CircuitoAbierto, Circuito, crear_transporte, es_error_transitorio, llamar_con_reintentos
+)
+
 logger = logging.getLogger(__name__)
 
+# Patrón para validar IUE
+IUE_PATTERN = r'^\d{1,3}\s*-\s*\d+\s*/\s*\d{4}$'
+
+# URLs dentro de los campos de texto de la respuesta
+URL_PATTERN = re.compile(r'https?://[^\s<>"]+|www\.[^\s<>"]+')
+
+# Campos de un movimiento cuyo enlace se expone también como enlace_decreto
+CAMPOS_DECRETO = ('decreto', 'resolucion', 'sentencia')
+
+# Campos que identifican a un movimiento al calcular su huella
+CAMPOS_HUELLA = ('fecha', 'tipo', 'decreto', 'vencimiento', 'sede')
+
+# URL del servicio SOAP del Poder Judicial (SOAP_WSDL_URL permite apuntar a otro
+# servidor, p. ej. benchmarks/servidor_stub.py)
+WSDL_URL = os.environ.get('SOAP_WSDL_URL', 'http://www.expedientes.poderjudicial.gub.uy/wsConsultaIUE.php?wsdl')
+
+# Copia local del WSDL para no descargarlo ni depender de la red al arrancar
+WSDL_CACHE_PATH = os.environ.get(
+    'WSDL_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'wsConsultaIUE.wsdl')
+)
+WSDL_CACHE_TTL = int(os.environ.get('WSDL_CACHE_TTL', 24 * 60 * 60))
+
+# Tiempo mínimo entre intentos de refresco fallidos
+WSDL_REINTENTO_REFRESCO = 60
+
+# Fracción de las respuestas que se registran completas en el log (nivel DEBUG)
+SOAP_LOG_SAMPLE_RATE = float(os.environ.get('SOAP_LOG_SAMPLE_RATE', 0.01))
+
+# Caché de resultados por IUE. RESULT_CACHE_DB activa un segundo nivel en SQLite
+# compartido por todos los workers de gunicorn.
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 2048))
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 10 * 60))
+RESULT_CACHE_TTL_NO_ENCONTRADO = int(os.environ.get('RESULT_CACHE_TTL_NO_ENCONTRADO', 2 * 60))
+RESULT_CACHE_DB = os.environ.get('RESULT_CACHE_DB', '')
+# Tiempo durante el cual un resultado vencido se sirve si el servicio está caído
+RESULT_CACHE_STALE = int(os.environ.get('RESULT_CACHE_STALE', 24 * 60 * 60))
+
+# Directorio de los bloqueos con los que los workers de gunicorn evitan consultar a la
+# vez el mismo IUE (vacío para no usarlos). Requiere la caché persistente (RESULT_CACHE_DB).
+SOAP_SINGLE_FLIGHT_DIR = os.environ.get('SOAP_SINGLE_FLIGHT_DIR', '')
+
+# Resultado de una consulta compartida cuyo responsable se canceló: quienes la esperaban
+# la retoman en lugar de recibir un error que no es del servicio
+VUELO_INTERRUMPIDO = object()
+
+_cliente_compartido = None
+_cliente_lock = threading.Lock()
+
+
+def _exportar_metricas():
+    cliente = _cliente_compartido
+    if cliente is None:
+        return []
+    estado = cliente.circuito.estado
+    lineas = metricas.lineas_metrica(
+        'expedientes_circuito_estado', 'Estado del circuit breaker del servicio SOAP (1 = estado actual)',
+        {f'estado="{e}"': int(e == estado) for e in (Circuito.CERRADO, Circuito.ABIERTO, Circuito.SEMIABIERTO)}
+    )
+    if cliente.cache is not None:
+        estadisticas = cliente.cache.estadisticas()
+        for clave in ('hits', 'misses', 'evictions'):
+            lineas += metricas.lineas_metrica(
+                f'expedientes_cache_{clave}_total', f'{clave} de la caché de resultados', estadisticas[clave], 'counter'
+            )
+        lineas += metricas.lineas_metrica(
+            'expedientes_cache_items', 'Resultados en la caché en memoria', estadisticas['items']
+        )
+    return lineas
+
+
+metricas.registrar_exportador(_exportar_metricas)
+
+
+class BloqueoArchivos:
+    """
+    Bloqueos por clave entre procesos de la misma máquina, con flock sobre un
+    conjunto fijo de archivos (dos claves pueden compartir archivo; sólo implica
+    alguna espera de más)
+    """
+
+    ARCHIVOS = 1024
+
+    def __init__(self, directorio):
+        if fcntl is None:
+            raise RuntimeError("El bloqueo entre procesos no está disponible en esta plataforma")
+        self.directorio = directorio
+        os.makedirs(directorio, exist_ok=True)
+
+    def abrir(self, clave):
+        """
+        Abre (sin bloquearlo) el archivo de bloqueo de `clave`
+        Returns:
+            int: Descriptor para intentar() y liberar()
+        """
+        numero = int.from_bytes(hashlib.blake2b(clave.encode('utf-8'), digest_size=4).digest(), 'big') % self.ARCHIVOS
+        return os.open(os.path.join(self.directorio, f"{numero:04d}.lock"), os.O_CREAT | os.O_RDWR, 0o600)
+
+    def intentar(self, descriptor):
+        """
+        Toma el bloqueo si está libre, sin esperar
+        Returns:
+            bool: Si se obtuvo el bloqueo
+        """
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def adquirir(self, clave):
+        """
+        Bloquea hasta obtener el bloqueo de `clave`
+        Returns:
+            tuple: (descriptor para liberar(), si hubo que esperar a otro proceso)
+        """
+        descriptor = self.abrir(clave)
+        try:
+            if self.intentar(descriptor):
+                return descriptor, False
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            return descriptor, True
+        except BaseException:
+            os.close(descriptor)
+            raise
+
+    def liberar(self, descriptor):
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+        finally:
+            os.close(descriptor)
+
+
+class CacheResultados:
+    """
+    Caché de resultados de consultar_expediente con TTL, indexada por el IUE normalizado.
+    Tiene un nivel en memoria (LRU) y, opcionalmente, un nivel persistente en SQLite
+    que comparten todos los procesos que apunten al mismo archivo.
+    """
+
+    # Cada cuántas escrituras se purgan las entradas vencidas del nivel SQLite
+    PURGA_CADA = 500
+
+    def __init__(self, max_items=2048, ttl=600, ttl_no_encontrado=120, ruta_db=None, ttl_vencido=0):
+        """
+        Args:
+            ttl_vencido (int): Segundos que se conserva un resultado vencido para
+                servirlo si el servicio no está disponible (ver obtener_vencido)
+        """
+        self.max_items = max_items
+        self.ttl = ttl
+        self.ttl_no_encontrado = ttl_no_encontrado
+        self.ttl_vencido = ttl_vencido
+        self.ruta_db = ruta_db
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._conexion = ConexionPorHilo(ruta_db, pragmas=('synchronous=NORMAL',), timeout=5,
+                                         isolation_level=None) if ruta_db else None
+        self._escrituras = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.ruta_db:
+            self._conexion().execute(
+                'CREATE TABLE IF NOT EXISTS resultados (iue TEXT PRIMARY KEY, valor TEXT NOT NULL, expira REAL NOT NULL)'
+            )
+
+    def obtener(self, iue):
+        ahora = time.time()
+        with self._lock:
+            entrada = self._items.get(iue)
+            if entrada is not None:
+                expira, valor = entrada
+                if expira > ahora:
+                    self._items.move_to_end(iue)
+                    self.hits += 1
+                    return valor
+                if expira + self.ttl_vencido <= ahora:
+                    del self._items[iue]
+
+        if self.ruta_db:
+            try:
+                fila = self._conexion().execute(
+                    'SELECT valor, expira FROM resultados WHERE iue = ? AND expira > ?', (iue, ahora)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Error al leer la caché persistente: {str(e)}")
+                fila = None
+            if fila is not None:
+                valor = json.loads(fila[0])
+                with self._lock:
+                    self._guardar_en_memoria(iue, valor, fila[1])
+                    self.hits += 1
+                return valor
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def obtener_vencido(self, iue):
+        """
+        Devuelve el último resultado conocido aunque haya vencido (dentro de ttl_vencido),
+        marcado con 'desactualizado': True. Se usa cuando el servicio no responde.
+        """
+        ahora = time.time()
+        with self._lock:
+            entrada = self._items.get(iue)
+        if entrada is None and self.ruta_db:
+            try:
+                fila = self._conexion().execute(
+                    'SELECT valor, expira FROM resultados WHERE iue = ?', (iue,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Error al leer la caché persistente: {str(e)}")
+                fila = None
+            if fila is not None:
+                entrada = (fila[1], json.loads(fila[0]))
+        if entrada is None or entrada[0] + self.ttl_vencido <= ahora:
+            return None
+        return dict(entrada[1], desactualizado=entrada[0] <= ahora)
+
+    def guardar(self, iue, valor, encontrado=True):
+        """
+        Args:
+            iue (str): IUE normalizado
+            valor (dict): Resultado de la consulta
+            encontrado (bool): False si el servicio no devolvió datos (usa el TTL corto)
+        """
+        expira = time.time() + (self.ttl if encontrado else self.ttl_no_encontrado)
+        with self._lock:
+            self._guardar_en_memoria(iue, valor, expira)
+            self._escrituras += 1
+            purgar = self._escrituras % self.PURGA_CADA == 0
+
+        if self.ruta_db:
+            try:
+                conexion = self._conexion()
+                conexion.execute(
+                    'INSERT OR REPLACE INTO resultados (iue, valor, expira) VALUES (?, ?, ?)',
+                    (iue, json.dumps(valor, default=str), expira)
+                )
+                if purgar:
+                    conexion.execute('DELETE FROM resultados WHERE expira <= ?', (time.time() - self.ttl_vencido,))
+            except sqlite3.Error as e:
+                logger.warning(f"Error al escribir la caché persistente: {str(e)}")
+
+    def _guardar_en_memoria(self, iue, valor, expira):
+        self._items[iue] = (expira, valor)
+        self._items.move_to_end(iue)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def invalidar(self, iue):
+        with self._lock:
+            self._items.pop(iue, None)
+        if self.ruta_db:
+            try:
+                self._conexion().execute('DELETE FROM resultados WHERE iue = ?', (iue,))
+            except sqlite3.Error as e:
+                logger.warning(f"Error al invalidar la caché persistente: {str(e)}")
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'items': len(self._items)
+            }
+
+
+def _crear_bloqueo():
+    if not SOAP_SINGLE_FLIGHT_DIR or fcntl is None:
+        return None
+    if not RESULT_CACHE_DB:
+        # Sin caché compartida, quien espera el bloqueo no encuentra el resultado del otro
+        # proceso y consulta igual: el bloqueo sólo serializaría las consultas
+        logger.warning("SOAP_SINGLE_FLIGHT_DIR se ignora porque no está configurada RESULT_CACHE_DB")
+        return None
+    return BloqueoArchivos(SOAP_SINGLE_FLIGHT_DIR)
+
+
+def obtener_cliente():
+    """
+    Devuelve el cliente SOAP compartido por todo el proceso.
+    Se crea una única vez (usando la copia local del WSDL si existe) y
+    se refresca en segundo plano cuando vence el TTL del WSDL.
+    """
+    global _cliente_compartido
+    if _cliente_compartido is None:
+        with _cliente_lock:
+            if _cliente_compartido is None:
+                from indice_busqueda import IndiceBusqueda, SEARCH_INDEX_DB
+                from historial_expedientes import HistorialExpedientes, HISTORY_DB
+                _cliente_compartido = ConsultaExpedientes(
+                    cache_wsdl=WSDL_CACHE_PATH,
+                    cache=CacheResultados(
+                        max_items=RESULT_CACHE_SIZE,
+                        ttl=RESULT_CACHE_TTL,
+                        ttl_no_encontrado=RESULT_CACHE_TTL_NO_ENCONTRADO,
+                        ruta_db=RESULT_CACHE_DB or None,
+                        ttl_vencido=RESULT_CACHE_STALE
+                    ),
+                    indice=IndiceBusqueda(SEARCH_INDEX_DB) if SEARCH_INDEX_DB else None,
+                    historial=HistorialExpedientes(HISTORY_DB) if HISTORY_DB else None,
+                    bloqueo=_crear_bloqueo()
+                )
+    _cliente_compartido.refrescar_wsdl_si_vencido()
+    return _cliente_compartido
+
+
+def reiniciar_tras_fork():
+    """
+    Prepara el cliente compartido (si ya se creó) para usarlo en un proceso recién
+    forkeado, como los workers de gunicorn con preload_app
+    """
+    if _cliente_compartido is not None:
+        _cliente_compartido.reiniciar_tras_fork()
+
+
+def cerrar_conexiones():
+    """
+    Cierra las conexiones SQLite que el hilo actual abrió para el cliente compartido.
+    Con preload_app se llama en el maestro antes de crear los workers: una conexión
+    SQLite no se puede usar del otro lado de un fork, así que cada worker abre las
+    suyas en la primera consulta
+    """
+    if _cliente_compartido is not None:
+        _cliente_compartido.cerrar_conexiones()
+
+
 class ConsultaExpedientes:
-    def __init__(self):
-        # URL del servicio SOAP del Poder Judicial
-        self.wsdl = 'http://www.expedientes.poderjudicial.gub.uy/wsConsultaIUE.php?wsdl'
+    def __init__(self, wsdl=None, cache_wsdl=None, ttl_wsdl=WSDL_CACHE_TTL, cache=None,
+                 transporte=None, circuito=None, indice=None, historial=None, bloqueo=None):
+        """
+        Args:
+            wsdl (str): URL del WSDL (por defecto el del Poder Judicial)
+            cache_wsdl (str): Ruta de la copia local del WSDL, o None para no usarla
+            ttl_wsdl (int): Segundos tras los cuales la copia local se refresca
+            cache (CacheResultados): Caché de resultados por IUE, o None para no usarla
+            transporte (Transport): Transporte de zeep (por defecto, con pool, timeouts
+                y sin reintentos propios; ver transporte.py)
+            circuito (Circuito): Circuit breaker compartido con el motor de lotes
+            indice (IndiceBusqueda): Índice de búsqueda donde se guardan los resultados
+                obtenidos, o None para no indexarlos
+            historial (HistorialExpedientes): Historial donde se registran los cambios de
+                cada expediente, o None para no registrarlos
+            bloqueo (BloqueoArchivos): Bloqueo para no consultar el mismo IUE a la vez
+                desde varios procesos, o None para coordinar sólo los hilos del proceso
+        """
+        self.wsdl = wsdl or WSDL_URL
+        self.cache = cache
+        self.indice = indice
+        self.historial = historial
+        self.bloqueo = bloqueo
+        # Consultas al servicio en curso por IUE, compartidas por quienes piden el mismo IUE
+        self._vuelos = {}
+        self._vuelos_lock = threading.Lock()
+        self.transporte = transporte or crear_transporte()
+        self.circuito = circuito or Circuito()
+        self.cache_wsdl = cache_wsdl
+        self.ttl_wsdl = ttl_wsdl
+        self._refresco_lock = threading.Lock()
+        self._ultimo_intento_refresco = 0
         try:
-            self.client = Client(wsdl=self.wsdl)
+            with metricas.medir('wsdl'):
+                self.client = self._crear_cliente()
             logger.debug(f"Cliente SOAP inicializado correctamente con WSDL: {self.wsdl}")
-        except TransportError as e:
+        except (TransportError, OSError) as e:
             logger.error(f"Error al inicializar el cliente SOAP: {str(e)}")
             raise ConnectionError("No se pudo conectar al servicio del Poder Judicial. Por favor, intente más tarde.")
 
-    def _limpiar_iue(self, iue):
+    def reiniciar_tras_fork(self):
+        """
+        Descarta lo que el proceso hijo hereda del padre y no puede compartir: las
+        conexiones abiertas del pool y los locks que pudieran estar tomados por hilos
+        del padre (p. ej. un refresco del WSDL en curso), que en el hijo no existen
+        """
+        self.transporte.session.close()
+        self._vuelos = {}
+        self._vuelos_lock = threading.Lock()
+        self._refresco_lock = threading.Lock()
+        self._ultimo_intento_refresco = 0
+
+    def cerrar_conexiones(self):
+        """
+        Cierra las conexiones SQLite del hilo actual a la caché, el índice y el historial
+        """
+        for almacen in (self.cache, self.indice, self.historial):
+            conexion = getattr(almacen, '_conexion', None)
+            if conexion is not None:
+                conexion.cerrar()
+
+    def _crear_cliente(self):
+        """
+        Crea el cliente zeep, leyendo el WSDL de la copia local si está disponible
+        """
+        if self.cache_wsdl and os.path.exists(self.cache_wsdl):
+            try:
+                return Client(wsdl=self.cache_wsdl, transport=self.transporte)
+            except Exception as e:
+                logger.warning(f"WSDL en caché inválido ({self.cache_wsdl}), se descarga nuevamente: {str(e)}")
+
+        if not self.cache_wsdl:
+            return Client(wsdl=self.wsdl, transport=self.transporte)
+
+        self._guardar_wsdl(self._descargar_wsdl())
+        return Client(wsdl=self.cache_wsdl, transport=self.transporte)
+
+    def _descargar_wsdl(self):
+        return self.transporte.load(self.wsdl)
+
+    def _guardar_wsdl(self, contenido):
+        """
+        Escribe el WSDL de forma atómica para que otros procesos nunca lean un archivo a medias
+        """
+        os.makedirs(os.path.dirname(self.cache_wsdl), exist_ok=True)
+        temporal = f"{self.cache_wsdl}.{os.getpid()}.tmp"
+        with open(temporal, 'wb') as f:
+            f.write(contenido)
+        os.replace(temporal, self.cache_wsdl)
+
+    def wsdl_vencido(self):
+        if not self.cache_wsdl:
+            return False
+        try:
+            return time.time() - os.path.getmtime(self.cache_wsdl) > self.ttl_wsdl
+        except OSError:
+            return True
+
+    def refrescar_wsdl_si_vencido(self):
+        """
+        Lanza un refresco del WSDL en segundo plano si la copia local venció.
+        Mientras tanto se sigue usando el cliente actual.
+        """
+        if not self.wsdl_vencido():
+            return
+        if time.time() - self._ultimo_intento_refresco < WSDL_REINTENTO_REFRESCO:
+            return
+        if not self._refresco_lock.acquire(blocking=False):
+            return
+        self._ultimo_intento_refresco = time.time()
+        hilo = threading.Thread(target=self._refrescar_wsdl, name='refresco-wsdl', daemon=True)
+        hilo.start()
+
+    def _refrescar_wsdl(self):
+        try:
+            contenido = self._descargar_wsdl()
+            self._guardar_wsdl(contenido)
+            # La asignación es atómica: las consultas en curso terminan con el cliente anterior
+            with metricas.medir('wsdl'):
+                self.client = Client(wsdl=self.cache_wsdl, transport=self.transporte)
+            logger.info(f"WSDL refrescado desde {self.wsdl}")
+        except Exception as e:
+            logger.warning(f"No se pudo refrescar el WSDL, se mantiene la copia local: {str(e)}")
+        finally:
+            self._refresco_lock.release()
+
+    @staticmethod
+    def _limpiar_iue(iue):
         """
         Limpia el IUE de espacios adicionales manteniendo el formato correcto
         """
@@ -29,184 +498,37 @@ class ConsultaExpedientes:
             logger.error(f"Error al limpiar IUE '{iue}': {str(e)}")
             raise ValueError("Error al procesar el formato del IUE")
 
-    def consultar_expediente(self, iue):
+    def consultar_expediente(self, iue, usar_cache=True):
         """
         Consulta un expediente por su IUE
         Args:
             iue (str): Identificador Único de Expediente
+            usar_cache (bool): Si es False se consulta el servicio aunque haya un resultado
+                en caché (el resultado nuevo igualmente se guarda)
         Returns:
             dict: Información del expediente
         """
         try:
             iue_limpio = self._limpiar_iue(iue)
-            logger.debug(f"Consultando expediente con IUE: {iue_limpio}")
+
+            if usar_cache and self.cache is not None:
+                resultado = self.cache.obtener(iue_limpio)
+                if resultado is not None:
+                    logger.debug(f"Expediente {iue_limpio} obtenido de la caché")
+                    return resultado
 
             try:
-                # Realizar la consulta según la documentación
-                response = self.client.service.consultaIUE(iue=iue_limpio)
-
-                # Log detallado de la respuesta para debuggear
-                logger.debug(f"Tipo de respuesta: {type(response)}")
-                logger.debug(f"Respuesta completa: {response}")
-
-                if response is None:
-                    logger.warning(f"No se encontraron datos para el IUE: {iue_limpio}")
-                    return {
-                        'expediente': iue_limpio,
-                        'origen': 'No disponible',
-                        'caratula': 'No se encontró información para el expediente consultado',
-                        'primer_movimiento': 'No disponible'
-                    }
-
-                # Extraer movimientos directamente de la respuesta principal si están disponibles
-                primer_movimiento = "No disponible"
-                movimientos_urls = []
-
-                try:
-                    # Verificar si tenemos movimientos en la respuesta principal
-                    if hasattr(response, 'movimientos') and response.movimientos:
-                        # Ordenar movimientos por fecha (el más antiguo primero)
-                        movimientos = response.movimientos
-                        if isinstance(movimientos, list):
-                            # Convertir a lista si no lo es ya
-                            movimientos_lista = list(movimientos)
-                            
-                            # Buscar primero movimientos con enlaces
-                            movimientos_con_enlaces = []
-                            for mov in movimientos_lista:
-                                tiene_enlaces = False
-                                for attr_name in dir(mov):
-                                    if attr_name.startswith('__'):
-                                        continue
-                                    try:
-                                        attr_value = getattr(mov, attr_name)
-                                        if isinstance(attr_value, str) and ('http://' in attr_value or 'https://' in attr_value):
-                                            tiene_enlaces = True
-                                            url_desc = f"{mov.fecha if hasattr(mov, 'fecha') else 'Fecha desconocida'}: {attr_value}"
-                                            movimientos_urls.append(url_desc)
-                                    except:
-                                        continue
-                                if tiene_enlaces:
-                                    movimientos_con_enlaces.append(mov)
-                            
-                            # Si hay movimientos con enlaces, usar el más antiguo como primer movimiento
-                            if movimientos_con_enlaces:
-                                try:
-                                    # Ordenar por fecha (ascendente)
-                                    movimientos_con_enlaces.sort(key=lambda x: x.fecha if hasattr(x, 'fecha') else '')
-                                    primer_mov = movimientos_con_enlaces[0]
-                                    fecha = primer_mov.fecha if hasattr(primer_mov, 'fecha') else "Sin fecha"
-                                    tipo = primer_mov.tipo if hasattr(primer_mov, 'tipo') else "Sin tipo"
-                                    decreto = primer_mov.decreto if hasattr(primer_mov, 'decreto') and primer_mov.decreto else ""
-                                    decreto_txt = f" - Decreto: {decreto}" if decreto else ""
-                                    primer_movimiento = f"{fecha}: {tipo}{decreto_txt} (Con enlace)"
-                                except Exception as sort_err:
-                                    logger.error(f"Error al ordenar movimientos con enlaces: {str(sort_err)}")
-                                    primer_mov = movimientos_con_enlaces[0]
-                                    fecha = primer_mov.fecha if hasattr(primer_mov, 'fecha') else "Sin fecha"
-                                    tipo = primer_mov.tipo if hasattr(primer_mov, 'tipo') else "Sin tipo"
-                                    primer_movimiento = f"{fecha}: {tipo} (Con enlace)"
-                            else:
-                                # Si no hay movimientos con enlaces, usar el comportamiento anterior
-                                try:
-                                    # Ordenar por fecha
-                                    movimientos_lista.sort(key=lambda x: x.fecha if hasattr(x, 'fecha') else '')
-                                    primer_mov = movimientos_lista[0]
-                                    fecha = primer_mov.fecha if hasattr(primer_mov, 'fecha') else "Sin fecha"
-                                    tipo = primer_mov.tipo if hasattr(primer_mov, 'tipo') else "Sin tipo"
-                                    decreto = primer_mov.decreto if hasattr(primer_mov, 'decreto') and primer_mov.decreto else ""
-                                    decreto_txt = f" - Decreto: {decreto}" if decreto else ""
-                                    primer_movimiento = f"{fecha}: {tipo}{decreto_txt}"
-                                except Exception as sort_err:
-                                    logger.error(f"Error al ordenar movimientos: {str(sort_err)}")
-                                    primer_mov = movimientos_lista[0]
-                                    fecha = primer_mov.fecha if hasattr(primer_mov, 'fecha') else "Sin fecha"
-                                    tipo = primer_mov.tipo if hasattr(primer_mov, 'tipo') else "Sin tipo"
-                                    primer_movimiento = f"{fecha}: {tipo}"
-                        else:
-                            # Si solo hay un movimiento
-                            tiene_enlaces = False
-                            for attr_name in dir(movimientos):
-                                if attr_name.startswith('__'):
-                                    continue
-                                try:
-                                    attr_value = getattr(movimientos, attr_name)
-                                    if isinstance(attr_value, str) and ('http://' in attr_value or 'https://' in attr_value):
-                                        tiene_enlaces = True
-                                        url_desc = f"{movimientos.fecha if hasattr(movimientos, 'fecha') else 'Fecha desconocida'}: {attr_value}"
-                                        movimientos_urls.append(url_desc)
-                                except:
-                                    continue
-                            
-                            fecha = movimientos.fecha if hasattr(movimientos, 'fecha') else "Sin fecha"
-                            tipo = movimientos.tipo if hasattr(movimientos, 'tipo') else "Sin tipo"
-                            decreto = movimientos.decreto if hasattr(movimientos, 'decreto') and movimientos.decreto else ""
-                            decreto_txt = f" - Decreto: {decreto}" if decreto else ""
-                            enlace_txt = " (Con enlace)" if tiene_enlaces else ""
-                            primer_movimiento = f"{fecha}: {tipo}{decreto_txt}{enlace_txt}"
-
-                    # Buscar URLs en otros atributos de la respuesta
-                    for attr_name in dir(response):
-                        if attr_name.startswith('__'):
-                            continue
-                        try:
-                            attr_value = getattr(response, attr_name)
-                            if isinstance(attr_value, str):
-                                # Buscar URLs en el texto
-                                import re
-                                urls = re.findall(r'https?://[^\s<>"]+|www\.[^\s<>"]+', attr_value)
-                                for url in urls:
-                                    movimientos_urls.append(f"{attr_name}: {url}")
-                        except:
-                            continue
-
-                except Exception as e:
-                    logger.error(f"Error al procesar movimientos para IUE '{iue_limpio}': {str(e)}")
-                    primer_movimiento = "Error al procesar movimientos"
-
-                # Procesamiento de la respuesta y agregar enlaces a movimientos
-                movimientos_procesados = []
-                if hasattr(response, 'movimientos') and response.movimientos:
-                    for mov in response.movimientos:
-                        mov_dict = {
-                            'fecha': mov.fecha if hasattr(mov, 'fecha') else '',
-                            'tipo': mov.tipo if hasattr(mov, 'tipo') else '',
-                            'decreto': mov.decreto if hasattr(mov, 'decreto') else '',
-                            'vencimiento': mov.vencimiento if hasattr(mov, 'vencimiento') else '',
-                            'sede': mov.sede if hasattr(mov, 'sede') else '',
-                            'enlaces': []
-                        }
-                        
-                        # Buscar enlaces en los atributos del movimiento
-                        for attr_name in dir(mov):
-                            if attr_name.startswith('__'):
-                                continue
-                            try:
-                                attr_value = getattr(mov, attr_name)
-                                if isinstance(attr_value, str) and ('http://' in attr_value or 'https://' in attr_value):
-                                    mov_dict['enlaces'].append({
-                                        'tipo': attr_name,
-                                        'url': attr_value
-                                    })
-                                    # Si es un decreto, también agregar como enlace_decreto
-                                    if attr_name.lower() in ['decreto', 'resolucion', 'sentencia'] or 'decreto' in attr_name.lower():
-                                        mov_dict['enlace_decreto'] = attr_value
-                            except:
-                                continue
-                        
-                        movimientos_procesados.append(mov_dict)
-
-                return {
-                    'expediente': iue_limpio,
-                    'origen': response.origen if hasattr(response, 'origen') else 'No disponible',
-                    'caratula': response.caratula if hasattr(response, 'caratula') else 'No disponible',
-                    'primer_movimiento': primer_movimiento,
-                    'urls_movimientos': movimientos_urls,
-                    'movimientos': movimientos_procesados if movimientos_procesados else response.movimientos if hasattr(response, 'movimientos') else []
-                }
+                return self._consultar_compartido(iue_limpio, usar_cache)
 
             except Exception as e:
                 logger.error(f"Error al llamar al servicio SOAP: {str(e)}")
+                if isinstance(e, CircuitoAbierto) or es_error_transitorio(e):
+                    # Mientras el servicio no responde se sirve el último resultado conocido
+                    vencido = self.cache.obtener_vencido(iue_limpio) if self.cache is not None else None
+                    if vencido is not None:
+                        logger.warning(f"Servicio no disponible, se devuelve {iue_limpio} desde la caché")
+                        return vencido
+                    raise ConnectionError("No se pudo conectar al servicio del Poder Judicial. Por favor, intente más tarde.")
                 raise
 
         except Fault as e:
@@ -215,6 +537,275 @@ class ConsultaExpedientes:
         except ValueError as ve:
             logger.error(f"Error de formato en IUE '{iue}': {str(ve)}")
             raise ValueError(str(ve))
+        except ConnectionError:
+            raise
         except Exception as e:
             logger.error(f"Error inesperado al consultar IUE '{iue}': {str(e)}")
-            raise Exception("Error al procesar la consulta. Por favor, intente más tarde.")
\ No newline at end of file
+            raise Exception("Error al procesar la consulta. Por favor, intente más tarde.")
+
+    def _unirse(self, iue_limpio):
+        """
+        Se suma a la consulta en curso de un IUE o, si no hay ninguna, la inicia
+        Returns:
+            tuple: (Future con el resultado o la excepción, si quien llama debe hacer la consulta)
+        """
+        with self._vuelos_lock:
+            futuro = self._vuelos.get(iue_limpio)
+            if futuro is not None:
+                return futuro, False
+            futuro = self._vuelos[iue_limpio] = concurrent.futures.Future()
+            # En curso: si alguien que espera se cancela, el Future compartido no se cancela
+            futuro.set_running_or_notify_cancel()
+            return futuro, True
+
+    def _terminar_vuelo(self, iue_limpio, futuro, resultado=None, error=None):
+        """
+        Publica el resultado de la consulta a quienes la esperan. Si quien consultaba se
+        canceló se publica VUELO_INTERRUMPIDO, y quienes esperan vuelven a _unirse():
+        uno de ellos pasa a hacer la consulta
+        """
+        with self._vuelos_lock:
+            self._vuelos.pop(iue_limpio, None)
+        if error is not None:
+            futuro.set_exception(error)
+        else:
+            futuro.set_result(resultado)
+
+    def _consultar_compartido(self, iue_limpio, usar_cache):
+        """
+        Consulta el servicio, salvo que ya haya una consulta del mismo IUE en curso:
+        en ese caso espera su resultado (o su excepción) en lugar de repetirla
+        """
+        while True:
+            futuro, lider = self._unirse(iue_limpio)
+            if lider:
+                break
+            logger.debug(f"Esperando la consulta en curso de {iue_limpio}")
+            resultado = futuro.result()
+            if resultado is not VUELO_INTERRUMPIDO:
+                return resultado
+        try:
+            resultado = self._consultar_servicio(iue_limpio, usar_cache)
+        except Exception as e:
+            self._terminar_vuelo(iue_limpio, futuro, error=e)
+            raise
+        except BaseException:
+            self._terminar_vuelo(iue_limpio, futuro, resultado=VUELO_INTERRUMPIDO)
+            raise
+        self._terminar_vuelo(iue_limpio, futuro, resultado=resultado)
+        return resultado
+
+    def _consultar_servicio(self, iue_limpio, usar_cache):
+        logger.debug(f"Consultando expediente con IUE: {iue_limpio}")
+        descriptor = None
+        if self.bloqueo is not None:
+            descriptor, espero = self.bloqueo.adquirir(iue_limpio)
+            if espero and usar_cache and self.cache is not None:
+                # Otro worker acaba de consultar este IUE: su resultado ya está en la caché compartida
+                resultado = self.cache.obtener(iue_limpio)
+                if resultado is not None:
+                    self.bloqueo.liberar(descriptor)
+                    return resultado
+
+        def consultar():
+            with metricas.medir('soap'):
+                return self.client.service.consultaIUE(iue=iue_limpio)
+
+        try:
+            # Realizar la consulta según la documentación; los errores de red
+            # se reintentan y, si el servicio está caído, se corta por el circuito
+            response = llamar_con_reintentos(consultar, self.circuito)
+            registrar_respuesta(iue_limpio, response)
+
+            with metricas.medir('parseo'):
+                resultado = self._procesar_respuesta(iue_limpio, response)
+            self._guardar_resultado(iue_limpio, resultado)
+            return resultado
+        finally:
+            if descriptor is not None:
+                self.bloqueo.liberar(descriptor)
+
+    def _guardar_resultado(self, iue_limpio, resultado):
+        """
+        Guarda un resultado recién obtenido del servicio en la caché, el índice de búsqueda
+        y el historial
+        """
+        if self.cache is not None:
+            self.cache.guardar(iue_limpio, resultado, encontrado=expediente_encontrado(resultado))
+        if self.indice is not None:
+            try:
+                self.indice.indexar(resultado)
+            except sqlite3.Error as e:
+                logger.warning(f"No se pudo indexar {iue_limpio}: {str(e)}")
+        if self.historial is not None:
+            try:
+                self.historial.registrar(resultado)
+            except sqlite3.Error as e:
+                logger.warning(f"No se pudo registrar {iue_limpio} en el historial: {str(e)}")
+
+    def _procesar_respuesta(self, iue_limpio, response):
+        """
+        Convierte la respuesta de consultaIUE en el diccionario que consumen las vistas.
+        Recorre los movimientos una sola vez: arma cada movimiento, junta sus enlaces y
+        elige el primer movimiento (el más antiguo, priorizando los que tienen enlace).
+        Args:
+            iue_limpio (str): IUE normalizado
+            response: Respuesta de zeep (None si el expediente no existe)
+        Returns:
+            dict: Información del expediente
+        """
+        if response is None:
+            logger.warning(f"No se encontraron datos para el IUE: {iue_limpio}")
+            return {
+                'expediente': iue_limpio,
+                'origen': 'No disponible',
+                'caratula': 'No se encontró información para el expediente consultado',
+                'primer_movimiento': 'No disponible'
+            }
+
+        campos_respuesta = _campos(response)
+        movimientos = campos_respuesta.get('movimientos')
+        if movimientos and not isinstance(movimientos, list):
+            # Un único movimiento llega como objeto suelto en lugar de lista
+            movimientos = [movimientos]
+
+        movimientos_urls = []
+        movimientos_procesados = []
+        # (clave de fecha, campos) del movimiento más antiguo, con y sin enlaces
+        primero = None
+        primero_con_enlace = None
+
+        for mov in movimientos or ():
+            campos = _campos(mov)
+            fecha = campos.get('fecha', '')
+            mov_dict = {
+                'fecha': fecha,
+                'tipo': campos.get('tipo', ''),
+                'decreto': campos.get('decreto', ''),
+                'vencimiento': campos.get('vencimiento', ''),
+                'sede': campos.get('sede', ''),
+                'enlaces': []
+            }
+
+            # Buscar enlaces en los campos del movimiento
+            for nombre, valor in campos.items():
+                if isinstance(valor, str) and ('http://' in valor or 'https://' in valor):
+                    mov_dict['enlaces'].append({'tipo': nombre, 'url': valor})
+                    movimientos_urls.append(f"{fecha if 'fecha' in campos else 'Fecha desconocida'}: {valor}")
+                    # Si es un decreto, también agregar como enlace_decreto
+                    nombre_min = nombre.lower()
+                    if nombre_min in CAMPOS_DECRETO or 'decreto' in nombre_min:
+                        mov_dict['enlace_decreto'] = valor
+
+            clave = _clave_fecha(fecha)
+            if primero is None or clave < primero[0]:
+                primero = (clave, campos)
+            if mov_dict['enlaces'] and (primero_con_enlace is None or clave < primero_con_enlace[0]):
+                primero_con_enlace = (clave, campos)
+
+            movimientos_procesados.append(mov_dict)
+
+        if primero_con_enlace is not None:
+            primer_movimiento = f"{_describir_movimiento(primero_con_enlace[1])} (Con enlace)"
+        elif primero is not None:
+            primer_movimiento = _describir_movimiento(primero[1])
+        else:
+            primer_movimiento = "No disponible"
+
+        # Buscar URLs en otros campos de la respuesta
+        for nombre, valor in campos_respuesta.items():
+            if isinstance(valor, str) and ('http' in valor or 'www.' in valor):
+                for url in URL_PATTERN.findall(valor):
+                    movimientos_urls.append(f"{nombre}: {url}")
+
+        return {
+            'expediente': iue_limpio,
+            'origen': campos_respuesta.get('origen', 'No disponible'),
+            'caratula': campos_respuesta.get('caratula', 'No disponible'),
+            'primer_movimiento': primer_movimiento,
+            'urls_movimientos': movimientos_urls,
+            'movimientos': movimientos_procesados
+        }
+
+
+def _campos(objeto):
+    """
+    Devuelve los campos de un objeto de zeep como dict. Los objetos de zeep ya los
+    guardan en __values__; para cualquier otro objeto se recorre dir().
+    """
+    valores = getattr(objeto, '__values__', None)
+    if valores is not None:
+        return valores
+    campos = {}
+    for nombre in dir(objeto):
+        if nombre.startswith('__'):
+            continue
+        try:
+            campos[nombre] = getattr(objeto, nombre)
+        except Exception:
+            continue
+    return campos
+
+
+def expediente_encontrado(resultado):
+    """
+    Indica si un resultado de consultar_expediente corresponde a un expediente
+    existente (y no a un error o a un IUE sin datos)
+    """
+    if resultado.get('error') or 'movimientos' not in resultado:
+        return False
+    return bool(resultado.get('caratula') or resultado.get('movimientos'))
+
+
+def registrar_respuesta(iue, response):
+    """
+    Registra la respuesta completa en el log para debuggear, sólo para una muestra
+    de las consultas: formatear respuestas con cientos de movimientos es costoso.
+    """
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < SOAP_LOG_SAMPLE_RATE:
+        logger.debug(f"Respuesta completa de {iue} ({type(response)}): {response}")
+
+
+def huella_movimiento(movimiento):
+    """
+    Huella estable de un movimiento (tal como lo devuelve consultar_expediente),
+    para detectar movimientos nuevos sin comparar todos sus campos
+    """
+    texto = '\x1f'.join(str(movimiento.get(campo) or '') for campo in CAMPOS_HUELLA)
+    return hashlib.blake2b(texto.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def huella_movimientos(movimientos):
+    """
+    Huella del conjunto de movimientos de un expediente: cambia si aparece,
+    desaparece o se modifica cualquier movimiento
+    """
+    huella = hashlib.blake2b(digest_size=16)
+    for movimiento in movimientos or ():
+        huella.update(huella_movimiento(movimiento).encode('ascii'))
+    return huella.hexdigest()
+
+
+def etag_resultado(resultado):
+    """
+    ETag de un resultado: la huella de sus movimientos junto con los datos del
+    expediente que se muestran, para que cambie si cambia cualquiera de ellos
+    """
+    huella = hashlib.blake2b(digest_size=12)
+    for valor in (resultado.get('expediente'), resultado.get('caratula'), resultado.get('origen'),
+                  huella_movimientos(resultado.get('movimientos'))):
+        huella.update(str(valor or '').encode('utf-8') + b'\x1f')
+    return huella.hexdigest()
+
+
+def _clave_fecha(fecha):
+    # Las fechas se comparan como texto, tal como las devuelve el servicio
+    return '' if fecha is None else str(fecha)
+
+
+def _describir_movimiento(campos):
+    fecha = campos.get('fecha', 'Sin fecha')
+    tipo = campos.get('tipo', 'Sin tipo')
+    decreto = campos.get('decreto')
+    decreto_txt = f" - Decreto: {decreto}" if decreto else ""
+    return f"{fecha}: {tipo}{decreto_txt}"
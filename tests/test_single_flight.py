@@ -0,0 +1,114 @@
+"""
+Consultas concurrentes del mismo IUE contra el servidor stub de benchmarks/:
+deben llegar al servicio una sola vez.
+
+    python -m pytest tests
+"""
+import asyncio
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, 'benchmarks'))
+
+import motor_lote
+from motor_lote import MotorLote
+from servidor_stub import ServidorStub
+from soap_client import BloqueoArchivos, CacheResultados, ConsultaExpedientes
+
+IUE = '2-1234/2024'
+CONCURRENTES = 20
+# Demora de cada respuesta del stub: da tiempo a que todos se sumen a la misma consulta
+LATENCIA = 0.5
+
+
+@pytest.fixture
+def stub():
+    servidor = ServidorStub(latencia=LATENCIA).iniciar()
+    yield servidor
+    servidor.detener()
+
+
+@pytest.fixture
+def cliente(stub):
+    return ConsultaExpedientes(wsdl=stub.url)
+
+
+@pytest.fixture
+def motor(cliente):
+    motor = MotorLote(cliente, tasa=0)
+    yield motor
+    motor.cerrar()
+
+
+def test_hilos_concurrentes_hacen_una_sola_consulta(stub, cliente):
+    barrera = threading.Barrier(CONCURRENTES)
+
+    def consultar():
+        barrera.wait()
+        return cliente.consultar_expediente(IUE, usar_cache=False)
+
+    with concurrent.futures.ThreadPoolExecutor(CONCURRENTES) as pool:
+        resultados = list(pool.map(lambda _: consultar(), range(CONCURRENTES)))
+
+    assert stub.estadisticas['consultas'] == 1
+    assert all(resultado == resultados[0] for resultado in resultados)
+    assert resultados[0]['expediente'] == IUE
+
+
+def test_lote_y_consulta_individual_comparten_la_consulta(stub, cliente, motor):
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        individual = pool.submit(cliente.consultar_expediente, IUE, False)
+        lote = motor.consultar([IUE] * CONCURRENTES, usar_cache=False)
+        individual = individual.result()
+
+    assert stub.estadisticas['consultas'] == 1
+    assert all(resultado == individual for resultado in lote)
+    assert not individual.get('error')
+
+
+def test_cancelar_al_que_consulta_no_corta_a_los_que_esperan(stub, motor):
+    lider = _programar(motor, IUE)
+    time.sleep(LATENCIA / 5)
+    esperando = [_programar(motor, IUE) for _ in range(CONCURRENTES - 1)]
+    time.sleep(LATENCIA / 5)
+    lider.cancel()
+
+    resultados = [futuro.result(timeout=10 * LATENCIA) for futuro in esperando]
+
+    # Uno de los que esperaban retomó la consulta: una llamada cancelada y otra completa
+    assert stub.estadisticas['consultas'] == 2
+    assert all(resultado['expediente'] == IUE and not resultado.get('error') for resultado in resultados)
+
+
+def _programar(motor, iue):
+    return asyncio.run_coroutine_threadsafe(motor.consultar_uno(iue, usar_cache=False), motor._loop)
+
+
+def test_lote_grande_con_bloqueo_entre_procesos(tmp_path, monkeypatch):
+    # Configuración de varios workers: bloqueo por IUE entre procesos, caché persistente y
+    # limitador de tasa compartido. Con cientos de IUEs varios comparten archivo de bloqueo
+    monkeypatch.setattr(motor_lote, 'BATCH_RATE_LIMIT_DB', str(tmp_path / 'limite_tasa.db'))
+    servidor = ServidorStub(latencia=0.01).iniciar()
+    cliente = ConsultaExpedientes(
+        wsdl=servidor.url,
+        cache=CacheResultados(ruta_db=str(tmp_path / 'resultados.db')),
+        bloqueo=BloqueoArchivos(str(tmp_path / 'bloqueos'))
+    )
+    motor = MotorLote(cliente, tasa=1000)
+    iues = [f"2-{n}/2024" for n in range(1, 401)]
+    try:
+        resultados = asyncio.run_coroutine_threadsafe(motor.consultar_async(iues), motor._loop).result(timeout=60)
+    finally:
+        motor.cerrar()
+        servidor.detener()
+
+    assert servidor.estadisticas['consultas'] == len(iues)
+    assert [resultado['expediente'] for resultado in resultados] == iues
+    assert not any(resultado.get('error') for resultado in resultados)
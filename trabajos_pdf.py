@@ -0,0 +1,267 @@
+"""
+Cola de trabajos para exportar lotes de expedientes a PDF en segundo plano.
+
+Los trabajos se guardan en SQLite, así que cualquier worker de gunicorn puede
+tomarlos (la toma es atómica) y consultar su estado. Cada trabajo consulta el
+rango con el motor de lotes, informa el progreso y genera el archivo con el
+renderizador elegido (PDF por defecto, o CSV/JSON). Las partes del PDF se
+convierten en un pool de procesos para que xhtml2pdf no retenga el GIL del
+proceso web. Los archivos quedan en disco hasta que vencen.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+
+import metricas
+from recursos import ConexionPorHilo, propiedad_motor
+from renderizadores import obtener_renderizador
+
+logger = logging.getLogger(__name__)
+
+PDF_JOBS_DB = os.environ.get(
+    'PDF_JOBS_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'trabajos_pdf.db')
+)
+PDF_JOBS_DIR = os.environ.get(
+    'PDF_JOBS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'pdf')
+)
+# Segundos que se conserva un PDF generado
+PDF_JOBS_TTL = int(os.environ.get('PDF_JOBS_TTL', 60 * 60))
+PDF_JOBS_PROCESSES = int(os.environ.get('PDF_JOBS_PROCESSES', 2))
+# Un trabajo tomado que no se actualiza en este tiempo se considera abandonado
+PDF_JOBS_STALE = int(os.environ.get('PDF_JOBS_STALE', 15 * 60))
+
+PENDIENTE = 'pendiente'
+CONSULTANDO = 'consultando'
+GENERANDO = 'generando'
+TERMINADO = 'terminado'
+ERROR = 'error'
+
+
+class ColaTrabajosPDF:
+    def __init__(self, renderizar_html, ruta_db=PDF_JOBS_DB, directorio=PDF_JOBS_DIR,
+                 ttl=PDF_JOBS_TTL, procesos=PDF_JOBS_PROCESSES, motor=None, guardados=None):
+        """
+        Args:
+            renderizar_html (callable): Recibe (resultados, sede, desde, hasta, anio)
+                y devuelve el HTML del PDF de esos expedientes (se llama por partes)
+            motor (MotorLote): Motor de consultas (por defecto el compartido del proceso)
+            guardados (ResultadosGuardados): Resultados ya consultados, para los trabajos
+                encolados con token
+        """
+        self.renderizar_html = renderizar_html
+        self.ruta_db = ruta_db
+        self.directorio = directorio
+        self.ttl = ttl
+        self.procesos = procesos
+        self._motor = motor
+        self.guardados = guardados
+        self._conexion = ConexionPorHilo(self.ruta_db, filas=True)
+        self._pool = None
+        self._hilo = None
+        self._hilo_pid = None
+        self._hilo_lock = threading.Lock()
+        self._hay_trabajo = threading.Event()
+        os.makedirs(self.directorio, exist_ok=True)
+        with self._conexion() as conexion:
+            conexion.execute('''
+                CREATE TABLE IF NOT EXISTS trabajos (
+                    id TEXT PRIMARY KEY,
+                    estado TEXT NOT NULL,
+                    sede TEXT NOT NULL,
+                    desde INTEGER NOT NULL,
+                    hasta INTEGER NOT NULL,
+                    anio TEXT NOT NULL,
+                    usar_cache INTEGER NOT NULL,
+                    total INTEGER NOT NULL,
+                    completados INTEGER NOT NULL DEFAULT 0,
+                    archivo TEXT,
+                    error TEXT,
+                    creado REAL NOT NULL,
+                    actualizado REAL NOT NULL,
+                    expira REAL,
+                    token TEXT,
+                    formato TEXT NOT NULL DEFAULT 'pdf'
+                )
+            ''')
+            columnas = [fila['name'] for fila in conexion.execute('PRAGMA table_info(trabajos)')]
+            if 'token' not in columnas:
+                conexion.execute('ALTER TABLE trabajos ADD COLUMN token TEXT')
+            if 'formato' not in columnas:
+                conexion.execute("ALTER TABLE trabajos ADD COLUMN formato TEXT NOT NULL DEFAULT 'pdf'")
+
+    motor = propiedad_motor()
+
+    def encolar(self, sede, desde, hasta, anio, usar_cache=True, token=None, formato='pdf'):
+        """
+        Crea un trabajo de exportación y se asegura de que haya un trabajador activo
+        Args:
+            token (str): Token de resultados guardados del mismo rango; si sigue vigente
+                al ejecutar el trabajo, el PDF se genera sin volver a consultar
+            formato (str): Renderizador a usar (pdf, csv, json)
+        Returns:
+            str: Id del trabajo
+        Raises:
+            ValueError: Si el formato no es válido
+        """
+        obtener_renderizador(formato)
+        id_trabajo = uuid.uuid4().hex
+        ahora = time.time()
+        with self._conexion() as conexion:
+            conexion.execute(
+                'INSERT INTO trabajos (id, estado, sede, desde, hasta, anio, usar_cache, total, creado, actualizado, token, formato) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (id_trabajo, PENDIENTE, sede, desde, hasta, anio, int(usar_cache), hasta - desde + 1, ahora, ahora,
+                 token, formato)
+            )
+        self.iniciar()
+        self._hay_trabajo.set()
+        return id_trabajo
+
+    def estado(self, id_trabajo):
+        fila = self._conexion().execute('SELECT * FROM trabajos WHERE id = ?', (id_trabajo,)).fetchone()
+        if fila is None:
+            return None
+        trabajo = dict(fila)
+        if trabajo['estado'] == TERMINADO and (trabajo['expira'] or 0) < time.time():
+            return None
+        return trabajo
+
+    def iniciar(self):
+        """
+        Arranca el hilo trabajador de este proceso (una vez por proceso, también tras un fork)
+        """
+        with self._hilo_lock:
+            if self._hilo is not None and self._hilo_pid == os.getpid() and self._hilo.is_alive():
+                return
+            self._hilo = threading.Thread(target=self._trabajar, name='trabajos-pdf', daemon=True)
+            self._hilo_pid = os.getpid()
+            self._pool = None
+            self._hilo.start()
+
+    def _trabajar(self):
+        while True:
+            try:
+                self.purgar_vencidos()
+                trabajo = self._tomar()
+                if trabajo is None:
+                    self._hay_trabajo.wait(timeout=30)
+                    self._hay_trabajo.clear()
+                    continue
+                self._ejecutar(trabajo)
+            except Exception as e:
+                logger.error(f"Error en el trabajador de PDF: {str(e)}")
+                time.sleep(5)
+
+    def _tomar(self):
+        """
+        Toma el trabajo pendiente más antiguo (o uno abandonado por otro proceso)
+        """
+        ahora = time.time()
+        conexion = self._conexion()
+        with conexion:
+            fila = conexion.execute(
+                'SELECT id FROM trabajos WHERE estado = ? OR (estado IN (?, ?) AND actualizado < ?) '
+                'ORDER BY creado LIMIT 1',
+                (PENDIENTE, CONSULTANDO, GENERANDO, ahora - PDF_JOBS_STALE)
+            ).fetchone()
+            if fila is None:
+                return None
+            # La condición sobre `actualizado` evita que dos procesos tomen el mismo trabajo
+            tomado = conexion.execute(
+                'UPDATE trabajos SET estado = ?, completados = 0, actualizado = ? '
+                'WHERE id = ? AND (estado = ? OR actualizado < ?)',
+                (CONSULTANDO, ahora, fila['id'], PENDIENTE, ahora - PDF_JOBS_STALE)
+            ).rowcount
+        if not tomado:
+            return None
+        return dict(conexion.execute('SELECT * FROM trabajos WHERE id = ?', (fila['id'],)).fetchone())
+
+    def _actualizar(self, id_trabajo, **campos):
+        campos['actualizado'] = time.time()
+        asignaciones = ', '.join(f"{campo} = ?" for campo in campos)
+        with self._conexion() as conexion:
+            conexion.execute(f'UPDATE trabajos SET {asignaciones} WHERE id = ?', (*campos.values(), id_trabajo))
+
+    def _ejecutar(self, trabajo):
+        id_trabajo = trabajo['id']
+        sede, desde, hasta, anio = trabajo['sede'], trabajo['desde'], trabajo['hasta'], trabajo['anio']
+        try:
+            resultados = self._resultados_guardados(trabajo)
+            if resultados is not None:
+                self._actualizar(id_trabajo, completados=len(resultados))
+            else:
+                resultados = self._consultar(trabajo)
+
+            self._actualizar(id_trabajo, estado=GENERANDO)
+            renderizador = obtener_renderizador(
+                trabajo['formato'] or 'pdf', self.renderizar_html, ejecutor=self._obtener_pool()
+            )
+            ruta = os.path.join(self.directorio, f"{id_trabajo}.{renderizador.extension}")
+            temporal = f"{ruta}.tmp"
+            try:
+                with metricas.medir(renderizador.nombre), open(temporal, 'wb') as destino:
+                    renderizador.escribir(resultados, destino, sede=sede, desde=desde, hasta=hasta, anio=anio)
+            except Exception:
+                if os.path.exists(temporal):
+                    os.remove(temporal)
+                raise
+            os.replace(temporal, ruta)
+            self._actualizar(id_trabajo, estado=TERMINADO, archivo=ruta, expira=time.time() + self.ttl)
+            logger.info(f"Trabajo PDF {id_trabajo} terminado ({trabajo['total']} expedientes)")
+        except Exception as e:
+            logger.error(f"Error en el trabajo PDF {id_trabajo}: {str(e)}")
+            self._actualizar(id_trabajo, estado=ERROR, error=str(e) or type(e).__name__,
+                             expira=time.time() + self.ttl)
+
+    def _resultados_guardados(self, trabajo):
+        if not trabajo['token'] or self.guardados is None:
+            return None
+        guardado = self.guardados.obtener(trabajo['token'])
+        if guardado is None:
+            logger.info(f"Los resultados del trabajo {trabajo['id']} vencieron, se vuelve a consultar")
+            return None
+        return guardado['resultados']
+
+    def _consultar(self, trabajo):
+        sede, desde, hasta, anio = trabajo['sede'], trabajo['desde'], trabajo['hasta'], trabajo['anio']
+        iues = [f"{sede}-{nro}/{anio}" for nro in range(desde, hasta + 1)]
+        resultados = [None] * len(iues)
+        completados = 0
+        for indice, resultado in self.motor.consultar_iter(iues, usar_cache=bool(trabajo['usar_cache'])):
+            resultados[indice] = resultado
+            completados += 1
+            if completados % 10 == 0 or completados == len(iues):
+                self._actualizar(trabajo['id'], completados=completados)
+        return resultados
+
+    def _obtener_pool(self):
+        if self._pool is None:
+            # spawn: hacer fork de un proceso con hilos (gunicorn, event loop) no es seguro
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.procesos, mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._pool
+
+    def purgar_vencidos(self):
+        ahora = time.time()
+        conexion = self._conexion()
+        vencidos = conexion.execute(
+            'SELECT id, archivo FROM trabajos WHERE expira IS NOT NULL AND expira < ?', (ahora,)
+        ).fetchall()
+        for fila in vencidos:
+            if fila['archivo']:
+                try:
+                    os.remove(fila['archivo'])
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"No se pudo borrar {fila['archivo']}: {str(e)}")
+        if vencidos:
+            with conexion:
+                conexion.executemany('DELETE FROM trabajos WHERE id = ?', [(fila['id'],) for fila in vencidos])
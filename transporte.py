@@ -0,0 +1,216 @@
+"""
+Transporte HTTP para el servicio SOAP del Poder Judicial: pool de conexiones
+con keep-alive, timeouts de conexión y lectura, reintentos con backoff y
+jitter para consultaIUE (que es idempotente) y un circuit breaker que corta
+las consultas mientras el servicio está caído.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from zeep.exceptions import TransportError
+from zeep.transports import Transport
+
+import metricas
+
+logger = logging.getLogger(__name__)
+
+SOAP_CONNECT_TIMEOUT = float(os.environ.get('SOAP_CONNECT_TIMEOUT', 5))
+SOAP_READ_TIMEOUT = float(os.environ.get('SOAP_READ_TIMEOUT', 20))
+# Conexiones reutilizables por proceso; conviene que coincida con la concurrencia de los lotes
+SOAP_POOL_SIZE = int(os.environ.get('SOAP_POOL_SIZE', os.environ.get('BATCH_MAX_CONCURRENCY', 20)))
+SOAP_RETRIES = int(os.environ.get('SOAP_RETRIES', 2))
+SOAP_RETRY_BACKOFF = float(os.environ.get('SOAP_RETRY_BACKOFF', 0.5))
+# Fallos seguidos que abren el circuito y segundos hasta volver a probar
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30))
+
+
+class CircuitoAbierto(ConnectionError):
+    """
+    El servicio falló repetidamente y las consultas se cortan sin intentar conectarse
+    """
+
+
+def crear_transporte(pool=SOAP_POOL_SIZE, timeout_conexion=SOAP_CONNECT_TIMEOUT, timeout_lectura=SOAP_READ_TIMEOUT):
+    """
+    Transporte de zeep sobre una requests.Session con pool de conexiones
+    """
+    session = requests.Session()
+    # Los reintentos se manejan en llamar_con_reintentos, no en urllib3
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    timeouts = (timeout_conexion, timeout_lectura)
+    return Transport(session=session, timeout=timeouts, operation_timeout=timeouts)
+
+
+def crear_cliente_httpx(pool=SOAP_POOL_SIZE, timeout_conexion=SOAP_CONNECT_TIMEOUT, timeout_lectura=SOAP_READ_TIMEOUT):
+    """
+    Cliente httpx equivalente a crear_transporte(), para el motor asíncrono
+    """
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout_lectura, connect=timeout_conexion),
+        limits=httpx.Limits(max_connections=pool, max_keepalive_connections=pool)
+    )
+
+
+class Circuito:
+    """
+    Circuit breaker. Tras `umbral` fallos seguidos se abre y rechaza las consultas;
+    pasados `espera` segundos deja pasar una consulta de prueba (semiabierto) y
+    vuelve a cerrarse si sale bien.
+    """
+
+    CERRADO = 'cerrado'
+    ABIERTO = 'abierto'
+    SEMIABIERTO = 'semiabierto'
+
+    def __init__(self, umbral=CIRCUIT_FAILURE_THRESHOLD, espera=CIRCUIT_RESET_TIMEOUT):
+        self.umbral = umbral
+        self.espera = espera
+        self.estado = self.CERRADO
+        self.fallos = 0
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    def permitir(self):
+        """
+        Raises:
+            CircuitoAbierto: Si no se debe consultar al servicio en este momento
+        """
+        with self._lock:
+            if self.estado == self.CERRADO:
+                return
+            if self.estado == self.ABIERTO and time.monotonic() - self._abierto_desde >= self.espera:
+                self.estado = self.SEMIABIERTO
+                self._prueba_en_curso = False
+            if self.estado == self.SEMIABIERTO and not self._prueba_en_curso:
+                self._prueba_en_curso = True
+                return
+        raise CircuitoAbierto("El servicio del Poder Judicial no está respondiendo. Por favor, intente más tarde.")
+
+    def registrar_exito(self):
+        with self._lock:
+            if self.estado != self.CERRADO:
+                logger.info("Circuito del servicio SOAP cerrado")
+            self.estado = self.CERRADO
+            self.fallos = 0
+            self._prueba_en_curso = False
+
+    def registrar_fallo(self):
+        with self._lock:
+            self.fallos += 1
+            if self.estado == self.SEMIABIERTO or self.fallos >= self.umbral:
+                if self.estado != self.ABIERTO:
+                    logger.warning(f"Circuito del servicio SOAP abierto tras {self.fallos} fallos")
+                self.estado = self.ABIERTO
+                self._abierto_desde = time.monotonic()
+                self._prueba_en_curso = False
+
+    def liberar_prueba(self):
+        """
+        La consulta de prueba terminó sin resultado (p. ej. se canceló): se deja
+        que la próxima consulta vuelva a probar en lugar de quedar semiabierto sin fin
+        """
+        with self._lock:
+            self._prueba_en_curso = False
+
+    @property
+    def abierto(self):
+        return self.estado == self.ABIERTO
+
+
+def es_error_transitorio(error):
+    """
+    Errores de red o del servidor que vale la pena reintentar.
+    Un Fault SOAP es una respuesta válida del servicio y no se reintenta.
+    """
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, httpx.TransportError)):
+        return True
+    if isinstance(error, TransportError):
+        return error.status_code is None or error.status_code >= 500
+    return False
+
+
+def _espera(intento, base):
+    # Backoff exponencial con "full jitter" para no sincronizar los reintentos
+    return random.uniform(0, base * (2 ** intento))
+
+
+def _permitir(circuito):
+    try:
+        circuito.permitir()
+    except CircuitoAbierto as e:
+        metricas.registrar_error(e)
+        raise
+
+
+def llamar_con_reintentos(funcion, circuito, reintentos=SOAP_RETRIES, espera_base=SOAP_RETRY_BACKOFF):
+    """
+    Ejecuta `funcion` (una consulta idempotente) reintentando los errores transitorios
+    Raises:
+        CircuitoAbierto: Si el circuito está abierto
+    """
+    _permitir(circuito)
+    intento = 0
+    while True:
+        try:
+            resultado = funcion()
+        except Exception as e:
+            metricas.registrar_error(e)
+            if not es_error_transitorio(e):
+                # El servicio respondió (p. ej. con un Fault): no es un fallo de disponibilidad
+                circuito.registrar_exito()
+                raise
+            circuito.registrar_fallo()
+            if intento >= reintentos or circuito.abierto:
+                raise
+            logger.warning(f"Reintentando consulta SOAP tras error transitorio: {str(e) or type(e).__name__}")
+            time.sleep(_espera(intento, espera_base))
+            intento += 1
+            continue
+        except BaseException:
+            # Cancelación o interrupción: no dice nada del servicio, pero si era la
+            # consulta de prueba hay que liberarla
+            circuito.liberar_prueba()
+            raise
+        circuito.registrar_exito()
+        return resultado
+
+
+async def llamar_con_reintentos_async(funcion, circuito, reintentos=SOAP_RETRIES, espera_base=SOAP_RETRY_BACKOFF):
+    """
+    Igual que llamar_con_reintentos() para una corrutina
+    """
+    _permitir(circuito)
+    intento = 0
+    while True:
+        try:
+            resultado = await funcion()
+        except Exception as e:
+            metricas.registrar_error(e)
+            if not es_error_transitorio(e):
+                circuito.registrar_exito()
+                raise
+            circuito.registrar_fallo()
+            if intento >= reintentos or circuito.abierto:
+                raise
+            logger.warning(f"Reintentando consulta SOAP tras error transitorio: {str(e) or type(e).__name__}")
+            await asyncio.sleep(_espera(intento, espera_base))
+            intento += 1
+            continue
+        except BaseException:
+            # Cancelación o interrupción: no dice nada del servicio, pero si era la
+            # consulta de prueba hay que liberarla
+            circuito.liberar_prueba()
+            raise
+        circuito.registrar_exito()
+        return resultado